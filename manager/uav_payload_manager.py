@@ -6,11 +6,14 @@ import sys
 import subprocess
 import signal
 import threading
+from ruamel.yaml import YAML
 
 sys.path.append("preprocessing")
 from generate_chirp import generate_from_yaml_filename
 sys.path.append("postprocessing")
 from save_data import save_data
+from radar_output import RadarOutputReader
+from quicklook import QuickLookRadargram
 
 # Nominal flow:
 # setup -> ready -[button press]-> starting -> recording -[button press]-> saving -> ready
@@ -30,6 +33,9 @@ expected_cwd = "/home/ubuntu/uhd_radar"
 yaml_filename = None
 uhd_process = None
 uhd_output_reader_thread = None
+output_reader = None
+quicklook = None
+health_print_interval = 10 # [s] How often to print live counters while recording
 
 # Setup button and button LED
 button = gpiozero.Button(4, pull_up=False, hold_time=5)
@@ -84,18 +90,39 @@ def update_led_state():
             print(e)
 
 # Output logging
-def log_output_from_usrp(out, file_out):
+def check_for_recording_start(line):
     global current_state
-    for line in iter(out.readline, ''):
-        if (current_state != "saving") and (line.startswith("Received chirp") or line.startswith("[START]")):
-            current_state = "recording"
-        file_out.write(f"[{time.time():0.3f}] \t{line}")
-        print(f"UHD output: \t{line}", end="")
-    out.close()
-    file_out.close()
+    if (current_state != "saving") and (line.startswith("Received chirp") or line.startswith("[START]")):
+        current_state = "recording"
+    if quicklook is not None:
+        if line.startswith("[OPEN FILE]"):
+            quicklook.tail_file(strip_binary_path(line[12:].strip()))
+        elif line.startswith("[CLOSE FILE]"):
+            quicklook.add_file(strip_binary_path(line[13:].strip()))
+
+def strip_binary_path(filename):
+    if filename.startswith("../../"): # Automatically added to escape cwd of binary
+        filename = filename[6:] # Strip it out
+    return filename
+
+def radar_binary(config):
+    # Radar program to run from sdr/build (RUN_MANAGER:radar_binary can be set to ../simulated_radar.py to run without hardware)
+    return config['RUN_MANAGER'].get('radar_binary') or "./radar"
+
+def log_output_from_usrp(out, file_out):
+    global output_reader
+    output_reader = RadarOutputReader(file_out, line_callback=check_for_recording_start)
+    output_reader.read(out)
+
+def print_health():
+    if output_reader is None:
+        return
+    stats = output_reader.stats()
+    print(f"Recording for {stats['elapsed_s']:.0f} s: ~{stats['pulses_per_second']:.0f} pulses/s, " +
+          f"{stats['errors']} errors ({stats['errors_per_second']:.1f}/s), {stats['files_closed']} files closed")
 
 def start_recording():
-    global current_state, uhd_process, uhd_output_reader_thread
+    global current_state, uhd_process, uhd_output_reader_thread, quicklook
 
     print("Starting UHD process")
     current_state = "starting"
@@ -109,13 +136,21 @@ def start_recording():
         print(e)
         error_and_quit()
 
-    uhd_process = subprocess.Popen(["./radar", yaml_filename], stdout=subprocess.PIPE, bufsize=1, close_fds=True, text=True, cwd="sdr/build")
+    # Optionally render a quick-look radargram while recording
+    with open(yaml_filename) as stream:
+        config = YAML().load(stream)
+    if config['RUN_MANAGER'].get('quicklook_loc') is not None:
+        quicklook = QuickLookRadargram(config, config['RUN_MANAGER']['quicklook_loc'],
+            n_stack=config['RUN_MANAGER'].get('quicklook_n_stack', 100))
+        quicklook.start()
+
+    uhd_process = subprocess.Popen([radar_binary(config), yaml_filename], stdout=subprocess.PIPE, bufsize=1, close_fds=True, text=True, cwd="sdr/build")
     uhd_output_reader_thread = threading.Thread(target=log_output_from_usrp, args=(uhd_process.stdout, open('uhd_stdout.log', 'w')))
     uhd_output_reader_thread.daemon = True # thread dies with the program
     uhd_output_reader_thread.start()
 
 def stop_recording():
-    global current_state, yaml_filename
+    global current_state, yaml_filename, quicklook
 
     was_force_killed = False
 
@@ -132,6 +167,11 @@ def stop_recording():
         uhd_process.kill()
         was_force_killed = True
 
+    if quicklook is not None:
+        uhd_output_reader_thread.join()
+        quicklook.finish()
+        quicklook = None
+
     # Save output
     print("Copying data files...")
     save_data(yaml_filename, extra_files={"uhd_stdout.log": "uhd_stdout.log"})
@@ -189,10 +229,12 @@ def run_and_fail_on_nonzero(cmd):
         print(f"Running '{cmd}' produced non-zero return value {retval}. Quitting...")
         error_and_quit()
 
-os.chdir("sdr/build")
-run_and_fail_on_nonzero("cmake ..")
-run_and_fail_on_nonzero("make")
-os.chdir("../..")
+with open(yaml_filename) as stream:
+    if radar_binary(YAML().load(stream)) == "./radar":
+        os.chdir("sdr/build")
+        run_and_fail_on_nonzero("cmake ..")
+        run_and_fail_on_nonzero("make")
+        os.chdir("../..")
 
 # If successful, move on to ready state
 time.sleep(1) # TODO: Could remove - helps make it more obvious what's happening
@@ -202,10 +244,16 @@ button.when_held = button_hold # When held, ask system to shutdown
 update_led_state()
 
 # The rest is handled asynchronously
+last_health_print = time.time()
 while True:
     # Check and updated LED state
     update_led_state()
 
+    # Periodically print live counters
+    if (current_state == "recording") and (time.time() - last_health_print > health_print_interval):
+        print_health()
+        last_health_print = time.time()
+
     # Check if UHD process ended on it's own
     if (current_state == "recording") and uhd_process:
         retval = uhd_process.poll()
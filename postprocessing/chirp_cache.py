@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import hashlib
+import collections
+import threading
+
+import numpy as np
+import scipy.fft
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from generate_chirp import generate_chirp, CHIRP_PARAMETERS
+
+class ChirpCache():
+    """
+    Cache of reference chirps and matched filter spectra, so that processing many files from
+    the same survey doesn't repeatedly synthesize the same chirp and compute the same FFT.
+
+    Reference chirps are keyed by a hash of the GENERATE parameters used by `generate_chirp`.
+    Matched filters are keyed by a hash of the chirp samples, the FFT length, and the dtype.
+    Each matched filter entry holds the time domain chirp, the conjugate of its spectrum, and
+    its energy (sum of |chirp|^2, used to normalize the pulse compression output).
+
+    At most `max_entries` entries are kept in memory (least recently used entries are
+    evicted first). If `cache_dir` is provided, entries are also saved there as .npz files
+    and loaded from there when they're not in memory.
+
+    Cached arrays are shared between every caller, so they're read-only. Copy them before
+    modifying them.
+
+    Most code should just use the module-level `chirp_cache` instance.
+    """
+    def __init__(self, max_entries=32, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def reference_chirp(self, config):
+        """
+        Cached version of `generate_chirp(config)`. Returns a tuple (ts, chirp_complex).
+        """
+        gen_params = {key: config["GENERATE"].get(key) for key in CHIRP_PARAMETERS}
+        key = "chirp_" + _hash(json.dumps(gen_params, sort_keys=True, default=str).encode())
+
+        entry = self._get(key)
+        if entry is None:
+            ts, chirp = generate_chirp(config)
+            if ts is None:
+                raise ValueError("Error occured when generating chirp.")
+            entry = self._put(key, {"ts": ts, "chirp": chirp})
+        return entry["ts"], entry["chirp"]
+
+    def matched_filter(self, chirp, fft_len, dtype=np.complex128):
+        """
+        Return a dictionary with the time domain "chirp", the conjugate of its spectrum
+        computed with an FFT of length `fft_len` ("spectrum_conj", of type `dtype`), and
+        the chirp "energy" (sum of |chirp|^2).
+        """
+        chirp = np.asarray(chirp)
+        dtype = np.dtype(dtype)
+        key = f"mf_{_hash(chirp.tobytes(), str(chirp.dtype).encode())}_{fft_len}_{dtype.str.strip('<>|=')}"
+
+        entry = self._get(key)
+        if entry is None:
+            entry = self._put(key, {
+                "chirp": chirp.copy(), # Don't freeze the caller's array
+                "spectrum_conj": np.conj(scipy.fft.fft(chirp, fft_len)).astype(dtype),
+                "energy": np.sum(np.abs(chirp)**2)
+            })
+        return entry
+
+    def clear(self):
+        """
+        Remove all entries from memory (entries saved in `cache_dir` are kept)
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def _get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + ".npz")
+            if os.path.exists(path):
+                with np.load(path) as f:
+                    return self._put(key, {name: f[name] for name in f.files}, save=False)
+
+        return None
+
+    def _put(self, key, entry, save=True):
+        for value in entry.values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+
+        if save and (self.cache_dir is not None):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            np.savez(os.path.join(self.cache_dir, key + ".npz"), **entry)
+
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+def _hash(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part)
+    return h.hexdigest()
+
+chirp_cache = ChirpCache()
@@ -0,0 +1,135 @@
+import os
+import re
+import shutil
+import queue
+import threading
+
+import zarr
+
+import processing_dask
+
+class LiveZarrConverter():
+    """
+    Builds a zarr dataset from the partial rx_samps.bin.N files while the radar is still
+    recording, so that an analysis-ready zarr store exists as soon as the recording ends.
+
+    Typical use (this is what run.py does when RUN_MANAGER:live_zarr_loc is set):
+
+    converter = LiveZarrConverter(config, "data/rx_samps.zarr")
+    converter.start()
+    converter.add_file("data/rx_samps.bin.0") # For each [CLOSE FILE] line
+    converter.process_log_line(line) # For each line of stdout from the radar program
+    converter.finish() # Wait for all queued files to be converted
+    converter.save(prefix, stdout_log) # Move the zarr store next to the rest of the data
+
+    The final zarr store has the same layout as one produced by
+    `processing_dask.save_radar_data_to_zarr`, so it can be used interchangeably.
+    """
+    def __init__(self, config, zarr_path):
+        self.config = config
+        self.zarr_path = zarr_path
+
+        self.file_queue = queue.Queue()
+        self.n_pulses = 0 # Number of pulses written to the zarr store so far
+        self.n_files = 0 # Number of files written to the zarr store so far
+        self.failed = False # Set if a file couldn't be converted, after which no more are added
+        self.errors = {} # Errors reported so far, chirp index -> error code
+
+        self.converter_thread = None
+
+    def start(self):
+        """
+        Start the background conversion thread
+        """
+        self.converter_thread = threading.Thread(target=self._convert_from_queue)
+        self.converter_thread.daemon = True # thread dies with the program
+        self.converter_thread.start()
+
+    def add_file(self, filename):
+        """
+        Queue a closed rx_samps file for conversion. Files must be added in recording order.
+        """
+        self.file_queue.put(filename)
+
+    def process_log_line(self, line):
+        """
+        Keep track of errors reported by the radar program, so they can be stored with the data
+        """
+        if "Receiver error:" in line:
+            chirp_search = re.search(r"(?:Chirp )([\d]+)", line)
+            if chirp_search is not None:
+                self.errors[int(chirp_search.groups()[0])] = re.search(
+                    r"(?:Receiver error: )([\w_]+)", line).groups()[0]
+
+    def finish(self):
+        """
+        Wait for every queued file to be converted and stop the background thread
+        """
+        if self.converter_thread is None:
+            return
+        self.file_queue.put(None)
+        self.converter_thread.join()
+        self.converter_thread = None
+
+    def save(self, prefix, stdout_log=None):
+        """
+        Add the final attributes to the zarr store and move it to `prefix` + ".zarr", which is
+        where `processing_dask.save_radar_data_to_zarr` would have put it.
+
+        Returns the new path to the zarr store, or None if no data was converted or the
+        conversion failed (in which case the incomplete store is left at zarr_path, marked with
+        the live_conversion_incomplete attribute, and the zarr store should be built from the
+        saved data with `processing_dask.save_radar_data_to_zarr` instead).
+        """
+        if self.failed or (self.n_files == 0):
+            return None
+
+        processing_dask.add_stdout_log_to_zarr(self.zarr_path, stdout_log)
+        zarr.open_group(self.zarr_path, mode='r+').attrs.update({
+            "config": self.config, # Needed by the error handling functions and pulse_compress
+            "prefix": prefix,
+            "basename": os.path.basename(prefix),
+            "live_errors": self._errors_attr()
+        })
+        zarr.consolidate_metadata(self.zarr_path)
+
+        final_zarr_path = prefix + ".zarr"
+        shutil.move(self.zarr_path, final_zarr_path)
+        return final_zarr_path
+
+    def _errors_attr(self):
+        # JSON-compatible version of self.errors
+        chirp_idxs = sorted(self.errors.keys())
+        return {"chirp_idx": chirp_idxs, "error_code": [self.errors[idx] for idx in chirp_idxs]}
+
+    def _convert_from_queue(self):
+        while True:
+            filename = self.file_queue.get()
+            if filename is None:
+                return
+            if self.failed:
+                continue
+
+            try:
+                n = processing_dask.append_radar_data_to_zarr(filename, self.zarr_path, self.config,
+                        first_pulse_idx=self.n_pulses, attrs={"live_errors": self._errors_attr()})
+            except Exception as e:
+                # Pulses from any later file would be appended with the wrong pulse_idx, so stop here
+                print(f"[LIVE ZARR] Failed to convert {filename}: {e}. Stopping live zarr conversion.")
+                self._mark_incomplete(f"Failed to convert {filename}: {e}")
+                continue
+
+            if n > 0:
+                self.n_pulses += n
+                self.n_files += 1
+            print(f"[LIVE ZARR] Added {n} pulses from {filename} ({self.n_pulses} total)")
+
+    def _mark_incomplete(self, reason):
+        self.failed = True
+        try:
+            zarr.open_group(self.zarr_path, mode='r+').attrs.update({
+                "live_conversion_incomplete": True,
+                "live_conversion_error": reason
+            })
+        except Exception:
+            pass # No store was created yet
@@ -1,9 +1,12 @@
-import shutil
-import glob
 import argparse
-import re
 import os
 
+from processing import findRxSampsParts
+from save_data import append_file
+
+# Note: merging is optional. processing.load_radar_data, processing.load_radar_window, and
+# processing_dask.save_radar_data_to_zarr can all read the partial files directly.
+
 if __name__ == "__main__":
     # Accept one command line argument, a string called prefix
     parser = argparse.ArgumentParser()
@@ -13,33 +16,16 @@ if __name__ == "__main__":
                         help='Output file name. If left blank, will be prefix + "_rx_samps.bin"')
     args = parser.parse_args()
 
-    path = args.prefix + '_p*_rx_samps.bin'
-    files = glob.glob(path, recursive=False)
-    file_ordering = {}
-    for filename in files:
-        filename_search = re.search('\d{8}_\d{6}_p(\d+)_rx_samps.bin', filename)
-        if filename_search:
-            file_ordering[int(filename_search.group(1))] = filename
-
-    file_idxs = list(file_ordering.keys())
-    file_idxs.sort()
-
-    print("Found files:")
-    for idx in file_idxs:
-        print(f"[{idx}] {file_ordering[idx]}")
-
-    # Sanity check file list to see if we're missing anything, have duplicates, or have no files
-    if len(set(file_idxs)) != len(file_idxs):
-        print("Error: duplicate file indices found.")
-        exit(1)
-    
-    if len(file_idxs) == 0:
-        print("Error: no files found.")
+    # Find the files, checking that we're not missing anything, have duplicates, or have no files
+    try:
+        filenames = findRxSampsParts(args.prefix)
+    except ValueError as e:
+        print(f"Error: {e}")
         exit(1)
 
-    if len(file_idxs) != file_idxs[-1] + 1:
-        print("Error: missing file indices.")
-        exit(1)
+    print("Found files:")
+    for idx, filename in enumerate(filenames):
+        print(f"[{idx}] {filename}")
 
     # Generate output filename
     if args.output is None:
@@ -52,8 +38,8 @@ if __name__ == "__main__":
     
     print(f"\nEverything looks OK. Merging files to {args.output}...")
     with open(args.output, 'wb') as outfile:
-        for idx in file_idxs:
-            print(f"Copying {file_ordering[idx]}...")
-            shutil.copyfileobj(open(file_ordering[idx], 'rb'), outfile)
+        for filename in filenames:
+            print(f"Copying {filename}...")
+            append_file(filename, outfile)
 
-    print(f"Done. Merged data written to {args.output}")
\ No newline at end of file
+    print(f"Done. Merged data written to {args.output}")
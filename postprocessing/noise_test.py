@@ -1,145 +1,226 @@
-# Assumes that coherent summation is OFF in coherent.cpp 
+# Assumes that coherent summation is OFF in coherent.cpp
 # (This depends on #ifdef and can't be set via yaml. Edit coherent.cpp
-# directly--or, if you're doing this a lot, change #ifdef to an if 
+# directly--or, if you're doing this a lot, change #ifdef to an if
 # statement so that you can set the value of average_before_save via yaml)
-# Assumes that SDR configuration is loopback. 
+# Assumes that SDR configuration is loopback.
+#
+# Monte Carlo test of SNR versus number of coherent sums: white noise is added
+# to every received pulse, and the SNR of the average of the first k pulses
+# (against the first, "ideal", pulse) is computed for every k = 1..N.
+# Pulses are read, aligned, and summed a chunk at a time, so the number of
+# pulses is only limited by the size of the recording. NOISE:noise_std can be
+# a single value or a list of values, which are all run in one pass.
+#
+# Usage (from the root of the repository):
+#   python postprocessing/noise_test.py config/default.yaml --chunk_pulses 1024
+import os
+import argparse
 import numpy as np
-import numpy.random as rand
 import scipy.signal as sp
 import matplotlib.pyplot as plt
 import processing as pr
 from ruamel.yaml import YAML as ym
 
-# Initialize constants
-yaml = ym(typ='safe')                 # Always use safe load if not dumping
-with open("config/default.yaml") as stream:
-    config = yaml.load(stream)
-    noise_params = config["NOISE"]
-    sample_rate = noise_params["sample_rate"]
-    rx_samps = noise_params["rx_samps"]
-    orig_chirp = noise_params["orig_chirp"]
-    noise_std = noise_params["noise_std"]
-    coh_sums = noise_params["coherent_sums"]
-    direct_start = noise_params["direct_start"]
-    show_graphs = noise_params["show_graphs"]
-    describe = noise_params["describe"]
-    
-print("--- Loaded constants from config.yaml ---")
-    
-# Open received data
-print("--- Opening data and determining direct path peak for first signal---")
-rx_sig = pr.extractSig(rx_samps)
-n_rx_samps = int(np.shape(rx_sig)[0])
-if (show_graphs): pr.plotSignal(rx_sig, 'Loopback Test', sample_rate) 
-
-# Read original chirp
-tx_sig = pr.extractSig(orig_chirp)
-n_tx_samps = int(np.shape(tx_sig)[0])
-if (show_graphs): pr.plotSignal(tx_sig, 'Original Chirp', sample_rate)
-
-# Read the first chirp in received data -- this is the "ideal" signal for SNR
-samps_per = int(n_rx_samps / coh_sums)
-rx_ideal = rx_sig[0:samps_per]
-xcorr_ideal = np.abs(sp.correlate(rx_ideal, tx_sig, mode='valid', method='auto'))
-dir_peak = pr.findDirectPath(xcorr_ideal, direct_start, describe)
-
-if (show_graphs): pr.plotChirpVsTime(rx_ideal, "'Ideal' Signal", sample_rate)
-
-# Split received data into individual signals
-print("--- Splitting rx signal into individual chirps ---")
-signals = []   
-for x in range(coh_sums):
-   ind_start = x * (samps_per)
-   this_sig = np.zeros(samps_per, dtype=np.csingle)
-   for y in range(samps_per):
-      this_sig[y] = rx_sig[ind_start + y]
-   signals.append(this_sig)
-signals = np.asarray(signals)
-
-# For each signal:
-count = 1
-num_misalign = 0
-total = np.zeros(samps_per, dtype=np.csingle)   
-snrs = np.zeros(coh_sums)
-for sig in signals:
-    
-    # Match filter signal & determine direct path peak to ensure alignment with ideal signal
-    if (describe): print("\n--- Beginning Processing of Signal %d ---" % count)
-    xcorr_sig = np.abs(sp.correlate(sig, tx_sig, mode='valid', method='auto'))
-        
-    aligned = (dir_peak == pr.findDirectPath(xcorr_sig, direct_start, describe))
-    if (describe): print("\tIs Signal %d aligned with the first? %r" % (count, aligned))
-    if (not aligned):
-        if describe: print("--- Skipping signal %d due to poor alignment with first signal ---", count)
-        num_misalign += 1
-        continue
-
-    # Add white noise
-    if (describe): print("--- Adding White Noise ---")
-    white_noise = np.zeros(samps_per, dtype=np.csingle)
-    rx_noise = np.zeros(samps_per, dtype=np.csingle)
-    for x in range(samps_per):
-        noise_r = rand.normal(0, noise_std)
-        noise_i = rand.normal(0, noise_std)
-        white_noise[x] = np.csingle(complex(np.float32(noise_r), np.float32(noise_i)))
-    rx_noise = np.add(white_noise, sig)         # Element-wise
+# Read a recording as chunks of pulses
+# -----
+# filename     - the rx samples file to read
+# samps_per    - number of samples in each pulse
+# chunk_pulses - maximum number of pulses in each chunk
+# num_pulses   - number of pulses to read, -1 to read to the end of the file
+# cpu_format   - the CPU-side sample format the file was recorded with
+# Yields complex64 arrays of shape (pulses, samps_per)
+def pulse_chunks(filename, samps_per, chunk_pulses=1024, num_pulses=-1, cpu_format='fc32'):
+    sample_dtype, _ = pr.sample_format(cpu_format)
+    bytes_per_pulse = 2 * samps_per * np.dtype(sample_dtype).itemsize
+    n_available = os.path.getsize(filename) // bytes_per_pulse
+    if (num_pulses < 0) or (num_pulses > n_available):
+        num_pulses = n_available
+
+    for start in range(0, num_pulses, chunk_pulses):
+        n = min(chunk_pulses, num_pulses - start)
+        sig = pr.extractSig(filename, count=2*samps_per*n, offset=start*bytes_per_pulse, cpu_format=cpu_format)
+        yield np.reshape(sig, (n, samps_per))
+
+# Check which pulses have their direct path peak at the same sample as the
+# ideal signal. This is the same test as pr.findDirectPath on the match filter
+# of each pulse, done for all of the pulses at once.
+# -----
+# pulses       - complex array of shape (pulses, samps_per)
+# tx_sig       - the transmitted chirp
+# dir_peak     - direct path peak sample of the ideal signal
+# direct_start - sample at which to start the search for the direct path
+# Returns a boolean array with one element per pulse
+def aligned_pulses(pulses, tx_sig, dir_peak, direct_start):
+    xcorr = np.abs(sp.fftconvolve(pulses, np.conj(tx_sig[::-1])[np.newaxis, :], mode='valid', axes=1))
+    return (np.argmax(xcorr[:, direct_start:], axis=1) + direct_start) == dir_peak
+
+# Compute the SNR after every number of coherent sums, for several noise levels
+# at once.
+#
+# For each chunk of pulses, one set of standard normal noise is drawn and
+# cumulative sums along the pulses give the running sum of the signal (S_k)
+# and of the unit noise (Z_k) after every pulse. The error of the average of k
+# pulses with noise standard deviation s is (S_k - k*ideal + s*Z_k)/k, so its
+# power only depends on three statistics of each k:
+#   a = mean(|S_k - k*ideal|^2), b = mean(Re((S_k - k*ideal) * conj(Z_k))), c = mean(|Z_k|^2)
+# and the noise power for any s is (a + 2*s*b + s^2*c) / k^2. Every noise
+# level is therefore computed from the same noise (common random numbers),
+# which makes the curves for different levels directly comparable and costs
+# no more than running a single level. The running sums are carried between
+# chunks in double precision.
+# -----
+# chunks     - iterable of complex arrays of shape (pulses, samps_per)
+# ideal      - the noise-free signal, used as the reference for SNR
+# noise_stds - standard deviation(s) of the noise added to each of I and Q
+# rng        - numpy random Generator (or seed) used to draw the noise
+# Returns (snrs, final_averages): snrs has shape (len(noise_stds), N), where
+# snrs[i, k-1] is the SNR (as a ratio, like pr.getSNR) after k sums with
+# noise_stds[i], and final_averages is the average of all N pulses with noise
+# for each noise level, with shape (len(noise_stds), samps_per).
+def snr_vs_sums(chunks, ideal, noise_stds, rng=None):
+    rng = np.random.default_rng(rng)
+    ideal = np.asarray(ideal, dtype=np.complex128)
+    noise_stds = np.atleast_1d(np.asarray(noise_stds, dtype=np.float64))
+    samps_per = np.shape(ideal)[0]
+    avg_signal_pwr = np.mean(np.abs(ideal)**2)
+
+    signal_total = np.zeros(samps_per, dtype=np.complex128)
+    noise_total = np.zeros(samps_per, dtype=np.complex128)
+    n = 0
+    a, b, c = [], [], []
+    for chunk in chunks:
+        if np.shape(chunk)[1] != samps_per:
+            raise ValueError(f"Pulses have {np.shape(chunk)[1]} samples, but the ideal signal has {samps_per}.")
+        m = np.shape(chunk)[0]
+        if m == 0:
+            continue
+        k = np.arange(n + 1, n + m + 1)
+
+        unit_noise = rng.standard_normal((m, 2*samps_per), dtype=np.float32).view(np.complex64)
+        cum_noise = np.cumsum(unit_noise, axis=0, dtype=np.complex128)
+        cum_noise += noise_total
+        error = np.cumsum(chunk, axis=0, dtype=np.complex128)
+        error += signal_total
+        signal_total = error[-1].copy()
+        noise_total = cum_noise[-1].copy()
+        error -= k[:, np.newaxis] * ideal[np.newaxis, :]
+
+        a.append(np.mean(np.abs(error)**2, axis=1))
+        b.append(np.mean(np.real(error * np.conj(cum_noise)), axis=1))
+        c.append(np.mean(np.abs(cum_noise)**2, axis=1))
+        n += m
+
+    if n == 0:
+        raise ValueError("No pulses to sum.")
+    a, b, c = np.concatenate(a), np.concatenate(b), np.concatenate(c)
+    k = np.arange(1, n + 1)
+    s = noise_stds[:, np.newaxis]
+    avg_noise_pwr = (a + 2*s*b + s**2 * c) / k**2
+    snrs = avg_signal_pwr / avg_noise_pwr
+
+    final_averages = ((signal_total[np.newaxis, :] + s * noise_total[np.newaxis, :]) / n).astype(np.csingle)
+    return snrs, final_averages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("yaml_file", nargs='?', default='config/default.yaml', help='Path to YAML configuration file')
+    parser.add_argument("--chunk_pulses", type=int, default=1024, help='Number of pulses processed at once')
+    parser.add_argument("--seed", type=int, default=None, help='Seed for the noise')
+    args = parser.parse_args()
+
+    # Initialize constants
+    yaml = ym(typ='safe')                 # Always use safe load if not dumping
+    with open(args.yaml_file) as stream:
+        config = yaml.load(stream)
+        noise_params = config["NOISE"]
+        sample_rate = noise_params["sample_rate"]
+        rx_samps = noise_params["rx_samps"]
+        orig_chirp = noise_params["orig_chirp"]
+        noise_stds = np.atleast_1d(noise_params["noise_std"])
+        coh_sums = noise_params.get("coherent_sums", -1)  # -1 to use every pulse in the file
+        direct_start = noise_params["direct_start"]
+        show_graphs = noise_params["show_graphs"]
+        describe = noise_params["describe"]
+        cpu_format = config.get("DEVICE", {}).get("cpu_format", "fc32")
+
+    print("--- Loaded constants from config.yaml ---")
+
+    # Work out the length of each pulse
+    sample_dtype, _ = pr.sample_format(cpu_format)
+    n_rx_samps = os.path.getsize(rx_samps) // (2 * np.dtype(sample_dtype).itemsize)
+    if coh_sums > 0:
+        samps_per = int(n_rx_samps / coh_sums)
+    else:
+        samps_per = int(config["CHIRP"]["rx_duration"] * sample_rate)
+        coh_sums = n_rx_samps // samps_per
+
+    # Read original chirp
+    tx_sig = pr.extractSig(orig_chirp)
+    if (show_graphs): pr.plotSignal(tx_sig, 'Original Chirp', sample_rate)
+
+    # Read the first chirp in received data -- this is the "ideal" signal for SNR
+    print("--- Opening data and determining direct path peak for first signal---")
+    rx_ideal = np.array(next(pulse_chunks(rx_samps, samps_per, 1, cpu_format=cpu_format))[0])
+    xcorr_ideal = np.abs(sp.correlate(rx_ideal, tx_sig, mode='valid', method='auto'))
+    dir_peak = pr.findDirectPath(xcorr_ideal, direct_start, describe)
+
+    if (show_graphs): pr.plotChirpVsTime(rx_ideal, "'Ideal' Signal", sample_rate)
+
+    # Skip pulses that aren't aligned with the ideal signal, counting them as they go by
+    num_misalign = 0
+    def aligned_chunks():
+        global num_misalign
+        for chunk in pulse_chunks(rx_samps, samps_per, args.chunk_pulses, num_pulses=coh_sums, cpu_format=cpu_format):
+            aligned = aligned_pulses(chunk, tx_sig, dir_peak, direct_start)
+            num_misalign += np.sum(~aligned)
+            yield chunk[aligned]
+
+    print(f"--- Adding white noise and coherently summing {coh_sums} signals, {args.chunk_pulses} at a time ---")
+    snrs, avg_totals = snr_vs_sums(aligned_chunks(), rx_ideal, noise_stds, rng=args.seed)
+    n_sums = np.shape(snrs)[1]
+    if num_misalign > 0:
+        print(f"--- Skipped {num_misalign} signals due to poor alignment with first signal ---")
+
+    for noise_std, snr in zip(noise_stds, snrs):
+        print(f"\tnoise_std {noise_std}: SNR {snr[0]:f} after 1 sum, {snr[-1]:f} after {n_sums} sums " +
+              f"({10*np.log10(snr[-1]/snr[0]):.2f} dB gain, {10*np.log10(n_sums):.2f} dB expected)")
 
     # Plot an example signal with white noise and match filter
-    if (count == 1): 
-        if (describe): print("--- Plotting an individual signal with added white noise ---")
-        rx_time = np.zeros(samps_per)
-        for x in range(samps_per):
-            rx_time[x] = x/sample_rate
-        rx_time *= 1e6
-            
-        pr.plotChirpVsTime(rx_noise, "Individual Signal With Noise", sample_rate)
-        
-        xcorr_noise = np.abs(sp.correlate(rx_noise, tx_sig, mode='valid', method='auto'))
-        xcorr_noise_samps = np.shape(xcorr_noise)[0]
-        xcorr_noise_time = np.zeros(xcorr_noise_samps)
-        for x in range(xcorr_noise_samps):
-            xcorr_noise_time[x] = x * 1e6 / sample_rate
-            
-        plt.figure()
-        plt.plot(xcorr_noise_time, 20* np.log10(xcorr_noise))
-        plt.title("Match-filter of Individual Signal with Noise")
-        plt.xlabel("Time (ms)")
-        plt.ylabel("Power [dB]")
-        plt.show()
-    
-    # Coherently sum and calculate SNR
-    if (describe): print("--- Coherently sum result ---")
-    for x in range(samps_per):
-        total[x] += rx_noise[x]
-    avg_total = np.divide(total, count)
-    if (show_graphs): pr.plotSignal(avg_total, 'Received signal after %d coherent summations' % (count-num_misalign), sample_rate) 
-    
-    print("--- Calculating SNR after %d coherent summations ---" % (count - num_misalign))
-    this_snr = pr.getSNR(rx_ideal, avg_total)
-    print("\tSNR: %f" % this_snr)    
-    snrs[count-1]=this_snr
-
-    count += 1
-
-print("\n--- Plotting total signal after %d coherent summations ---" % coh_sums)
-pr.plotChirpVsTime(avg_total, "Total after %d summations" % coh_sums, sample_rate)
-
-print("--- Plotting match filter of total signal after %d coherent summations ---" % coh_sums)
-xcorr_total = np.abs(sp.correlate(avg_total, tx_sig, mode='valid', method='auto'))
-plt.figure()
-plt.plot(xcorr_noise_time, 20*np.log10(xcorr_total))        # xcorr_noise and xcorr_total are the same shape
-plt.title("Match-filter of %d coherent summations" % coh_sums)
-plt.xlabel('Time (ms)')
-plt.ylabel('Power [dB]')
-plt.show()
-
-print("--- Plotting SNR versus # Sums ---")
-plt.figure()
-plt.plot(np.add(1, range(coh_sums)), snrs)
-plt.xlabel("Number of sums")
-plt.ylabel("Calculated SNR")
-plt.title("Signal to Noise Ratio versus Number of Coherent Sums")
-plt.show()
-
-
-    
+    print("--- Plotting an individual signal with added white noise ---")
+    rng = np.random.default_rng(args.seed)
+    rx_noise = rx_ideal + noise_stds[0] * rng.standard_normal(2*samps_per, dtype=np.float32).view(np.csingle)
+    pr.plotChirpVsTime(rx_noise, "Individual Signal With Noise", sample_rate)
+
+    xcorr_noise = np.abs(sp.correlate(rx_noise, tx_sig, mode='valid', method='auto'))
+    xcorr_noise_time = np.arange(np.shape(xcorr_noise)[0]) * 1e6 / sample_rate
+
+    plt.figure()
+    plt.plot(xcorr_noise_time, 20* np.log10(xcorr_noise))
+    plt.title("Match-filter of Individual Signal with Noise")
+    plt.xlabel("Time (ms)")
+    plt.ylabel("Power [dB]")
+    plt.show()
+
+    print("\n--- Plotting total signal after %d coherent summations ---" % n_sums)
+    pr.plotChirpVsTime(avg_totals[0], "Total after %d summations" % n_sums, sample_rate)
+
+    print("--- Plotting match filter of total signal after %d coherent summations ---" % n_sums)
+    xcorr_total = np.abs(sp.correlate(avg_totals[0], tx_sig, mode='valid', method='auto'))
+    plt.figure()
+    plt.plot(xcorr_noise_time, 20*np.log10(xcorr_total))        # xcorr_noise and xcorr_total are the same shape
+    plt.title("Match-filter of %d coherent summations" % n_sums)
+    plt.xlabel('Time (ms)')
+    plt.ylabel('Power [dB]')
+    plt.show()
+
+    print("--- Plotting SNR versus # Sums ---")
+    plt.figure()
+    sums = np.arange(1, n_sums + 1)
+    for noise_std, snr in zip(noise_stds, snrs):
+        p = plt.plot(sums, snr, label=f"noise_std = {noise_std}")
+        plt.plot(sums, snr[0] * sums, '--', color=p[0].get_color(), alpha=0.5)  # Ideal coherent gain
+    plt.xlabel("Number of sums")
+    plt.ylabel("Calculated SNR")
+    plt.title("Signal to Noise Ratio versus Number of Coherent Sums")
+    plt.legend()
+    plt.show()
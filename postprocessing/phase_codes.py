@@ -0,0 +1,107 @@
+import threading
+
+import numpy as np
+
+class PhaseCodeGenerator():
+    """
+    Reproduces the pseudorandom phase codes used by the radar program for phase dithering,
+    without needing a phase codes file from `pseudorandom_phase_to_file`.
+
+    The radar program (see sdr/pseudorandom_phase.hpp) uses a std::mt19937 seeded with 0 and
+    casts each 32 bit output to a float, using one output per chirp. numpy's legacy
+    RandomState uses the same Mersenne Twister and seeding algorithm, so the sequence is
+    identical.
+
+    Phases can be requested for any set of chirp indices with `phases(chirp_idxs)`. Only the
+    span of indices requested is held in memory. The generator state is saved every
+    `checkpoint_interval` chirps as it's reached, so later requests start from the nearest
+    checkpoint instead of from the start of the sequence.
+
+    Most code should just use the module-level `sdr_phase_codes` instance.
+    """
+    def __init__(self, seed=0, checkpoint_interval=2**20):
+        self.seed = seed
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoints = [np.random.RandomState(seed).get_state()] # checkpoints[i] is the state before chirp i*checkpoint_interval
+        self.lock = threading.Lock()
+
+    def phases(self, chirp_idxs):
+        """
+        Return the phases (as float32) for each chirp index in `chirp_idxs`
+        """
+        chirp_idxs = np.asarray(chirp_idxs, dtype=np.int64)
+        if chirp_idxs.size == 0:
+            return np.zeros(chirp_idxs.shape, dtype=np.float32)
+        if np.min(chirp_idxs) < 0:
+            raise ValueError("Chirp indices must be non-negative")
+
+        first = np.min(chirp_idxs)
+        codes = self._generate(first, np.max(chirp_idxs) - first + 1)
+        return codes[chirp_idxs - first]
+
+    def _generate(self, start, count):
+        # Generate phases for chirps [start, start + count)
+        with self.lock:
+            checkpoint_idx = min(start // self.checkpoint_interval, len(self.checkpoints) - 1)
+            state = self.checkpoints[checkpoint_idx]
+        random_state = np.random.RandomState()
+        random_state.set_state(state)
+
+        position = checkpoint_idx * self.checkpoint_interval
+        end = start + count
+        output = np.empty(count, dtype=np.float32)
+        while position < end:
+            # Generate up to the next checkpoint, the start of the requested span, or the end
+            next_checkpoint = (position // self.checkpoint_interval + 1) * self.checkpoint_interval
+            stop = min(next_checkpoint, end, start if position < start else end)
+            codes = random_state.randint(0, 2**32, size=stop - position, dtype=np.uint32)
+            if position >= start:
+                output[(position - start):(stop - start)] = codes # Implicit conversion to float32, same as the cast in C++
+            position = stop
+
+            if position == next_checkpoint:
+                self._add_checkpoint(position // self.checkpoint_interval, random_state.get_state())
+
+        return output
+
+    def _add_checkpoint(self, checkpoint_idx, state):
+        with self.lock:
+            if checkpoint_idx == len(self.checkpoints):
+                self.checkpoints.append(state)
+
+    def __getstate__(self):
+        # Locks can't be pickled (needed for dask's processes scheduler)
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+class PhaseCodeFile():
+    """
+    Phase codes read from a file written by `pseudorandom_phase_to_file` (a binary file of
+    float32 phases, one per chirp). Has the same `phases(chirp_idxs)` interface as
+    `PhaseCodeGenerator` but only reads the requested phases from disk.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def phases(self, chirp_idxs):
+        """
+        Return the phases (as float32) for each chirp index in `chirp_idxs`
+        """
+        codes = np.memmap(self.filename, dtype=np.float32, mode='r')
+        return np.array(codes[np.asarray(chirp_idxs, dtype=np.int64)])
+
+def phase_code_source(phase_codes_filename=None):
+    """
+    Return a `PhaseCodeFile` for `phase_codes_filename`, or the `sdr_phase_codes` generator
+    if `phase_codes_filename` is None.
+    """
+    if phase_codes_filename is None:
+        return sdr_phase_codes
+    return PhaseCodeFile(phase_codes_filename)
+
+sdr_phase_codes = PhaseCodeGenerator(seed=0)
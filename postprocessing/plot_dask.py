@@ -1,27 +1,217 @@
+import os
+import json
+import shutil
+
 import xarray as xr
 import dask.array as da
+import zarr
 
 import numpy as np
 import matplotlib.pyplot as plt
 
-def plot_radargram(pulse_compressed, figsize=None, vmin=-70, vmax=-40, ylims=(65,15), sig_speed=None):
+def _coarsen_power(power, slow_time_factor, travel_time_factor):
+    """
+    Decimate a dataset of power products (power_mean and power_max, both linear power) by
+    `slow_time_factor` along pulse_idx and `travel_time_factor` along travel_time.
+    Coordinates are averaged, and incomplete blocks at the end are padded (the NaN padding
+    is skipped by the reductions).
+    """
+    factors = {dim: f for dim, f in (('pulse_idx', slow_time_factor), ('travel_time', travel_time_factor)) if f > 1}
+    if len(factors) == 0:
+        return power
+    coarse = power.coarsen(factors, boundary='pad')
+    return xr.Dataset({
+        "power_mean": coarse.mean()["power_mean"],
+        "power_max": coarse.max()["power_max"]
+    })
+
+def _power_from_compressed(pulse_compressed):
+    # Linear power of each sample, as the finest level of power products
+    power = np.abs(pulse_compressed["radar_data"])**2
+    return xr.Dataset({"power_mean": power, "power_max": power}).astype(np.float32)
+
+def _pyramid_fingerprint(pulse_compressed):
+    """
+    Describe the dataset a pyramid is built from, so that a pyramid built from a different
+    dataset (or the same recording processed differently) isn't reused. JSON-compatible.
+    """
+    attrs = pulse_compressed.attrs
+    fingerprint = {
+        "basename": attrs.get("basename"),
+        "shape": [len(pulse_compressed["pulse_idx"]), len(pulse_compressed["travel_time"])],
+        "pulse_idx": [pulse_compressed["pulse_idx"].values[0], pulse_compressed["pulse_idx"].values[-1]],
+        "slow_time": [pulse_compressed["slow_time"].values[0], pulse_compressed["slow_time"].values[-1]],
+        "travel_time": [pulse_compressed["travel_time"].values[0], pulse_compressed["travel_time"].values[-1]],
+    }
+    for key in ("pulse_compress", "processing_pipeline", "phase_dithering_inversion", "errors_removed"):
+        fingerprint[key] = attrs.get(key)
+    # Round trip through JSON so it compares equal to the copy stored in the zarr attributes
+    return json.loads(json.dumps(fingerprint, default=lambda x: x.item() if hasattr(x, "item") else str(x)))
+
+def _pyramid_group(slow_time_level, travel_time_level):
+    return f"st{slow_time_level}_tt{travel_time_level}"
+
+def build_radargram_pyramid(pulse_compressed, pyramid_path, slow_time_factor=4, travel_time_factor=2, min_traces=256, min_samples=64, target_chunk_mb=16):
+    """
+    Precompute a pyramid of power products from `pulse_compressed` and save it as a zarr
+    store at `pyramid_path` (for example, next to the compressed dataset as "compressed.pyramid.zarr").
+
+    Level (i, j) of the pyramid is decimated by `slow_time_factor`**i in slow time and
+    `travel_time_factor`**j in travel time, for i >= 1 and j >= 0. Slow time levels are added
+    until fewer than `min_traces` traces would remain, and travel time levels until fewer
+    than `min_samples` samples would remain. Each level stores both the mean power
+    ("power_mean") and the maximum power ("power_max") of the samples it covers, as linear
+    power in float32.
+
+    The full resolution data is only read once: each level is computed from the previous
+    (already saved) level, so building the pyramid costs about as much as computing the
+    power of the dataset once. The pyramid needs about 2/3 of the storage of the complex data.
+
+    Returns `pyramid_path`. See `plot_radargram` for how the pyramid is used.
+    """
+    if os.path.exists(pyramid_path):
+        shutil.rmtree(pyramid_path)
+
+    n_traces = len(pulse_compressed["pulse_idx"])
+    n_samples = len(pulse_compressed["travel_time"])
+
+    def save_level(power, i, j):
+        # Uniform chunks of about target_chunk_mb, so that every level can be written to zarr
+        traces_per_chunk = max(1, int(target_chunk_mb * 2**20 / (4 * len(power["travel_time"]))))
+        power = power.drop_encoding().chunk({'pulse_idx': traces_per_chunk, 'travel_time': -1})
+        power.to_zarr(pyramid_path, group=_pyramid_group(i, j), mode='w')
+        return xr.open_zarr(pyramid_path, group=_pyramid_group(i, j))
+
+    levels = []
+    slow_time_base = _power_from_compressed(pulse_compressed)
+    i = 1
+    while (i == 1) or (n_traces / slow_time_factor**i >= min_traces):
+        slow_time_base = save_level(_coarsen_power(slow_time_base, slow_time_factor, 1), i, 0)
+        levels.append([i, 0, len(slow_time_base["pulse_idx"]), len(slow_time_base["travel_time"])])
+
+        power = slow_time_base
+        j = 1
+        while n_samples / travel_time_factor**j >= min_samples:
+            power = save_level(_coarsen_power(power, 1, travel_time_factor), i, j)
+            levels.append([i, j, len(power["pulse_idx"]), len(power["travel_time"])])
+            j += 1
+        i += 1
+
+    root = zarr.open_group(pyramid_path, mode='a')
+    root.attrs.update({
+        "slow_time_factor": slow_time_factor,
+        "travel_time_factor": travel_time_factor,
+        "levels": levels, # [slow time level, travel time level, traces, samples]
+        "source_shape": [n_traces, n_samples],
+        "basename": pulse_compressed.attrs.get("basename"),
+        "fingerprint": _pyramid_fingerprint(pulse_compressed)
+    })
+    return pyramid_path
+
+def _pyramid_matches(pyramid_path, pulse_compressed):
+    # Check that the pyramid at pyramid_path was built from this dataset (see _pyramid_fingerprint)
+    try:
+        fingerprint = zarr.open_group(pyramid_path, mode='r').attrs["fingerprint"]
+    except Exception:
+        return False
+    return fingerprint == _pyramid_fingerprint(pulse_compressed)
+
+def _choose_level(n, factor, target, max_level=None):
+    # Coarsest level with at least `target` points left (level 0 = full resolution)
+    level = 0
+    while (n / factor**(level+1) >= target) and ((max_level is None) or (level + 1 <= max_level)):
+        level += 1
+    return level
+
+def radargram_power(pulse_compressed, width_px, height_px, ylims=None, sig_speed=None, pyramid_path=None, reduction='mean'):
+    """
+    Return the power (in dB) of `pulse_compressed` at about the resolution needed to draw a
+    radargram `width_px` traces wide with `height_px` samples between `ylims` (in units of
+    the y axis, so distance if `sig_speed` is provided and travel time otherwise).
+
+    `reduction` ('mean' or 'max') chooses how samples are combined when decimating: the mean
+    power, or the maximum power, of the samples covered by each output sample.
+
+    If `pyramid_path` is provided (see `build_radargram_pyramid`), the coarsest level with
+    enough resolution is read from the pyramid and only the travel times inside `ylims` are
+    loaded. Otherwise, the same decimation is computed from `pulse_compressed` (which reads
+    the whole dataset, but never holds more than one chunk of it in memory at full resolution).
+
+    Returns an xarray DataArray with dimensions (pulse_idx, travel_time).
+    """
+    if reduction not in ('mean', 'max'):
+        raise ValueError(f"Unknown reduction '{reduction}'. Expected 'mean' or 'max'.")
+
+    def y_mask(travel_time):
+        if ylims is None:
+            return np.ones(len(travel_time), dtype=bool)
+        y = travel_time * (sig_speed / 2) if sig_speed else travel_time
+        # Keep one sample past each limit, so the edges of the plot aren't blank
+        inside = (y >= min(ylims)) & (y <= max(ylims))
+        mask = inside.copy()
+        mask[1:] |= inside[:-1]
+        mask[:-1] |= inside[1:]
+        return mask
+
+    n_traces = len(pulse_compressed["pulse_idx"])
+    n_samples_visible = max(1, int(np.sum(y_mask(pulse_compressed["travel_time"].values))))
+
+    if pyramid_path is not None:
+        attrs = zarr.open_group(pyramid_path, mode='r').attrs
+        levels = np.array(attrs["levels"])
+        slow_time_level = _choose_level(n_traces, attrs["slow_time_factor"], width_px, max_level=np.max(levels[:, 0]))
+        travel_time_level = _choose_level(n_samples_visible, attrs["travel_time_factor"], height_px, max_level=np.max(levels[:, 1]))
+        if slow_time_level > 0:
+            power = xr.open_zarr(pyramid_path, group=_pyramid_group(slow_time_level, travel_time_level))
+            power = power.isel(travel_time=y_mask(power["travel_time"].values))
+            return 10*np.log10(power[f"power_{reduction}"].compute())
+
+    # No pyramid (or the full resolution is needed): decimate the requested travel times directly
+    slow_time_factor = max(1, n_traces // width_px)
+    travel_time_factor = max(1, n_samples_visible // height_px)
+    power = _power_from_compressed(pulse_compressed.isel(travel_time=y_mask(pulse_compressed["travel_time"].values)))
+    power = _coarsen_power(power, slow_time_factor, travel_time_factor)
+    return 10*np.log10(power[f"power_{reduction}"].compute())
+
+def plot_radargram(pulse_compressed, figsize=None, vmin=-70, vmax=-40, ylims=(65,15), sig_speed=None, pyramid_path=None, reduction='mean', dpi=None):
+    """
+    Plot a radargram of `pulse_compressed` between `ylims`.
+
+    Only as many traces and samples as the figure can show are loaded (see `radargram_power`).
+    If `pyramid_path` is provided, power products are read from the pyramid stored there,
+    which is built with `build_radargram_pyramid` first if it doesn't exist yet (or doesn't
+    match `pulse_compressed`). With a pyramid, plotting takes about the same time regardless
+    of the length of the dataset.
+
+    `reduction` ('mean' or 'max') chooses how samples are combined when decimating. `dpi`
+    is the resolution used to work out how many pixels the figure has (defaults to matplotlib's
+    figure.dpi setting).
+    """
     duration_s = pulse_compressed.slow_time[-1] - pulse_compressed.slow_time[0]
 
     if figsize is None:
         figsize = (duration_s/10, 5)
-            
+    if dpi is None:
+        dpi = plt.rcParams['figure.dpi']
+
+    if (pyramid_path is not None) and (not _pyramid_matches(pyramid_path, pulse_compressed)):
+        if os.path.exists(pyramid_path):
+            print(f"[WARNING] Radargram pyramid at {pyramid_path} wasn't built from this dataset (or with this processing). Rebuilding it.")
+        build_radargram_pyramid(pulse_compressed, pyramid_path)
+
     fig, ax = plt.subplots(1,1, figsize=figsize)
 
-    return_power = 20*np.log10(np.abs(pulse_compressed["radar_data"].compute()))
+    return_power = radargram_power(pulse_compressed, int(float(figsize[0]) * dpi), int(float(figsize[1]) * dpi),
+                                   ylims=ylims, sig_speed=sig_speed, pyramid_path=pyramid_path, reduction=reduction)
 
     if sig_speed:
-        y_axis = pulse_compressed.travel_time * (sig_speed / 2)
+        y_axis = return_power.travel_time * (sig_speed / 2)
         y_axis_label = 'Distance to reflector [m]'
     else:
-        y_axis = pulse_compressed.travel_time
+        y_axis = return_power.travel_time
         y_axis_label = 'Two-way travel time [s]'
-    
-    p = ax.pcolormesh(pulse_compressed.slow_time, y_axis, return_power.T, cmap='inferno', vmin=vmin, vmax=vmax, shading='nearest')
+
+    p = ax.pcolormesh(return_power.slow_time, y_axis, return_power.T, cmap='inferno', vmin=vmin, vmax=vmax, shading='nearest')
     clb = fig.colorbar(p, ax=ax)
     clb.set_label('Power [dB]')
     ax.set_xlabel('Time [s]')
@@ -36,7 +226,7 @@ def plot_radargram(pulse_compressed, figsize=None, vmin=-70, vmax=-40, ylims=(65
                 ax.get_xticklabels() + ax.get_yticklabels() + clb.ax.get_yticklabels()):
         item.set_fontsize(18)
         item.set_fontfamily('sans-serif')
-        
+
     fig.tight_layout()
 
     return fig, ax
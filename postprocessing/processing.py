@@ -3,6 +3,8 @@ import scipy.signal
 import matplotlib.pyplot as plt
 import os
 import re
+import glob
+import json
 from ruamel.yaml import YAML as ym
 
 def load_config(prefix, modifications = {}):
@@ -26,7 +28,9 @@ def load_config(prefix, modifications = {}):
     return config
 
 def load_radar_data(prefix, load_start_seconds=0, max_seconds_to_load=60*100, max_chunk_size_samples=int(2e8), error_behavior=None, debug=False):
-    rx_samps = prefix + "_rx_samps.bin"
+    # Note: max_chunk_size_samples is no longer used (the data is memory mapped
+    # instead of being read in chunks) but is kept for compatibility.
+    rx_samps = rxSampsSource(prefix) # Single file or the parts of a multi-part recording
     log_file = prefix + "_uhd_stdout.log"
     
     config = load_config(prefix)
@@ -35,21 +39,17 @@ def load_radar_data(prefix, load_start_seconds=0, max_seconds_to_load=60*100, ma
     max_file_size_bytes = rx_len_samples*int(1/config['CHIRP']['pulse_rep_int'])*8*max_seconds_to_load
     load_start_bytes = rx_len_samples*int(1/config['CHIRP']['pulse_rep_int'])*8*load_start_seconds
 
-    file_size_bytes = os.path.getsize(rx_samps) - load_start_bytes
+    file_size_bytes = rxSampsSize(rx_samps) - load_start_bytes
     if file_size_bytes > max_file_size_bytes:
         print(f"WARNING: File is {file_size_bytes/(2**30):.2f} GB ({file_size_bytes / (rx_len_samples*int(1/config['CHIRP']['pulse_rep_int'])*2):.2f} seconds). Only loading the first {max_seconds_to_load} seconds.")
         file_size_bytes = max_file_size_bytes
 
-    rx_sig = np.zeros((file_size_bytes//8,), dtype=np.csingle)
-    for start_offset in np.arange(0, file_size_bytes, max_chunk_size_samples*8, dtype=np.int64):
-        if start_offset + max_chunk_size_samples*8 > file_size_bytes:
-            rx_sig[(start_offset//8):] = extractSig(rx_samps, count=(file_size_bytes-start_offset)//4, offset=load_start_bytes+start_offset)
-        else:
-            rx_sig[(start_offset//8):((start_offset//8)+(max_chunk_size_samples))] = extractSig(rx_samps, count=max_chunk_size_samples*2, offset=load_start_bytes+start_offset)
+    # Memory map (copy-on-write) only the requested part of the file
+    n_rxs = (file_size_bytes//8) // rx_len_samples
+    rx_sig = extractSig(rx_samps, count=n_rxs*rx_len_samples*2, offset=load_start_bytes)
 
     # Reshape data
     
-    n_rxs = len(rx_sig) // rx_len_samples
     rx_sig_reshaped = np.transpose(np.reshape(rx_sig, (n_rxs, rx_len_samples), order='C'))
 
     if debug:
@@ -62,6 +62,74 @@ def load_radar_data(prefix, load_start_seconds=0, max_seconds_to_load=60*100, ma
 
     # Extract log information about errors and start timestamp
 
+    errors, start_timestamp = errorsFromLog(log_file)
+
+    # Handle errors
+
+    rx_sig_reshaped, keep_mask = applyErrorBehavior(rx_sig_reshaped, np.arange(n_rxs), errors, error_behavior)
+    slow_time = slow_time[keep_mask]
+    n_rxs = len(slow_time)
+        
+    if debug:
+        print(f"n_rxs: {n_rxs}")
+        print(f"rx_sig_reshaped shape: {np.shape(rx_sig_reshaped)}")
+        print(f"Extracted start timestamp: {start_timestamp}")
+
+    return slow_time, config['GENERATE']['sample_rate'], rx_sig_reshaped
+
+# This function loads the pulses recorded in the time window [start_s, end_s)
+# (in seconds since the first pulse) without reading the rest of the file.
+# Multi-part recordings (without a merged rx_samps.bin) are also supported.
+# The window is converted to a range of pulses using the pulse repetition
+# interval and number of presums. For fc32 files, the data returned is a
+# (copy-on-write) memory map of the file, so nothing is read from disk until
+# it's used. sc16/sc8 files are converted to complex64, but only for the
+# requested window. Returns the slow time of each pulse (relative to the
+# first pulse in the file), the sample rate, and the data (sample_idx, pulse_idx).
+# -----
+# prefix         - the prefix of the data files (ending before "_rx_samps.bin")
+# start_s        - start of the time window (s)
+# end_s          - end of the time window (s), None to load to the end of the file
+# error_behavior - what to do with pulses with a reported error (see applyErrorBehavior)
+# config         - the config to use, if None it's loaded from prefix + "_config.yaml"
+def load_radar_window(prefix, start_s=0, end_s=None, error_behavior=None, config=None):
+    rx_samps = rxSampsSource(prefix)
+    if config is None:
+        config = load_config(prefix)
+    cpu_format = config['DEVICE'].get('cpu_format', 'fc32')
+    rx_len_samples = int(config['CHIRP']['rx_duration'] * config['GENERATE']['sample_rate'])
+    pulse_period = config['CHIRP']['pulse_rep_int'] * config['CHIRP']['num_presums']
+
+    dtype, _ = sample_format(cpu_format)
+    bytes_per_pulse = rx_len_samples * 2 * np.dtype(dtype).itemsize
+    n_pulses_in_file = rxSampsSize(rx_samps) // bytes_per_pulse
+
+    # (rounding avoids floating point error when times are exact multiples of pulse_period)
+    first_pulse = min(int(np.ceil(np.round(start_s / pulse_period, 6))), n_pulses_in_file)
+    end_pulse = n_pulses_in_file if end_s is None else min(max(int(np.ceil(np.round(end_s / pulse_period, 6))), first_pulse), n_pulses_in_file)
+    n_pulses = end_pulse - first_pulse
+
+    if n_pulses == 0:
+        rx_sig = np.zeros((0,), dtype=np.csingle)
+    else:
+        rx_sig = extractSig(rx_samps, count=n_pulses*rx_len_samples*2, offset=first_pulse*bytes_per_pulse, cpu_format=cpu_format)
+    rx_sig_reshaped = np.transpose(np.reshape(rx_sig, (n_pulses, rx_len_samples), order='C'))
+
+    pulse_idxs = np.arange(first_pulse, end_pulse)
+    slow_time = pulse_idxs * pulse_period
+
+    errors, _ = errorsFromLog(prefix + "_uhd_stdout.log")
+    rx_sig_reshaped, keep_mask = applyErrorBehavior(rx_sig_reshaped, pulse_idxs, errors, error_behavior)
+
+    return slow_time[keep_mask], config['GENERATE']['sample_rate'], rx_sig_reshaped
+
+# This function extracts the chirp indices and error codes of all receiver
+# errors in a log file, along with the start timestamp. Returns a tuple
+# (errors, start_timestamp) where errors is a dictionary mapping chirp index
+# to error code, or (None, None) if the log file doesn't exist.
+# -----
+# log_file - path to the uhd_stdout.log file
+def errorsFromLog(log_file):
     errors = None
     start_timestamp = None
 
@@ -89,45 +157,179 @@ def load_radar_data(prefix, load_start_seconds=0, max_seconds_to_load=60*100, ma
         print(f"WARNING: No log file found. This is fine, but checks for error codes will be disabled.")
         print(f"(Looking for a log file in: {log_file})")
 
-    # Handle errors
+    return errors, start_timestamp
 
-    # Choose what to do with chirps with a reported error (usually ERROR_CODE_LATE_COMMAND)
-    # Options are:
-    # None - do nothing
-    # 'zeros' - replace with zeros
-    # 'remove' - remove them from the rx_sig_reshaped array
+# This function handles pulses with a reported error (usually
+# ERROR_CODE_LATE_COMMAND). Returns the modified data and a boolean mask of
+# which of the input pulses were kept.
+# Options for error_behavior are:
+# None - do nothing
+# 'zeros' - replace with zeros
+# 'remove' - remove them from the data (this copies the remaining pulses)
+# -----
+# radar_data     - 2D array of samples (sample_idx, pulse_idx)
+# pulse_idxs     - the chirp index of each pulse in radar_data
+# errors         - dictionary mapping chirp index to error code (or None if there's no log)
+# error_behavior - None, 'zeros', or 'remove'
+def applyErrorBehavior(radar_data, pulse_idxs, errors, error_behavior):
+    keep_mask = np.ones(len(pulse_idxs), dtype=bool)
 
     if errors is None:
         if error_behavior is not None:
             print(f"WARNING: Requested doing something with errors but no log file was loaded. Defaulting to doing nothing.")
-    elif error_behavior == 'zeros':
-        error_idxs = np.array(list(errors.keys()))
-        rx_sig_reshaped[:,error_idxs] = 0
+        return radar_data, keep_mask
+
+    error_mask = np.isin(pulse_idxs, np.fromiter(errors.keys(), dtype=np.int64, count=len(errors)))
+    if error_behavior == 'zeros':
+        radar_data[:, error_mask] = 0
     elif error_behavior == 'remove':
-        error_idxs = np.array(list(errors.keys()))
-        all_idxs = np.arange(rx_sig_reshaped.shape[1])
-        keep_idxs = [x for x in all_idxs if x not in error_idxs]
+        keep_mask = ~error_mask
+        radar_data = radar_data[:, keep_mask]
 
-        rx_sig_reshaped = rx_sig_reshaped[:, keep_idxs]
-        n_rxs = len(keep_idxs)
+    return radar_data, keep_mask
 
-        slow_time = slow_time[keep_idxs]
-        
-    if debug:
-        print(f"n_rxs: {n_rxs}")
-        print(f"rx_sig_reshaped shape: {np.shape(rx_sig_reshaped)}")
-        print(f"Extracted start timestamp: {start_timestamp}")
+# This function returns the numpy dtype used to store each real and imaginary
+# value in a bin file recorded with the given cpu_format, along with the scale
+# factor that stored values must be divided by to get floating point samples.
+# -----
+# cpu_format - the CPU-side sample format ('fc32', 'sc16' or 'sc8')
+def sample_format(cpu_format):
+    if cpu_format == 'fc32':
+        return np.float32, 1.0
+    elif cpu_format == 'sc16':
+        return np.int16, np.iinfo(np.int16).max
+    elif cpu_format == 'sc8':
+        return np.int8, np.iinfo(np.int8).max
+    else:
+        raise Exception(f"Unrecognized cpu_format '{cpu_format}'. Must be one of 'fc32', 'sc16', or 'sc8'.")
 
-    return slow_time, config['GENERATE']['sample_rate'], rx_sig_reshaped
+# This function finds the partial files (<prefix>_p<N>_rx_samps.bin) that make
+# up a multi-part recording and returns their filenames in order. If save_data
+# wrote a manifest (<prefix>_rx_samps.manifest.json), the files listed there
+# are used. Raises a ValueError if no files are found or if file indices are
+# missing or duplicated.
+# -----
+# prefix - the prefix of the data files (ending before "_p<N>_rx_samps.bin")
+def findRxSampsParts(prefix):
+    manifest_filename = prefix + "_rx_samps.manifest.json"
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+        return [os.path.join(os.path.dirname(prefix), part) for part in manifest["parts"]]
+
+    file_ordering = {}
+    for filename in glob.glob(glob.escape(prefix) + '_p*_rx_samps.bin'):
+        filename_search = re.search(r'_p(\d+)_rx_samps.bin$', filename)
+        if filename_search:
+            file_idx = int(filename_search.group(1))
+            if file_idx in file_ordering:
+                raise ValueError(f"Duplicate file index {file_idx} found for prefix {prefix}")
+            file_ordering[file_idx] = filename
+
+    file_idxs = sorted(file_ordering.keys())
+    if len(file_idxs) == 0:
+        raise ValueError(f"No partial files found for prefix {prefix}")
+    if len(file_idxs) != file_idxs[-1] + 1:
+        raise ValueError(f"Missing file indices for prefix {prefix} (found {file_idxs})")
+
+    return [file_ordering[idx] for idx in file_idxs]
+
+# This class presents the ordered partial files of a multi-part recording as a
+# single logical file, without merging them. It can be passed to extractSig (and
+# everything that uses it) in place of a filename. Reads that fall within one
+# part are memory maps of that part, same as for a single file.
+# -----
+# filenames - the partial files, in order (see findRxSampsParts)
+class RxSampsParts():
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.sizes = np.array([os.path.getsize(f) for f in self.filenames], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.sizes)]) # Byte offset of the start of each part
+        self.size = int(self.offsets[-1])
+
+    def __repr__(self):
+        return f"RxSampsParts({self.filenames})"
+
+    def extract(self, count=-1, offset=0, cpu_format='fc32'):
+        itemsize = np.dtype(sample_format(cpu_format)[0]).itemsize
+        n_available = (self.size - offset) // itemsize
+        if (count < 0) or (count > n_available):
+            count = n_available
+        end = offset + (count // 2) * 2 * itemsize
+
+        pieces = []
+        for part_idx in np.flatnonzero((self.offsets[1:] > offset) & (self.offsets[:-1] < end)):
+            part_start = max(offset, self.offsets[part_idx])
+            part_end = min(end, self.offsets[part_idx+1])
+            if ((part_start - self.offsets[part_idx]) % (2 * itemsize)) != 0:
+                raise ValueError(f"Partial file {self.filenames[part_idx]} doesn't start on a sample boundary")
+            pieces.append(extractSig(self.filenames[part_idx], count=(part_end - part_start) // itemsize,
+                                     offset=int(part_start - self.offsets[part_idx]), cpu_format=cpu_format))
+
+        if len(pieces) == 0:
+            return np.zeros((0,), dtype=np.csingle)
+        if len(pieces) == 1:
+            return pieces[0]
+        return np.concatenate(pieces)
+
+# This function returns what to read the samples of a recording from: the
+# rx_samps.bin file if it exists, otherwise an RxSampsParts for the partial
+# files of a multi-part recording.
+# -----
+# prefix - the prefix of the data files (ending before "_rx_samps.bin")
+def rxSampsSource(prefix):
+    rx_samps = prefix + "_rx_samps.bin"
+    if os.path.exists(rx_samps):
+        return rx_samps
+    try:
+        return RxSampsParts(findRxSampsParts(prefix))
+    except ValueError:
+        return rx_samps # Let the caller fail to open it
+
+# This function returns the size in bytes of a bin file or RxSampsParts
+def rxSampsSize(filename):
+    if isinstance(filename, RxSampsParts):
+        return filename.size
+    return os.path.getsize(filename)
 
 # This function extracts the complex signal stored in a bin file.
 # The format of the bin file is <1st real><1st imag><2nd real><2nd imag>
-# The real and imaginary parts of the signal are of type np.float32
+# The real and imaginary parts of the signal are of type np.float32 (or
+# np.int16/np.int8 for sc16/sc8 files, which are scaled to the range [-1, 1]).
+# fc32 files are already laid out as complex64, so for those this returns a
+# (copy-on-write) memory map of the file and nothing is read until it's used.
+# sc16/sc8 files are converted max_block_samples at a time, so the only
+# full-size allocation is the complex64 output.
 # -----
-# filename - the name of the bin file to open
-def extractSig (filename, count=-1, offset=0):
-    sig_floats = np.fromfile(filename, dtype=np.float32, count=count, sep='', offset=offset)
-    return (sig_floats[::2] + (1j * sig_floats[1::2])).astype(np.csingle)
+# filename          - the name of the bin file to open (or an RxSampsParts)
+# count             - number of real values to read (2 per complex sample), -1 to read to the end
+# offset            - offset in bytes from the start of the file
+# cpu_format        - the CPU-side sample format the file was recorded with
+# max_block_samples - number of complex samples to convert at once (sc16/sc8 only)
+def extractSig (filename, count=-1, offset=0, cpu_format='fc32', max_block_samples=int(2**22)):
+    if isinstance(filename, RxSampsParts):
+        return filename.extract(count=count, offset=offset, cpu_format=cpu_format)
+
+    sample_dtype, scale_factor = sample_format(cpu_format)
+    n_available = (os.path.getsize(filename) - offset) // np.dtype(sample_dtype).itemsize
+    if (count < 0) or (count > n_available):
+        count = n_available
+    n_samples = count // 2
+
+    if n_samples <= 0:
+        return np.zeros((0,), dtype=np.csingle)
+
+    if cpu_format == 'fc32':
+        return np.memmap(filename, dtype=np.csingle, mode='c', offset=offset, shape=(n_samples,))
+
+    raw = np.memmap(filename, dtype=sample_dtype, mode='r', offset=offset, shape=(2*n_samples,))
+    sig = np.empty((n_samples,), dtype=np.csingle)
+    sig_floats = sig.view(np.float32)
+    for start in range(0, n_samples, max_block_samples):
+        end = min(start + max_block_samples, n_samples)
+        sig_floats[2*start:2*end] = raw[2*start:2*end]
+        sig[start:end] /= scale_factor
+    return sig
 
 # Load samples from a file safely
 # Maximum file size and chunk-by-chunk loading used to manage memory
@@ -142,32 +344,69 @@ def loadSamplesFromFile(filename, config, reshape=True, max_chunk_size=int(5e8),
         print(f"WARNING: File is {file_size_bytes/(2**30):.2f} GB ({file_size_bytes / (rx_len_samples*int(1/config['CHIRP']['pulse_rep_int'])*2):.2f} seconds). Only loading the first {max_seconds_to_load} seconds.")
         file_size_bytes = max_file_size_bytes
 
-    rx_sig = np.zeros((file_size_bytes//8,), dtype=np.csingle)
-    for start_offset in np.arange(0, file_size_bytes, max_chunk_size, dtype=np.int64):
-        if start_offset + max_chunk_size > file_size_bytes:
-            #print(f"{start_offset} (last) count: {file_size_bytes-start_offset}, offset: {load_start_bytes+start_offset}")
-            rx_sig[(start_offset//8):] = extractSig(filename, count=file_size_bytes-start_offset, offset=load_start_bytes+start_offset)
-        else:
-            #print(f"{max_chunk_size}, {start_offset}")
-            rx_sig[(start_offset//8):((start_offset//8)+(max_chunk_size//2))] = extractSig(filename, count=max_chunk_size, offset=load_start_bytes+start_offset)
+    # Memory map (copy-on-write) only the requested part of the file
+    # (max_chunk_size is no longer used but is kept for compatibility)
+    rx_sig = extractSig(filename, count=(file_size_bytes//8)*2, offset=load_start_bytes)
 
     # Reshape
     if reshape:
         n_rxs = len(rx_sig) // rx_len_samples
-        rx_sig = np.transpose(np.reshape(rx_sig, (n_rxs, rx_len_samples), order='C'))
+        rx_sig = np.transpose(np.reshape(rx_sig[:(n_rxs*rx_len_samples)], (n_rxs, rx_len_samples), order='C'))
 
 
     return rx_sig
 
+# This function stacks (averages) groups of n consecutive pulses (columns).
+# Any trailing pulses that don't make up a full group of n are dropped.
+# -----
+# radar_data - 2D array of samples (sample_idx, pulse_idx)
+# n          - number of pulses to average into each output pulse
 def stack(radar_data, n):
-    radar_data_stacked = np.zeros_like(radar_data, shape=(np.shape(radar_data)[0], np.shape(radar_data)[1]//n))
-    for out_idx, start_idx in enumerate(np.arange(0, np.shape(radar_data_stacked)[1]*n, n)):
-        radar_data_stacked[:,out_idx] = np.mean(radar_data[:,start_idx:(start_idx+n)], axis=1)
-    return radar_data_stacked
-
-def pulse_compress(radar_data, chirp, fs, upsampling=1, zero_sample_idx=0):
+    n_out = np.shape(radar_data)[1] // n
+    blocks = np.reshape(radar_data[:, :(n_out*n)], (np.shape(radar_data)[0], n_out, n))
+    return np.mean(blocks, axis=2).astype(radar_data.dtype, copy=False)
+
+# This function stacks pulses directly from a bin file, without loading the
+# whole file. It's a generator that yields stacked pulses as 2D arrays
+# (sample_idx, pulse_idx) of up to max_block_pulses // n pulses at a time.
+# Concatenating the blocks along axis 1 gives the same result as calling
+# stack on the full dataset. Trailing pulses that don't make up a full
+# group of n (including any incomplete pulse at the end of the file) are
+# dropped.
+# -----
+# filename         - the name of the bin file to read (or an RxSampsParts)
+# rx_len_samples   - number of samples in each pulse
+# n                - number of pulses to average into each output pulse
+# cpu_format       - the CPU-side sample format the file was recorded with
+# max_block_pulses - maximum number of raw pulses to hold in memory at once
+def stack_from_file(filename, rx_len_samples, n, cpu_format='fc32', max_block_pulses=int(2**14)):
+    dtype, _ = sample_format(cpu_format)
+    bytes_per_pulse = rx_len_samples * 2 * np.dtype(dtype).itemsize
+    n_out = (rxSampsSize(filename) // bytes_per_pulse) // n
+
+    out_per_block = max(1, max_block_pulses // n)
+    for out_start in range(0, n_out, out_per_block):
+        out_count = min(out_per_block, n_out - out_start)
+        sig = extractSig(filename, count=out_count*n*rx_len_samples*2, offset=out_start*n*bytes_per_pulse, cpu_format=cpu_format)
+        yield stack(np.transpose(np.reshape(sig, (out_count*n, rx_len_samples))), n)
+
+# This function pulse compresses (matched filters) each pulse (column) of
+# radar_data with the reference chirp. Pulses are processed max_block_pulses
+# at a time with one batched FFT convolution per block, which bounds the
+# memory used for intermediate results.
+# If upsampling > 1, the data and the chirp are both upsampled in the
+# frequency domain (by zero-padding their spectra) before correlation.
+# Returns the fast time of each output sample and the compressed data.
+# -----
+# radar_data       - 2D array of samples (sample_idx, pulse_idx) or a single 1D trace
+# chirp            - the reference chirp
+# fs               - the sampling rate of radar_data and chirp (s/s)
+# upsampling       - integer upsampling factor
+# zero_sample_idx  - sample index (before upsampling) that corresponds to zero fast time
+# max_block_pulses - number of pulses to compress at once
+def pulse_compress(radar_data, chirp, fs, upsampling=1, zero_sample_idx=0, max_block_pulses=1024):
     if upsampling > 1:
-        corr_sig = scipy.signal.resample_poly(corr_sig, upsampling, 1)
+        corr_sig = scipy.signal.resample(chirp, len(chirp)*upsampling)
     else:
         corr_sig = chirp
 
@@ -179,12 +418,15 @@ def pulse_compress(radar_data, chirp, fs, upsampling=1, zero_sample_idx=0):
     fast_time = np.linspace(0, np.shape(xcorr_results)[0]/(fs*upsampling), np.shape(xcorr_results)[0])
     fast_time = fast_time - fast_time[zero_sample_idx*upsampling]
 
-    for res_idx in range(np.shape(xcorr_results)[1]):
-        stacked = radar_data[:, res_idx]
+    # Correlation with corr_sig is convolution with its time-reversed conjugate
+    matched_filter = np.conj(corr_sig[::-1])[:, np.newaxis] / np.sum(np.abs(corr_sig)**2)
+
+    for start_idx in range(0, np.shape(xcorr_results)[1], max_block_pulses):
+        block = radar_data[:, start_idx:(start_idx+max_block_pulses)]
         if upsampling > 1:
-            stacked = scipy.signal.resample_poly(stacked, upsampling, 1)
+            block = scipy.signal.resample(block, np.shape(radar_data)[0]*upsampling, axis=0)
 
-        xcorr_results[:, res_idx] = scipy.signal.correlate(stacked, corr_sig, mode='valid', method='auto') / np.sum(np.abs(corr_sig)**2)
+        xcorr_results[:, start_idx:(start_idx+max_block_pulses)] = scipy.signal.fftconvolve(block, matched_filter, mode='valid', axes=0)
      
     return fast_time, xcorr_results
 
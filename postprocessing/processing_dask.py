@@ -1,14 +1,183 @@
 import os
 import re
+import warnings
 
 import xarray as xr
 import dask.array as da
 import dask
+import zarr
 
 import numpy as np
 import scipy.signal
+import scipy.fft
+import numcodecs
+import numcodecs.abc
+import numcodecs.compat
 
 import processing as old_processing
+from chirp_cache import chirp_cache
+from phase_codes import phase_code_source
+
+class ComplexIntegerCodec(numcodecs.abc.Codec):
+    """
+    Zarr filter that stores complex64 samples as interleaved integer I/Q pairs of type `dtype`.
+    Values are multiplied by `scale_factor` (and rounded) on write and divided by it on read.
+
+    This is used to store sc16/sc8 recordings in their native integer size while still
+    presenting the data as complex64 when the zarr store is opened. Data that originally came
+    from a file with the same integer format round-trips exactly.
+
+    Note that this module must be imported (which registers the codec with numcodecs) before
+    opening a zarr store written with this filter.
+    """
+    codec_id = 'uhd_radar_complex_int'
+
+    def __init__(self, dtype, scale_factor):
+        self.dtype = np.dtype(dtype).str
+        self.scale_factor = float(scale_factor)
+
+    def encode(self, buf):
+        floats = numcodecs.compat.ensure_contiguous_ndarray(buf).view(np.float32) * np.float32(self.scale_factor)
+        limits = np.iinfo(self.dtype)
+        return np.clip(np.around(floats), limits.min, limits.max).astype(self.dtype)
+
+    def decode(self, buf, out=None):
+        enc = numcodecs.compat.ensure_contiguous_ndarray(buf).view(self.dtype)
+        dec = np.empty((enc.size // 2,), dtype=np.complex64)
+        dec.view(np.float32)[:] = enc
+        dec /= self.scale_factor
+        return numcodecs.compat.ndarray_copy(dec, out)
+
+numcodecs.register_codec(ComplexIntegerCodec)
+
+def _radar_data_encoding(cpu_format, native_storage=False, compressor='default'):
+    """
+    Build the zarr encoding for the radar_data variable.
+
+    If `native_storage` is True and `cpu_format` is an integer format (sc16 or sc8), samples are
+    stored as integer I/Q pairs using `ComplexIntegerCodec`. `compressor` is passed on to zarr
+    (for example `numcodecs.Blosc(cname='zstd', clevel=5, shuffle=numcodecs.Blosc.BITSHUFFLE)`).
+    By default, zarr's default compressor is used.
+    """
+    encoding = {}
+    if native_storage and (cpu_format != 'fc32'):
+        sample_dtype, scale_factor = old_processing.sample_format(cpu_format)
+        encoding['filters'] = [ComplexIntegerCodec(sample_dtype, scale_factor)]
+    if compressor != 'default':
+        encoding['compressor'] = compressor
+    return encoding
+
+# Precompiled patterns for index_stdout_log. Each one starts with a literal string, which lets
+# the regex engine skip quickly through the (mostly irrelevant) lines of long logs.
+_LOG_ERROR_PATTERN = re.compile(r"\(Chirp (\d+)\) Receiver error: ([\w_]+)")
+_LOG_OLD_STYLE_ERROR_PATTERN = re.compile(r"Scheduling chirp (\d+)[^\n]*\n[^\n]*?Receiver error: ([\w_]+)") # Chirp index on the previous line
+_LOG_TIME_OFFSET_PATTERN = re.compile(r"\(Chirp (\d+)\) time_offset increased by ([-+\d.eE]+)")
+_LOG_NUM_PULSES_ATTEMPTED_PATTERN = re.compile(r"Total pulses attempted: (\d+)")
+_LOG_TIMESTAMP_PATTERN = re.compile(r"\[(\d+\.\d+)")
+
+def index_stdout_log(log):
+    """
+    Parse the UHD radar code stdout log into NumPy arrays.
+
+    Returns a dictionary with:
+    "start_timestamp" -- timestamp of the [START] line (or None)
+    "num_pulses_attempted" -- from the "Total pulses attempted" line (or None)
+    "error_chirp_idx", "error_code" -- arrays of the chirp indices and error codes of every
+        reported receiver error
+    "time_offset_chirp_idx", "time_offset_increase" -- arrays of the chirp indices at which
+        the transmit code increased time_offset (after an error) and by how much (in seconds)
+
+    Each type of line is extracted with a single scan of the whole log, rather than running
+    several regexes on every line.
+    """
+    if log is None:
+        log = ""
+
+    errors = _LOG_ERROR_PATTERN.findall(log) + _LOG_OLD_STYLE_ERROR_PATTERN.findall(log)
+    time_offsets = _LOG_TIME_OFFSET_PATTERN.findall(log)
+
+    num_pulses_attempted = _LOG_NUM_PULSES_ATTEMPTED_PATTERN.findall(log)
+    num_pulses_attempted = int(num_pulses_attempted[-1]) if num_pulses_attempted else None
+
+    start_timestamp = None
+    start_pos = max(log.rfind("[START]"), log.rfind("Scheduling chirp 0 RX"))
+    if start_pos >= 0:
+        timestamp_search = _LOG_TIMESTAMP_PATTERN.search(log, log.rfind("\n", 0, start_pos) + 1, start_pos)
+        if timestamp_search is not None:
+            start_timestamp = float(timestamp_search.groups()[0])
+
+    return {
+        "start_timestamp": start_timestamp,
+        "num_pulses_attempted": num_pulses_attempted,
+        "error_chirp_idx": np.array([int(idx) for idx, _ in errors], dtype=np.int64),
+        "error_code": np.array([code for _, code in errors], dtype=str),
+        "time_offset_chirp_idx": np.array([int(idx) for idx, _ in time_offsets], dtype=np.int64),
+        "time_offset_increase": np.array([float(increase) for _, increase in time_offsets], dtype=np.float64),
+    }
+
+def _stdout_log_coords(log_index):
+    """
+    Coordinates used to store the output of `index_stdout_log` alongside the radar data
+    """
+    return {
+        "error_chirp_idx": ("error", log_index["error_chirp_idx"], {"description": "Index of each chirp with a reported receiver error"}),
+        "error_code": ("error", log_index["error_code"], {"description": "Receiver error code reported for this chirp"}),
+        "time_offset_chirp_idx": ("time_offset_change", log_index["time_offset_chirp_idx"], {"description": "Index of each chirp at which the TX time_offset was increased"}),
+        "time_offset_increase": ("time_offset_change", log_index["time_offset_increase"], {"description": "Increase in TX time_offset in seconds"}),
+    }
+
+def add_stdout_log_to_zarr(zarr_path, log):
+    """
+    Add a stdout log (as the stdout_log attribute) and its index (see `index_stdout_log`) to an
+    existing zarr store, in the same way that `save_radar_data_to_zarr` stores them.
+    Used for zarr stores that were built before the log was complete.
+    """
+    log_index = index_stdout_log(log)
+
+    # Appending replaces the attributes of the whole group, so keep the existing attributes
+    # (i.e. config) and merge the new ones in afterwards
+    attrs = zarr.open_group(zarr_path, mode='r').attrs.asdict()
+    xr.Dataset(coords=_stdout_log_coords(log_index)).to_zarr(zarr_path, mode="a")
+
+    group = zarr.open_group(zarr_path, mode='r+')
+    coordinates = attrs.get("coordinates", "").split() + group.attrs.get("coordinates", "").split()
+    attrs.update({
+        "coordinates": " ".join(dict.fromkeys(coordinates)), # Variables xarray should open as coordinates
+        "stdout_log": log,
+        "start_timestamp": log_index["start_timestamp"],
+        "num_pulses_attempted": log_index["num_pulses_attempted"]
+    })
+    group.attrs.update(attrs)
+    if ".zmetadata" in os.listdir(zarr_path):
+        zarr.consolidate_metadata(zarr_path)
+
+def stdout_log_index(data):
+    """
+    Return the stdout log index (see `index_stdout_log`) for a dataset.
+
+    Datasets created by `save_radar_data_to_zarr` store the index as coordinates (error_chirp_idx,
+    error_code, time_offset_chirp_idx and time_offset_increase) and attributes (start_timestamp,
+    num_pulses_attempted), so this is just a lookup. For older datasets, the stdout_log attribute
+    is parsed instead.
+    """
+    if "error_chirp_idx" in data.coords:
+        return {
+            "start_timestamp": data.attrs.get("start_timestamp"),
+            "num_pulses_attempted": data.attrs.get("num_pulses_attempted"),
+            "error_chirp_idx": data["error_chirp_idx"].values,
+            "error_code": data["error_code"].values,
+            "time_offset_chirp_idx": data["time_offset_chirp_idx"].values,
+            "time_offset_increase": data["time_offset_increase"].values,
+        }
+    return index_stdout_log(data.attrs.get("stdout_log"))
+
+def _errors_dict(log_index):
+    errors = dict(zip(log_index["error_chirp_idx"].tolist(), log_index["error_code"].tolist()))
+    for chirp_idx, error_code in errors.items():
+        if error_code != "ERROR_CODE_LATE_COMMAND":
+            print(
+                f"WARNING: Uncommon error in the log: {error_code} (on chirp {chirp_idx})")
+    return errors
 
 def process_stdout_log(log):
     """
@@ -16,42 +185,86 @@ def process_stdout_log(log):
     Returns the starting timestamp the number of pulses attempted and a dictionary of errors, where the keys are
     chirp indices and the values are error codes.
     """
-    errors = {}
-    start_timestamp = None
-    num_pulses_attempted = None
-
-    for idx, line in enumerate(log.splitlines()):
-        if "Receiver error:" in line:
-            error_code = re.search(
-                r"(?:Receiver error: )([\w_]+)", line).groups()[0]
-            old_style_regex_search = re.search(
-                r"(?:Scheduling chirp )([\d]+)", log[idx-1])
-            if old_style_regex_search is not None:
-                chirp_idx = int(
-                    re.search(r"(?:Scheduling chirp )([\d]+)", log[idx-1]).groups()[0])
-            else:
-                chirp_idx = int(
-                    re.search(r"(?:Chirp )([\d]+)", line).groups()[0])
-            errors[chirp_idx] = error_code
-            if error_code != "ERROR_CODE_LATE_COMMAND":
-                print(
-                    f"WARNING: Uncommon error in the log: {error_code} (on chirp {chirp_idx})")
-                print(f"Full message: {line}")
-        if ("[START]" in line) or ("Scheduling chirp 0 RX" in line):
-            start_timestamp = float(
-                re.search(r"(?:\[)([\d]+\.[\d]+)", line).groups()[0])
-        if ("Total pulses attempted" in line): 
-            num_pulses_attempted = int(re.search(r": ([\d]+)", line).groups()[0])
+    log_index = index_stdout_log(log)
+    return log_index["start_timestamp"], _errors_dict(log_index), log_index["num_pulses_attempted"]
 
-    return start_timestamp, errors, num_pulses_attempted
 
+def _load_rx_pulses(rx_samps_file, cpu_format, rx_len_samples, first_pulse, n_pulses):
+    """
+    Read `n_pulses` whole pulses, starting at pulse `first_pulse`, from a raw interleaved I/Q
+    file and return them as a complex64 array of shape (rx_len_samples, n_pulses).
 
-def save_radar_data_to_zarr(prefix, skip_if_cached=True, zarr_base_location=None, expected_base_name_regex=r'\d{8}_\d{6}', log_required=True, dryrun=False):
+    For fc32 files, this is a view of a memory map of the file. sc16/sc8 files are converted
+    to complex64 without any full-size intermediate arrays.
+
+    This only receives a filename (not an open memmap), so it is cheap to send to worker
+    threads or processes.
+    """
+    sample_dtype, _ = old_processing.sample_format(cpu_format)
+    sig = old_processing.extractSig(rx_samps_file, count=n_pulses * rx_len_samples * 2,
+                                    offset=first_pulse * rx_len_samples * 2 * np.dtype(sample_dtype).itemsize,
+                                    cpu_format=cpu_format)
+    return np.transpose(np.reshape(sig, (n_pulses, rx_len_samples)))
+
+
+def choose_pulses_per_chunk(rx_len_samples, config=None, target_chunk_mb=None, stack_factors=None):
+    """
+    Choose how many pulses to put in each chunk of a radar dataset with `rx_len_samples`
+    complex64 samples per pulse.
+
+    Chunks always contain whole pulses. The number of pulses per chunk is the largest multiple
+    of every stack factor in `stack_factors` (i.e. of their least common multiple) that keeps
+    each chunk at or below `target_chunk_mb` megabytes, or exactly that multiple if a single
+    multiple is already bigger than the target. Aligning to stack factors means that
+    `stack` never has to combine pulses from different chunks. (Since the radar code writes
+    one pulse per num_presums received pulses, every chunk is also always a whole number of
+    presums.)
+
+    `target_chunk_mb` and `stack_factors` default to the `chunk_size_mb` and
+    `chunk_stack_factors` values in the POSTPROCESSING section of `config` (if provided), and
+    otherwise to 64 MB and [1].
+    """
+    postprocessing_config = (config or {}).get('POSTPROCESSING') or {}
+    if target_chunk_mb is None:
+        target_chunk_mb = postprocessing_config.get('chunk_size_mb', 64)
+    if stack_factors is None:
+        stack_factors = postprocessing_config.get('chunk_stack_factors', [1])
+
+    pulse_multiple = int(np.lcm.reduce([int(n) for n in stack_factors])) if len(stack_factors) > 0 else 1
+    pulse_bytes = rx_len_samples * np.dtype(np.complex64).itemsize
+    n_pulses = int((target_chunk_mb * 2**20) // pulse_bytes)
+    return max(pulse_multiple, (n_pulses // pulse_multiple) * pulse_multiple)
+
+
+def _rx_samps_to_dask(rx_samps_file, cpu_format, rx_len_samples, pulses_per_chunk):
+    """
+    Lazily load a raw rx_samps file as a dask array of shape (rx_len_samples, n_pulses).
+    Any trailing partial pulse at the end of the file is ignored.
+
+    Each dask chunk is a block of `pulses_per_chunk` whole pulses read directly from the file
+    by the task that needs it, so chunks can be read (and written to zarr) independently of
+    each other.
+    """
+    sample_dtype, _ = old_processing.sample_format(cpu_format)
+    n_rxs = (old_processing.rxSampsSize(rx_samps_file) // np.dtype(sample_dtype).itemsize) // (2 * rx_len_samples)
+    if n_rxs == 0:
+        return da.zeros((rx_len_samples, 0), dtype=np.complex64)
+    return da.concatenate([
+        da.from_delayed(
+            dask.delayed(_load_rx_pulses)(rx_samps_file, cpu_format, rx_len_samples, first_pulse, min(pulses_per_chunk, n_rxs - first_pulse)),
+            shape=(rx_len_samples, min(pulses_per_chunk, n_rxs - first_pulse)), dtype=np.complex64)
+        for first_pulse in range(0, n_rxs, pulses_per_chunk)
+    ], axis=1)
+
+
+def save_radar_data_to_zarr(prefix, skip_if_cached=True, zarr_base_location=None, expected_base_name_regex=r'\d{8}_\d{6}', log_required=True, dryrun=False, num_workers=1, parallel_scheduler='threads', native_storage=False, compressor='default', target_chunk_mb=None, stack_factors=None):
     """
     Load raw radar data from a given prefix, and save it to a zarr file.
     
     `prefix` is the path to the raw data, without the _rx_samps.bin/_config.yaml/_uhd_stdout.log suffixes.
     (`log_required` can be set to False if no log file is available)
+    If there's no _rx_samps.bin file, the partial files of a multi-part recording
+    (_p0_rx_samps.bin, _p1_rx_samps.bin, ...) are read in order instead, without merging them.
 
     As a safety precaution, this function will check that the prefix basename matches the `expected_base_name_regex` expression.
     If using the python code to run the radar system, the prefixes will be of the form YYYYMMDD_HHMMSS,
@@ -65,6 +278,22 @@ def save_radar_data_to_zarr(prefix, skip_if_cached=True, zarr_base_location=None
 
     Setting `dryrun` to True will cause this function to return the path to the zarr file
     that it would have created without actually writing anything to disk.
+
+    By default, the data is written using a single thread. Setting `num_workers` to a value
+    greater than 1 writes pulse-aligned regions of the zarr store concurrently, using either
+    threads or processes (`parallel_scheduler` = 'threads' or 'processes'). Each region is
+    read directly from the raw file by the worker that writes it and every region maps to
+    exactly one zarr chunk, so the output is byte-identical to the single-threaded path.
+
+    For sc16 and sc8 recordings, setting `native_storage` to True stores the samples as integer
+    I/Q pairs (with the scale factor in the zarr metadata) instead of complex64, which makes the
+    zarr store 2x (sc16) or 4x (sc8) smaller before compression. The data is still loaded
+    as complex64 (see `ComplexIntegerCodec`). `compressor` can be used to choose a different zarr
+    compressor than the default.
+
+    The data is chunked along pulse_idx only, with the number of pulses per chunk chosen by
+    `choose_pulses_per_chunk` from `target_chunk_mb` and `stack_factors` (or the
+    POSTPROCESSING section of the config file).
     
     Returns the path to the zarr file only. You are responsible for re-loading the data from the zarr file.
     """
@@ -89,7 +318,7 @@ def save_radar_data_to_zarr(prefix, skip_if_cached=True, zarr_base_location=None
         return zarr_path
 
     # Build filenames from prefix
-    rx_samps_file = prefix + "_rx_samps.bin"
+    rx_samps_file = old_processing.rxSampsSource(prefix) # Single file or the parts of a multi-part recording
     log_file = prefix + "_uhd_stdout.log"
 
     #
@@ -99,27 +328,13 @@ def save_radar_data_to_zarr(prefix, skip_if_cached=True, zarr_base_location=None
     config = old_processing.load_config(prefix)
 
     cpu_format = config['DEVICE'].get('cpu_format', 'fc32')
-    if cpu_format == 'fc32':
-        output_dtype = np.float32
-        scale_factor = 1.0
-    elif cpu_format == 'sc16':
-        output_dtype = np.int16
-        scale_factor = np.iinfo(output_dtype).max
-    elif cpu_format == 'sc8':
-        output_dtype = np.int8
-        scale_factor = np.iinfo(output_dtype).max
-    else:
-        raise Exception(f"Unrecognized cpu_format '{cpu_format}'. Must be one of 'fc32', 'sc16', or 'sc8'.")
 
     # Load raw RX samples
     rx_len_samples = int(config['CHIRP']['rx_duration']
                          * config['GENERATE']['sample_rate'])
-    rx_sig = da.from_array(
-        np.memmap(rx_samps_file, dtype=output_dtype, mode='r', order='C'), chunks=rx_len_samples*2*100)
-    rx_sig = (rx_sig[::2] + (1j * rx_sig[1::2])).astype(np.complex64) / scale_factor
-    n_rxs = rx_sig.size // rx_len_samples
-    radar_data = da.transpose(da.reshape(
-        rx_sig, (n_rxs, rx_len_samples), merge_chunks=True))
+    pulses_per_chunk = choose_pulses_per_chunk(rx_len_samples, config, target_chunk_mb, stack_factors)
+    radar_data = _rx_samps_to_dask(rx_samps_file, cpu_format, rx_len_samples, pulses_per_chunk)
+    n_rxs = radar_data.shape[1]
 
     # Create time axes
     slow_time = np.linspace(0, config['CHIRP']['pulse_rep_int']
@@ -136,6 +351,7 @@ def save_radar_data_to_zarr(prefix, skip_if_cached=True, zarr_base_location=None
         if log_required:
             raise FileNotFoundError(
                 f"Log file not found: {log_file}. If a log file is not required, set log_required=False")
+    log_index = index_stdout_log(log)
 
     # Save radar_data, slow_time, and fs to an xarray datarray
     data = xr.Dataset(
@@ -147,27 +363,94 @@ def save_radar_data_to_zarr(prefix, skip_if_cached=True, zarr_base_location=None
             "fast_time": ("sample_idx", fast_time, {"description": "time relative to start of this recording interval in seconds"}),
             "pulse_idx": ("pulse_idx", np.arange(radar_data.shape[1]), {"description": "Index of this chirp in the sequence"}),
             "slow_time": ("pulse_idx", slow_time, {"description": "time in seconds"}),
+            **_stdout_log_coords(log_index)
         },
         attrs={
             "config": config,
             "stdout_log": log,
             "prefix": prefix,
-            "basename": basename
+            "basename": basename,
+            "start_timestamp": log_index["start_timestamp"],
+            "num_pulses_attempted": log_index["num_pulses_attempted"]
         }
     )
 
     # TODO: Due to the currently hard-coded increase in pulse repetition interval after an error,
     # the slow time may not be correct.
 
+    encoding = {"radar_data": _radar_data_encoding(cpu_format, native_storage, compressor)}
+
     if not dryrun:
-        with dask.config.set(scheduler='single-threaded'):
-            data.to_zarr(zarr_path, mode="w")
+        if num_workers > 1:
+            if parallel_scheduler not in ('threads', 'processes'):
+                raise ValueError(f"Unrecognized parallel_scheduler '{parallel_scheduler}'. Must be one of 'threads' or 'processes'.")
+            with dask.config.set(scheduler=parallel_scheduler, num_workers=num_workers):
+                data.to_zarr(zarr_path, mode="w", encoding=encoding)
+        else:
+            with dask.config.set(scheduler='single-threaded'):
+                data.to_zarr(zarr_path, mode="w", encoding=encoding)
     else:
         print("This is a dry run: not saving data to disk")
         print(data)
 
     return zarr_path
 
+def append_radar_data_to_zarr(rx_samps_file, zarr_path, config, first_pulse_idx=0, attrs={}, native_storage=False, compressor='default'):
+    """
+    Append all of the pulses in a single raw rx_samps file (typically one of the partial
+    rx_samps.bin.N files written while the radar is running) to a zarr store at `zarr_path`.
+
+    If `first_pulse_idx` is 0, a new zarr store is created (overwriting anything already at
+    `zarr_path`). Otherwise, the pulses are appended along the pulse_idx dimension of the
+    existing store and numbered starting from `first_pulse_idx`.
+
+    The layout of the store is the same as the one produced by `save_radar_data_to_zarr`,
+    except that slow_time is calculated as pulse_idx * pulse_rep_int * num_presums, since the
+    total number of pulses isn't known in advance. `attrs` are added to (or updated in) the
+    dataset attributes. `native_storage` and `compressor` are used when creating the store and
+    behave the same way as in `save_radar_data_to_zarr`. Chunk sizes are chosen from the
+    POSTPROCESSING section of the config (see `choose_pulses_per_chunk`).
+
+    Returns the number of pulses appended.
+    """
+
+    cpu_format = config['DEVICE'].get('cpu_format', 'fc32')
+    rx_len_samples = int(config['CHIRP']['rx_duration']
+                         * config['GENERATE']['sample_rate'])
+    radar_data = _rx_samps_to_dask(rx_samps_file, cpu_format, rx_len_samples,
+                                   choose_pulses_per_chunk(rx_len_samples, config))
+    n_rxs = radar_data.shape[1]
+    if n_rxs == 0:
+        return 0
+
+    pulse_idx = first_pulse_idx + np.arange(n_rxs)
+    slow_time = pulse_idx * config['CHIRP']['pulse_rep_int'] * config['CHIRP'].get('num_presums', 1)
+
+    data = xr.Dataset(
+        data_vars={
+            "radar_data": (["sample_idx", "pulse_idx"], radar_data, {"description": "complex radar data"}),
+        },
+        coords={
+            "sample_idx": ("sample_idx", np.arange(rx_len_samples), {"description": "Index of this sample in the chirp"}),
+            "fast_time": ("sample_idx", np.linspace(0, config['CHIRP']['rx_duration'], rx_len_samples), {"description": "time relative to start of this recording interval in seconds"}),
+            "pulse_idx": ("pulse_idx", pulse_idx, {"description": "Index of this chirp in the sequence"}),
+            "slow_time": ("pulse_idx", slow_time, {"description": "time in seconds"}),
+        },
+        attrs={
+            "config": config,
+            **attrs
+        }
+    )
+
+    # Appends are done serially from a single thread, so it's safe to write partial zarr chunks
+    with dask.config.set(scheduler='single-threaded'):
+        if first_pulse_idx == 0:
+            data.to_zarr(zarr_path, mode="w", encoding={"radar_data": _radar_data_encoding(cpu_format, native_storage, compressor)})
+        else:
+            data.drop_vars(["sample_idx", "fast_time"]).to_zarr(zarr_path, append_dim="pulse_idx", safe_chunks=False)
+
+    return n_rxs
+
 def check_if_error_data_exists(data, errors=None, num_pulses_attempted=-1):
     """
 
@@ -186,7 +469,7 @@ def check_if_error_data_exists(data, errors=None, num_pulses_attempted=-1):
     Input variables:
         data Xarray dataset, some format as everything else
         errors Optional, if a dictionary of errors is already available from process_stdout_log,
-            you can provide it here to avoid calling that function twice.
+            you can provide it here (along with num_pulses_attempted) to avoid looking them up twice.
 
     There are four possible return values, returned as strings (sorry...)
 
@@ -206,8 +489,9 @@ def check_if_error_data_exists(data, errors=None, num_pulses_attempted=-1):
     pulses_requested = data.attrs['config']['CHIRP']['num_pulses']
     pulses_in_data = len(data.pulse_idx) * data.attrs['config']['CHIRP']['num_presums']
     
-    if not errors:
-        _, errors, num_pulses_attempted = process_stdout_log(data.attrs["stdout_log"])
+    if errors is None:
+        log_index = stdout_log_index(data)
+        errors, num_pulses_attempted = _errors_dict(log_index), log_index["num_pulses_attempted"]
     
     n_errors = len(errors)
 
@@ -220,12 +504,13 @@ def check_if_error_data_exists(data, errors=None, num_pulses_attempted=-1):
     else:
         return "unexpected_data_length"
 
-def fill_errors(data, error_fill_value=np.nan, allowed_file_error_types=[], force_file_error_type=None):
+def _error_handling_applies(data, log_index, allowed_file_error_types=[], force_file_error_type=None):
     """
-    Replace all values from chirps with a reported error with the specified error_fill_value
+    Shared check for fill_errors, remove_errors, and ProcessingPipeline: returns True if the
+    data includes the pulses with errors (so there's something to fill or remove), or if the
+    file error type is explicitly allowed.
     """
-
-    _, errors, num_pulses_attempted = process_stdout_log(data.attrs["stdout_log"])
+    errors, num_pulses_attempted = _errors_dict(log_index), log_index["num_pulses_attempted"]
     file_error_type = check_if_error_data_exists(data, errors, num_pulses_attempted)
 
     if force_file_error_type != None: # force the file error type if we want control over error handling behavior
@@ -237,10 +522,21 @@ def fill_errors(data, error_fill_value=np.nan, allowed_file_error_types=[], forc
                   "explicitly allowed by allowed_file_error_types so proceeding without additional checks. This may have unexpected behaviors!")
         else:
             print(f"[WARNING] File error type is {file_error_type} so there's nothing for this function to do. Returning a copy of your unmodified dataset.")
-            return data.copy()
+            return False
+
+    return True
+
+def fill_errors(data, error_fill_value=np.nan, allowed_file_error_types=[], force_file_error_type=None):
+    """
+    Replace all values from chirps with a reported error with the specified error_fill_value
+    """
+
+    log_index = stdout_log_index(data)
+    if not _error_handling_applies(data, log_index, allowed_file_error_types, force_file_error_type):
+        return data.copy()
 
     result = data.copy()
-    error_idxs = np.array(list(errors.keys()))
+    error_idxs = log_index["error_chirp_idx"]
 
     # only fill errors if they exist, otherwise avoid throwing an index error
     if error_idxs.size != 0:
@@ -253,19 +549,9 @@ def remove_errors(data, skip_if_already_complete=True, allowed_file_error_types=
     Remove received data associated with chrips with a reported error
     """
 
-    _, errors, num_pulses_attempted = process_stdout_log(data.attrs["stdout_log"])
-    file_error_type = check_if_error_data_exists(data, errors)
-
-    if force_file_error_type != None: # force the file error type if we want control over error handling behavior
-        file_error_type = force_file_error_type
-
-    if file_error_type != "error_data_included":
-        if (file_error_type in allowed_file_error_types):
-            print(f"[WARNING] Unexpected file error type of {file_error_type} but " +
-                  "explicitly allowed by allowed_file_error_types so proceeding without additional checks. This may have unexpected behaviors!")
-        else:
-            print(f"[WARNING] File error type is {file_error_type} so there's nothing for this function to do. Returning a copy of your unmodified dataset.")
-            return data.copy()
+    log_index = stdout_log_index(data)
+    if not _error_handling_applies(data, log_index, allowed_file_error_types, force_file_error_type):
+        return data.copy()
 
     if "errors_removed" in data.attrs:
         if skip_if_already_complete:
@@ -275,7 +561,7 @@ def remove_errors(data, skip_if_already_complete=True, allowed_file_error_types=
             raise ValueError("Errors have already been removed from this data")
 
     all_idxs = np.arange(data["radar_data"].shape[1])
-    err_idx = np.array(list(errors.keys()))
+    err_idx = log_index["error_chirp_idx"]
     if (len(err_idx) == 0):
         return data
     keep_idxs = np.delete(all_idxs, err_idx)
@@ -296,15 +582,201 @@ def stack(data: xr.Dataset, n_stack: int):
                  coord_func='min').mean()
 
 
-def pulse_compress(data: xr.Dataset, chirp, fs: float, zero_sample_idx: int=0, signal_speed: float=None):
+def _coarsen_sum(x, axis, factor):
+    """
+    Sum consecutive blocks of `factor` elements along `axis` of a NumPy array whose length
+    along `axis` is a multiple of `factor`. Small blocks along the last (contiguous) axis are
+    summed as strided slices, which is several times faster than summing a reshaped array.
+    """
+    if (axis == x.ndim - 1) and (factor < 8):
+        total = x[..., 0::factor].copy()
+        for k in range(1, factor):
+            total += x[..., k::factor]
+        return total
+    return x.reshape(x.shape[:axis] + (x.shape[axis] // factor, factor) + x.shape[(axis+1):]).sum(axis=(axis+1))
+
+
+def _coarsen_sum_dask(x: da.Array, axis: int, factor: int):
+    """
+    Sum consecutive blocks of `factor` elements along `axis` of a dask array, dropping any
+    incomplete block at the end. Chunks are aligned to multiples of `factor` first (which
+    doesn't move any data if they already are).
+    """
+    n_out = x.shape[axis] // factor
+    x = x[(slice(None),)*axis + (slice(0, n_out * factor),)]
+    x = x.rechunk({axis: max(factor, (x.chunks[axis][0] // factor) * factor)})
+    out_chunks = x.chunks[:axis] + (tuple(c // factor for c in x.chunks[axis]),) + x.chunks[(axis+1):]
+    return x.map_blocks(_coarsen_sum, axis, factor, chunks=out_chunks, dtype=x.dtype)
+
+
+def _stack_sums(data: xr.Dataset, stack_factors):
+    """
+    Yield (n_stack, sums, counts) for each of `stack_factors` in increasing order, where `sums`
+    and `counts` are lazy dask arrays (with the same dimensions as radar_data) of the sum and
+    number of the non-NaN radar_data values in each stack of n_stack chirps.
+
+    Each factor is computed from the block sums of the largest smaller factor that divides it
+    (or from the unstacked data), so the sums are shared between factors and only one pass
+    over the data is needed when every factor is computed together.
+    """
+    factors = sorted(set(int(n) for n in stack_factors))
+    if (len(factors) == 0) or (factors[0] < 1):
+        raise ValueError(f"Stack factors must be at least 1. Got {list(stack_factors)}.")
+
+    radar_data = data["radar_data"].data
+    if not isinstance(radar_data, da.Array):
+        radar_data = da.from_array(radar_data)
+    axis = data["radar_data"].dims.index("pulse_idx")
+
+    is_valid = ~da.isnan(radar_data)
+    levels = {1: (da.where(is_valid, radar_data, 0), is_valid.astype(np.int32))}
+    for n in factors:
+        if n not in levels:
+            parent = max(m for m in levels if n % m == 0)
+            levels[n] = tuple(_coarsen_sum_dask(x, axis, n // parent) for x in levels[parent])
+        yield (n,) + levels[n]
+
+
+def stack_multiscale(data: xr.Dataset, stack_factors):
+    """
+    Stack `data` by every stack factor in `stack_factors` at once. Returns a dictionary mapping
+    each stack factor to the same (lazy) dataset as `stack(data, n_stack)` would return.
+
+    Partial block sums are shared between factors (see `_stack_sums`), so computing all of the
+    results together (e.g. with `dask.compute`) reads the data once instead of once per factor.
+    Sharing works best when factors divide each other (e.g. powers of 2 or 1-2-5 sequences),
+    and chunks are aligned to the factors (see `choose_pulses_per_chunk`).
+    """
+    dims = data["radar_data"].dims
+    n_pulses = len(data["pulse_idx"])
+
+    stacked = {}
+    for n, sums, counts in _stack_sums(data, stack_factors):
+        radar_data = da.where(counts > 0, sums / da.maximum(counts, 1).astype(np.float32), np.nan).astype(data["radar_data"].dtype)
+
+        # Match the output of `stack`: pulse_idx is the minimum of each stack and other
+        # coordinates along pulse_idx (i.e. slow_time) are averaged over each stack
+        n_out = n_pulses // n
+        coords = {name: coord for name, coord in data.coords.items() if "pulse_idx" not in coord.dims}
+        for name, coord in data.coords.items():
+            if coord.dims == ("pulse_idx",):
+                reduce = np.min if name == "pulse_idx" else np.mean
+                coords[name] = ("pulse_idx", reduce(coord.values[:(n_out * n)].reshape((n_out, n)), axis=1), coord.attrs)
+
+        stacked[n] = xr.Dataset(
+            data_vars={"radar_data": (dims, radar_data, data["radar_data"].attrs)},
+            coords=coords,
+            attrs=data.attrs)
+    return stacked
+
+
+def stack_statistics(data: xr.Dataset, stack_factors, compute=True):
+    """
+    Compute statistics along slow time of the data stacked by each of `stack_factors`, for every
+    range bin (i.e. sample_idx for raw data or travel_time for pulse compressed data).
+
+    Returns a dataset with dimensions (n_stack, <range bin dimension>) and variables:
+    - "mean": mean of the (complex) stacked traces
+    - "power": mean power of the stacked traces
+    - "variance": variance of the stacked traces (power minus the power of the mean), which
+      is the noise variance in range bins with a stationary signal
+    - "magnitude_mean" and "magnitude_variance": mean and variance of the magnitude of the
+      stacked traces
+    - "n_traces": number of (non-NaN) stacked traces used
+    Statistics are computed from sums accumulated in double precision.
+
+    Every factor is computed from shared partial sums in a single pass over the data (see
+    `stack_multiscale`), so a whole ladder of stack factors costs about as much as reading the
+    data once. If `compute` is False, the lazy dataset is returned instead.
+    """
+    range_dim = [dim for dim in data["radar_data"].dims if dim != "pulse_idx"][0]
+
+    stats = []
+    for n, stacked in stack_multiscale(data, stack_factors).items():
+        # Raw moments of each range bin, summed in double precision from the complex64 data
+        x = stacked["radar_data"]
+        n_traces = x.notnull().sum(dim="pulse_idx")
+        x = x.fillna(0)
+        magnitude = np.abs(x)
+        mean = x.sum(dim="pulse_idx", skipna=False, dtype=np.complex128) / n_traces
+        power = (magnitude * magnitude).sum(dim="pulse_idx", skipna=False, dtype=np.float64) / n_traces
+        magnitude_mean = magnitude.sum(dim="pulse_idx", skipna=False, dtype=np.float64) / n_traces
+        stats.append(xr.Dataset({
+            "mean": mean,
+            "power": power,
+            "variance": power - np.abs(mean)**2,
+            "magnitude_mean": magnitude_mean,
+            "magnitude_variance": power - magnitude_mean**2,
+            "n_traces": n_traces
+        }))
+    stats = xr.concat(stats, dim=xr.DataArray(sorted(set(int(n) for n in stack_factors)), dims="n_stack", name="n_stack"))
+    stats = stats.drop_vars([name for name, coord in stats.coords.items() if (name != "n_stack") and (range_dim not in coord.dims)])
+    stats.attrs = dict(data.attrs)
+
+    if compute:
+        stats = stats.compute()
+    return stats
+
+
+def choose_fft_len(rx_len_samples, chirp_len):
+    """
+    Choose the FFT length used by `fft_correlate_valid` for pulses of `rx_len_samples` samples
+    and a reference chirp of `chirp_len` samples.
+
+    Short receive windows are correlated with a single FFT covering the whole pulse. Receive
+    windows much longer than the chirp are processed with overlap-save using FFTs of about
+    8x the chirp length, which keeps each FFT small without wasting much work on the overlap.
+    """
+    block_len = max(8 * chirp_len, 1024)
+    return scipy.fft.next_fast_len(min(rx_len_samples, block_len))
+
+def fft_correlate_valid(x, chirp_spectrum_conj, chirp_len, fft_len):
+    """
+    Cross-correlate every pulse in `x` (pulses along the last axis) with a reference chirp,
+    equivalent to `scipy.signal.correlate(pulse, chirp, mode='valid')` for each pulse.
+
+    `chirp_spectrum_conj` is `np.conj(scipy.fft.fft(chirp, fft_len))`, and `chirp_len` is the
+    length of the chirp. Blocks of `fft_len` samples of all pulses are transformed at once,
+    with overlap-save used if the pulses are longer than `fft_len`. The computation is done in
+    the precision of `x` (single precision for complex64 data).
+    """
+    n = x.shape[-1]
+    output_len = n - chirp_len + 1
+    step = fft_len - chirp_len + 1
+    if step < 1:
+        raise ValueError(f"fft_len ({fft_len}) must be at least as long as the chirp ({chirp_len})")
+
+    output_dtype = np.result_type(x.dtype, np.complex64)
+    chirp_spectrum_conj = chirp_spectrum_conj.astype(output_dtype, copy=False)
+    out = np.empty(x.shape[:-1] + (output_len,), dtype=output_dtype)
+    for start in range(0, output_len, step):
+        stop = min(start + step, output_len)
+        spectrum = scipy.fft.fft(x[..., start:min(start + fft_len, n)], n=fft_len, axis=-1)
+        spectrum *= chirp_spectrum_conj
+        out[..., start:stop] = scipy.fft.ifft(spectrum, axis=-1, overwrite_x=True)[..., :(stop - start)]
+    return out
+
+def pulse_compress(data: xr.Dataset, chirp, fs: float, zero_sample_idx: int=0, signal_speed: float=None, fft_len: int=None):
     """
     Apply pulse compression using samples from `chirp` to each pulse from `data`.
     Zero travel time is assumed to be at `zero_sample_idx` in the chirp.
     If a `signal_speed` is provided, this is used to create a secondary coordinate
     `reflection_distance` which is the distance from the radar to the reflection point
     assuming a constant signal speed.
+
+    The matched filter is applied in the frequency domain to whole chunks of pulses at once
+    (see `fft_correlate_valid`). The FFT length is chosen by `choose_fft_len` unless `fft_len`
+    is provided. Results match `scipy.signal.correlate(..., mode='valid')` up to floating point
+    precision.
+
+    If `chirp` is None, the reference chirp is generated from the config stored with the data.
+    Reference chirps and their spectra are cached (see `chirp_cache.ChirpCache`), so compressing
+    many files with the same chirp only computes them once.
     """
 
+    if chirp is None:
+        _, chirp = chirp_cache.reference_chirp(data.attrs["config"])
+
     output_len = len(data["sample_idx"])-len(chirp)+1
     travel_time = np.linspace(0, output_len/fs, output_len)
     travel_time = travel_time - travel_time[zero_sample_idx]
@@ -313,23 +785,28 @@ def pulse_compress(data: xr.Dataset, chirp, fs: float, zero_sample_idx: int=0, s
     if signal_speed is not None:
         coords['reflection_distance'] = ("travel_time", travel_time * (signal_speed/2))
 
+    # The chirp spectrum only needs to be computed once, not once per chunk
+    if fft_len is None:
+        fft_len = choose_fft_len(len(data["sample_idx"]), len(chirp))
+    matched_filter = chirp_cache.matched_filter(chirp, fft_len)
+    chirp_spectrum_conj = matched_filter["spectrum_conj"] / matched_filter["energy"]
+
     # This code is kind of a nightmare, but it should be a fairly efficient way
     # to do this.
     # This function call applies the lambda function (first argument) to each
-    # pulse in the data.
+    # chunk of the data. The lambda function receives a block of pulses with
+    # the samples of each pulse along the last axis.
     # If you want to understand all the other parameters, I recommend starting
     # with these pages:
     # https://docs.xarray.dev/en/stable/examples/apply_ufunc_vectorize_1d.html
     # https://docs.xarray.dev/en/stable/generated/xarray.apply_ufunc.html
 
     compressed = xr.apply_ufunc(
-        lambda x: scipy.signal.correlate(
-                x, chirp, mode='valid') / np.sum(np.abs(chirp)**2),
+        lambda x: fft_correlate_valid(x, chirp_spectrum_conj, len(chirp), fft_len),
         data,
         input_core_dims=[['sample_idx']], # The dimension operated over -- aka "don't vectorize over this"
         output_core_dims=[["travel_time"]], # The output dimensions of the lambda function itself
         exclude_dims=set(("sample_idx",)), # Dimensions to not vectorize over
-        vectorize=True, # Vectorize other dimensions using a call to np.vectorize
         dask="parallelized", # Allow dask to chunk and parallelize the computation
         output_dtypes=[data["radar_data"].dtype], # Needed for dask: explicitly provide the output dtype
         dask_gufunc_kwargs={"output_sizes": {'travel_time': output_len}} # Also needed for dask:
@@ -344,21 +821,397 @@ def pulse_compress(data: xr.Dataset, chirp, fs: float, zero_sample_idx: int=0, s
     return compressed
 
 
-def invert_phase_dithering(data, phase_codes_filename, override_errors=False):
-
+def _check_phase_dithering_inversion(data, override_errors=False):
     if not override_errors:
         if "phase_dithering_inversion" in data.attrs:
             raise Exception("It looks like phase dithering inversion has already been run on this dataset.")
         if not data.attrs['config']["CHIRP"].get("phase_dithering", False):
             raise Exception("phase_dithering is not set in the config file. Are you sure you want to invert this file?")
-    
-    phases = np.fromfile(phase_codes_filename, dtype=np.float32, count=len(data.pulse_idx))
+
+def _phase_dithering_attrs(phase_codes_filename):
+    if phase_codes_filename is None:
+        return {'phase_codes': 'mt19937', 'seed': 0}
+    return {'phase_codes_filename': phase_codes_filename}
+
+def invert_phase_dithering(data, phase_codes_filename=None, override_errors=False):
+    """
+    Undo the pseudorandom phase modulation applied to each chirp by the radar program.
+
+    Phase codes are looked up by pulse_idx, so this works correctly after errors have been
+    removed. If phase_codes_filename is None (the default), phase codes are generated lazily
+    for each chunk using the same generator as the radar program (see phase_codes.py).
+    Otherwise, they're read from phase_codes_filename, which should be a file produced by
+    pseudorandom_phase_to_file.
+    """
+
+    _check_phase_dithering_inversion(data, override_errors)
+
+    phase_codes = phase_code_source(phase_codes_filename)
+    pulse_idx = data["pulse_idx"].data
+    if isinstance(data["radar_data"].data, da.Array):
+        pulse_idx = da.from_array(pulse_idx, chunks=(data["radar_data"].data.chunks[data["radar_data"].get_axis_num("pulse_idx")],))
+        phases = pulse_idx.map_blocks(phase_codes.phases, dtype=np.float32)
+    else:
+        phases = phase_codes.phases(pulse_idx)
     xr_phases = xr.DataArray(phases, dims=('pulse_idx',))
 
     demodulated = data.copy()
 
-    demodulated["radar_data"] *= np.exp(-1j * xr_phases)
+    demodulated["radar_data"] = demodulated["radar_data"] * np.exp(-1j * xr_phases)
 
-    demodulated.attrs["phase_dithering_inversion"] = {'phases': phases}
+    demodulated.attrs["phase_dithering_inversion"] = _phase_dithering_attrs(phase_codes_filename)
     
-    return demodulated
\ No newline at end of file
+    return demodulated
+
+
+def _pipeline_block(x, local_idx, fill_mask, error_fill_value, phase_codes, pulse_idx, n_stack, chirp_spectrum_conj, chirp_len, fft_len):
+    """
+    Apply every ProcessingPipeline stage to one block of raw pulses `x` (sample_idx, pulse_idx).
+    `local_idx` selects the pulses to keep (in order) from `x` and all other per-pulse arrays
+    refer to the selected pulses.
+    """
+    x = x[:, local_idx]
+    if fill_mask is not None:
+        x[:, fill_mask] = error_fill_value
+    if phase_codes is not None:
+        x = x * np.exp(-1j * phase_codes.phases(pulse_idx))
+    if n_stack > 1:
+        x = x.reshape((x.shape[0], x.shape[1] // n_stack, n_stack))
+        # Like `stack`, NaNs (from fill_errors, or already in the data) are skipped
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning) # All-NaN stacks are NaN, as in `stack`
+            x = np.nanmean(x, axis=2)
+    if chirp_spectrum_conj is not None:
+        return fft_correlate_valid(np.transpose(x), chirp_spectrum_conj, chirp_len, fft_len)
+    return x
+
+class ProcessingPipeline():
+    """
+    Applies several processing steps to raw radar data in a single chunk-by-chunk pass, instead
+    of building (and potentially storing) an intermediate dataset for each step.
+
+    Stages are provided as a list of (name, keyword arguments) tuples, in processing order:
+
+    pipeline = ProcessingPipeline([
+        ("remove_errors", {}), # or ("fill_errors", {"error_fill_value": np.nan})
+        ("invert_phase_dithering", {}), # Or {"phase_codes_filename": "phase_codes.bin"}
+        ("stack", {"n_stack": 10}),
+        ("pulse_compress", {"chirp": chirp, "fs": 56e6, "zero_sample_idx": 0, "signal_speed": None}),
+    ])
+    compressed = pipeline.apply(raw) # Lazy, like the individual functions
+    pipeline.to_zarr(raw, "compressed.zarr") # Or compute everything and write only the final product
+
+    Every stage is optional, but stages must be in the order shown above. Keyword arguments
+    are the same as for the function of the same name in this module (except for `data`).
+    The result is the same as calling those functions one after another. Parameters are
+    recorded in the attributes of the output in the same way as the individual functions, and
+    the full list of stages is saved in the "processing_pipeline" attribute.
+    """
+    STAGE_ORDER = ["fill_errors", "remove_errors", "invert_phase_dithering", "stack", "pulse_compress"]
+
+    def __init__(self, stages):
+        self.stages = [(name, dict(kwargs)) for name, kwargs in stages]
+
+        stage_positions = []
+        for name, _ in self.stages:
+            if name not in self.STAGE_ORDER:
+                raise ValueError(f"Unrecognized pipeline stage '{name}'. Must be one of {self.STAGE_ORDER}.")
+            stage_positions.append(self.STAGE_ORDER.index(name))
+        if stage_positions != sorted(set(stage_positions)):
+            raise ValueError(f"Pipeline stages must be unique and in the order {self.STAGE_ORDER}.")
+        if ("fill_errors" in self._stage_names()) and ("remove_errors" in self._stage_names()):
+            raise ValueError("Only one of fill_errors and remove_errors can be used.")
+
+    def _stage_names(self):
+        return [name for name, _ in self.stages]
+
+    def _stage_kwargs(self, name):
+        return dict(self.stages)[name] if name in self._stage_names() else None
+
+    def apply(self, data: xr.Dataset):
+        """
+        Lazily apply the pipeline to `data`. Returns a dask-backed dataset.
+        """
+        attrs = dict(data.attrs)
+        n_pulses = len(data["pulse_idx"])
+        pulse_idx = data["pulse_idx"].values
+        keep_idxs = np.arange(n_pulses) # Positions (not pulse_idx values) of the pulses to keep
+        fill_mask = None
+        error_fill_value = None
+
+        # Errors
+        fill_kwargs = self._stage_kwargs("fill_errors")
+        remove_kwargs = self._stage_kwargs("remove_errors")
+        if (fill_kwargs is not None) or (remove_kwargs is not None):
+            log_index = stdout_log_index(data)
+            error_kwargs = fill_kwargs if fill_kwargs is not None else remove_kwargs
+            if _error_handling_applies(data, log_index, error_kwargs.get("allowed_file_error_types", []), error_kwargs.get("force_file_error_type")):
+                is_error = np.isin(pulse_idx, log_index["error_chirp_idx"])
+                if fill_kwargs is not None:
+                    fill_mask = is_error
+                    error_fill_value = fill_kwargs.get("error_fill_value", np.nan)
+                elif "errors_removed" in attrs:
+                    if not remove_kwargs.get("skip_if_already_complete", True):
+                        raise ValueError("Errors have already been removed from this data")
+                    print("Errors have already been removed from this data, skipping")
+                elif np.any(is_error):
+                    keep_idxs = keep_idxs[~is_error]
+                    attrs["errors_removed"] = True
+
+        # Phase dithering inversion
+        phase_codes = None
+        dither_kwargs = self._stage_kwargs("invert_phase_dithering")
+        if dither_kwargs is not None:
+            _check_phase_dithering_inversion(data, dither_kwargs.get("override_errors", False))
+            phase_codes = phase_code_source(dither_kwargs.get("phase_codes_filename"))
+            attrs["phase_dithering_inversion"] = _phase_dithering_attrs(dither_kwargs.get("phase_codes_filename"))
+
+        # Stacking
+        stack_kwargs = self._stage_kwargs("stack")
+        n_stack = 1 if stack_kwargs is None else stack_kwargs["n_stack"]
+        n_out = len(keep_idxs) // n_stack
+        if n_out == 0:
+            raise ValueError(f"Not enough pulses ({len(keep_idxs)}) to produce any output with n_stack={n_stack}")
+        keep_idxs = keep_idxs[:(n_out * n_stack)]
+
+        # Pulse compression
+        compress_kwargs = self._stage_kwargs("pulse_compress")
+        chirp_spectrum_conj, chirp_len, fft_len = None, None, None
+        n_samples = len(data["sample_idx"])
+        if compress_kwargs is not None:
+            chirp = compress_kwargs.get("chirp")
+            if chirp is None:
+                _, chirp = chirp_cache.reference_chirp(data.attrs["config"])
+            chirp_len = len(chirp)
+            fft_len = compress_kwargs.get("fft_len") or choose_fft_len(n_samples, chirp_len)
+            matched_filter = chirp_cache.matched_filter(chirp, fft_len)
+            chirp_spectrum_conj = matched_filter["spectrum_conj"] / matched_filter["energy"]
+            attrs["pulse_compress"] = {
+                "fs": compress_kwargs["fs"], "zero_sample_idx": compress_kwargs.get("zero_sample_idx", 0),
+                "signal_speed": compress_kwargs.get("signal_speed")}
+
+        # Build one task per output chunk, each reading only the raw pulses it needs
+        radar_data = data["radar_data"].data
+        if not isinstance(radar_data, da.Array):
+            radar_data = da.from_array(radar_data)
+        out_per_chunk = max(1, radar_data.chunks[1][0] // n_stack)
+        output_len = n_samples if chirp_spectrum_conj is None else n_samples - chirp_len + 1
+
+        blocks = []
+        for out_start in range(0, n_out, out_per_chunk):
+            out_stop = min(out_start + out_per_chunk, n_out)
+            block_idxs = keep_idxs[(out_start * n_stack):(out_stop * n_stack)]
+            first, last = block_idxs[0], block_idxs[-1] + 1
+            block = dask.delayed(_pipeline_block)(
+                radar_data[:, first:last], block_idxs - first,
+                None if fill_mask is None else fill_mask[block_idxs], error_fill_value,
+                phase_codes, pulse_idx[block_idxs],
+                n_stack, chirp_spectrum_conj, chirp_len, fft_len)
+            shape = (output_len, out_stop - out_start) if chirp_spectrum_conj is None else (out_stop - out_start, output_len)
+            blocks.append(da.from_delayed(block, shape=shape, dtype=radar_data.dtype))
+        result = da.concatenate(blocks, axis=(1 if chirp_spectrum_conj is None else 0))
+
+        # Coordinates
+        # Match the output of `stack`: pulse_idx is the minimum of each stack and other
+        # coordinates along pulse_idx (i.e. slow_time) are averaged over each stack
+        coords = {name: coord for name, coord in data.coords.items() if "pulse_idx" not in coord.dims}
+        coords["pulse_idx"] = ("pulse_idx", pulse_idx[keep_idxs[::n_stack]], data["pulse_idx"].attrs)
+        for name, coord in data.coords.items():
+            if (name != "pulse_idx") and (coord.dims == ("pulse_idx",)):
+                coords[name] = ("pulse_idx", np.mean(coord.values[keep_idxs].reshape((n_out, n_stack)), axis=1), coord.attrs)
+
+        if chirp_spectrum_conj is None:
+            dims = ["sample_idx", "pulse_idx"]
+        else:
+            dims = ["pulse_idx", "travel_time"]
+            coords = {name: coord for name, coord in coords.items() if name not in ("sample_idx", "fast_time")}
+            travel_time = np.linspace(0, output_len/compress_kwargs["fs"], output_len)
+            coords["travel_time"] = travel_time - travel_time[compress_kwargs.get("zero_sample_idx", 0)]
+            if compress_kwargs.get("signal_speed") is not None:
+                coords["reflection_distance"] = ("travel_time", coords["travel_time"] * (compress_kwargs["signal_speed"]/2))
+
+        attrs["processing_pipeline"] = [
+            [name, {key: value for key, value in kwargs.items() if key != "chirp"}] for name, kwargs in self.stages]
+
+        return xr.Dataset(
+            data_vars={"radar_data": (dims, result, data["radar_data"].attrs)},
+            coords=coords,
+            attrs=attrs)
+
+    def to_zarr(self, data: xr.Dataset, zarr_path, num_workers=None):
+        """
+        Apply the pipeline to `data` and write only the final result to `zarr_path`.
+        If `num_workers` is provided, it's used as the number of dask worker threads.
+
+        Returns the path to the zarr file.
+        """
+        result = self.apply(data)
+        if num_workers is not None:
+            with dask.config.set(scheduler='threads', num_workers=num_workers):
+                result.to_zarr(zarr_path, mode="w")
+        else:
+            result.to_zarr(zarr_path, mode="w")
+        return zarr_path
+
+
+def _slow_time_psd_block(x, pulse_axis, n_presum, fs, window, nperseg, noverlap, detrend, scaling, average):
+    """
+    Compute the slow time PSD of every segment of one block of pulses `x`, for every range bin.
+    The block must contain a whole number of segments (after presumming `n_presum` pulses).
+
+    Returns an array of shape (segments, frequencies, range bins) or, if `average` is True,
+    the sum over segments (in double precision) with shape (1, frequencies, range bins).
+    Frequencies are in fftshift order (negative to positive).
+    """
+    if pulse_axis == 0:
+        x = np.transpose(x)
+    if n_presum > 1:
+        x = _coarsen_sum(x, 1, n_presum) / n_presum
+    _, _, psd = scipy.signal.spectrogram(x, fs=fs, window=window, nperseg=nperseg, noverlap=noverlap,
+                                         detrend=detrend, return_onesided=False, scaling=scaling,
+                                         mode='psd', axis=-1)
+    psd = np.fft.fftshift(psd, axes=1) # (range bins, frequencies, segments)
+    if average:
+        return np.transpose(np.sum(psd, axis=2, dtype=np.float64))[np.newaxis, :, :]
+    return np.transpose(psd, (2, 1, 0)).astype(np.float32)
+
+
+def _slow_time_spectral(data: xr.Dataset, nperseg, noverlap, window, n_presum, detrend, scaling, segments_per_chunk, average):
+    """
+    Build the dask blocks (see `_slow_time_psd_block`) and coordinates shared by
+    `slow_time_spectrogram` and `slow_time_welch`.
+
+    Each block computes a run of consecutive segments from the raw pulses those segments cover.
+    Segments of neighbouring blocks overlap, so the pulses where blocks meet are read by both,
+    which makes windows that span chunk boundaries exactly the same as if the whole dataset had
+    been processed at once.
+    """
+    if noverlap is None:
+        noverlap = nperseg // 2
+    if not (0 <= noverlap < nperseg):
+        raise ValueError(f"noverlap ({noverlap}) must be at least 0 and less than nperseg ({nperseg})")
+    step = nperseg - noverlap
+
+    dims = data["radar_data"].dims
+    pulse_axis = dims.index("pulse_idx")
+    range_dim = dims[1 - pulse_axis]
+    n_presummed = len(data["pulse_idx"]) // n_presum
+    n_segments = (n_presummed - nperseg) // step + 1
+    if n_presummed < nperseg:
+        raise ValueError(f"Not enough pulses ({len(data['pulse_idx'])}) for one segment of {nperseg} pulses with n_presum={n_presum}")
+
+    # Sample rate in slow time, assuming uniformly spaced pulses
+    config = data.attrs.get("config")
+    if (config is not None) and ('CHIRP' in config):
+        pulse_interval = config['CHIRP']['pulse_rep_int'] * config['CHIRP'].get('num_presums', 1)
+    else:
+        pulse_interval = float(np.median(np.diff(data["slow_time"].values)))
+    fs = 1 / (pulse_interval * n_presum)
+    if "errors_removed" in data.attrs:
+        print("[WARNING] Errors have been removed from this data, so pulses aren't uniformly spaced in slow time. Consider using fill_errors instead.")
+
+    radar_data = data["radar_data"].data
+    if not isinstance(radar_data, da.Array):
+        radar_data = da.from_array(radar_data)
+    if segments_per_chunk is None:
+        segments_per_chunk = max(1, radar_data.chunks[pulse_axis][0] // (step * n_presum))
+
+    blocks = []
+    for seg_start in range(0, n_segments, segments_per_chunk):
+        seg_stop = min(seg_start + segments_per_chunk, n_segments)
+        first = seg_start * step * n_presum
+        last = ((seg_stop - 1) * step + nperseg) * n_presum
+        block = dask.delayed(_slow_time_psd_block)(
+            radar_data[(slice(None),)*pulse_axis + (slice(first, last),)], pulse_axis, n_presum, fs,
+            window, nperseg, noverlap, detrend, scaling, average)
+        shape = (1 if average else seg_stop - seg_start, nperseg, radar_data.shape[1 - pulse_axis])
+        blocks.append(da.from_delayed(block, shape=shape, dtype=(np.float64 if average else np.float32)))
+
+    # Coordinates of each segment: the first pulse_idx, and the mean of other coordinates
+    # along pulse_idx (i.e. slow_time), like `stack`
+    segment_starts = np.arange(n_segments) * step * n_presum
+    segment_len = nperseg * n_presum
+    segment_coords = {}
+    for name, coord in data.coords.items():
+        if coord.dims == ("pulse_idx",):
+            if name == "pulse_idx":
+                segment_coords[name] = ("pulse_idx", coord.values[segment_starts], coord.attrs)
+            else:
+                cumsum = np.concatenate([[0], np.cumsum(coord.values, dtype=np.float64)])
+                segment_coords[name] = ("pulse_idx", (cumsum[segment_starts + segment_len] - cumsum[segment_starts]) / segment_len, coord.attrs)
+
+    coords = {name: coord for name, coord in data.coords.items() if "pulse_idx" not in coord.dims}
+    coords["doppler_frequency"] = ("doppler_frequency", np.fft.fftshift(np.fft.fftfreq(nperseg, 1/fs)), {"description": "slow time frequency in Hz"})
+
+    attrs = dict(data.attrs)
+    attrs["slow_time_spectral"] = {
+        "nperseg": nperseg, "noverlap": noverlap, "window": window, "n_presum": n_presum,
+        "detrend": detrend, "scaling": scaling, "fs": fs, "n_segments": n_segments}
+
+    return blocks, segment_coords, coords, range_dim, attrs
+
+
+def slow_time_spectrogram(data: xr.Dataset, nperseg=256, noverlap=None, window='hann', n_presum=1, detrend=False, scaling='density', segments_per_chunk=None, zarr_path=None):
+    """
+    Compute the slow time (Doppler) spectrogram of every range bin of `data` (raw or pulse
+    compressed), chunk by chunk, so that it works on datasets of any length.
+
+    Pulses are optionally presummed (averaged) in groups of `n_presum` and then split into
+    segments of `nperseg` pulses overlapping by `noverlap` (default nperseg // 2). `window`,
+    `detrend` and `scaling` are as for `scipy.signal.spectrogram`, and each segment gives the
+    same PSD as scipy would for the whole dataset, including segments that span chunk
+    boundaries. `segments_per_chunk` sets how many segments are computed in each task (by
+    default, about one input chunk's worth).
+
+    Returns a (lazy) dataset with the PSD as "psd" (float32), with dimensions
+    (pulse_idx, doppler_frequency, <range bin dimension>). Segments are labelled with the
+    pulse_idx of their first pulse and the mean slow_time of their pulses. Doppler frequencies
+    run from negative to positive and assume uniformly spaced pulses (so errors should be
+    filled, not removed). Since NaNs propagate through the FFT, segments containing filled
+    errors are NaN unless error_fill_value is set to 0.
+
+    If `zarr_path` is provided, the spectrogram is written to a zarr store there as it's
+    computed (without holding it all in memory) and the opened store is returned.
+    """
+    blocks, segment_coords, coords, range_dim, attrs = _slow_time_spectral(
+        data, nperseg, noverlap, window, n_presum, detrend, scaling, segments_per_chunk, average=False)
+
+    coords.update(segment_coords)
+    spectrogram = xr.Dataset(
+        data_vars={"psd": (["pulse_idx", "doppler_frequency", range_dim], da.concatenate(blocks, axis=0))},
+        coords=coords,
+        attrs=attrs)
+
+    if zarr_path is not None:
+        spectrogram.to_zarr(zarr_path, mode="w")
+        return xr.open_zarr(zarr_path)
+    return spectrogram
+
+
+def slow_time_welch(data: xr.Dataset, nperseg=256, noverlap=None, window='hann', n_presum=1, detrend=False, scaling='density', segments_per_chunk=None, zarr_path=None):
+    """
+    Compute the Welch PSD in slow time (i.e. the Doppler spectrum averaged over the whole
+    dataset) of every range bin of `data`. Parameters are the same as for
+    `slow_time_spectrogram`, and the result is the mean of its segments, which matches
+    `scipy.signal.welch` with the same parameters.
+
+    Each task only returns the sum of the PSDs of its segments, so memory use is bounded by
+    the size of a chunk regardless of the length of the dataset.
+
+    Returns a (lazy) dataset with the PSD as "psd" (float64) with dimensions
+    (doppler_frequency, <range bin dimension>). If `zarr_path` is provided, it's written to a
+    zarr store there and the opened store is returned.
+    """
+    blocks, _, coords, range_dim, attrs = _slow_time_spectral(
+        data, nperseg, noverlap, window, n_presum, detrend, scaling, segments_per_chunk, average=True)
+
+    psd = da.concatenate(blocks, axis=0).sum(axis=0) / attrs["slow_time_spectral"]["n_segments"]
+    welch = xr.Dataset(
+        data_vars={"psd": (["doppler_frequency", range_dim], psd)},
+        coords=coords,
+        attrs=attrs)
+
+    if zarr_path is not None:
+        welch.to_zarr(zarr_path, mode="w")
+        return xr.open_zarr(zarr_path)
+    return welch
@@ -0,0 +1,196 @@
+import os
+import time
+import queue
+import threading
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import processing
+from chirp_cache import chirp_cache
+
+class QuickLookRadargram():
+    """
+    Builds a downsampled, pulse compressed radargram while the radar is recording and
+    periodically renders it to a PNG, so you can check for echoes before the recording ends.
+
+    Typical use (this is what run.py does when RUN_MANAGER:quicklook_loc is set):
+
+    quicklook = QuickLookRadargram(config, "data/quicklook.png")
+    quicklook.start()
+    quicklook.tail_file("data/rx_samps.bin") # For each [OPEN FILE] line
+    quicklook.add_file("data/rx_samps.bin") # For each [CLOSE FILE] line
+    quicklook.finish() # Process anything left and render the final image
+
+    Open files are polled every `poll_interval` seconds and only the pulses added since the
+    last poll are read. Each group of `n_stack` new pulses is stacked first and then pulse
+    compressed (both are linear, so this is the same as compressing and then stacking, but
+    n_stack times cheaper). The power of each stacked trace is averaged down to at most
+    `max_samples` samples in fast time and added to the radargram buffer.
+
+    The buffer holds at most `max_traces` columns. When it's full, adjacent columns are
+    averaged together and each new column averages twice as many stacked traces as before,
+    so the buffer (and the time to render it) stays bounded however long the recording is.
+    The PNG is re-rendered at most every `render_interval` seconds.
+    """
+    def __init__(self, config, png_path, n_stack=100, max_samples=512, max_traces=2000, render_interval=5.0, poll_interval=1.0):
+        self.config = config
+        self.png_path = png_path
+        self.n_stack = n_stack
+        self.max_samples = max_samples
+        self.max_traces = max_traces
+        self.render_interval = render_interval
+        self.poll_interval = poll_interval
+
+        self.cpu_format = config['DEVICE'].get('cpu_format', 'fc32')
+        self.fs = config['GENERATE']['sample_rate']
+        self.rx_len_samples = int(config['CHIRP']['rx_duration'] * self.fs)
+        sample_dtype, _ = processing.sample_format(self.cpu_format)
+        self.bytes_per_pulse = self.rx_len_samples * 2 * np.dtype(sample_dtype).itemsize
+        self.pulse_period = config['CHIRP']['pulse_rep_int'] * config['CHIRP'].get('num_presums', 1)
+        _, self.chirp = chirp_cache.reference_chirp(config)
+
+        self.file_queue = queue.Queue()
+        self.open_file = None # File currently being tailed
+        self.pulses_read = {} # Number of pulses already read from each file
+        self.leftover = np.zeros((self.rx_len_samples, 0), dtype=np.csingle) # Pulses not yet making up a full stack
+
+        self.columns = [] # Radargram buffer, one array of power (dB) per column
+        self.traces_per_column = 1 # Number of stacked traces averaged into each column
+        self.pending = [] # Stacked trace powers (linear) not yet making up a full column
+        self.n_pulses = 0 # Total number of pulses processed
+        self.last_render = 0
+        self.needs_render = False
+
+        self.worker_thread = None
+
+    def start(self):
+        """
+        Start the background processing thread
+        """
+        self.worker_thread = threading.Thread(target=self._process_from_queue)
+        self.worker_thread.daemon = True # thread dies with the program
+        self.worker_thread.start()
+
+    def tail_file(self, filename):
+        """
+        Start reading new pulses from `filename` as it's written
+        """
+        self.file_queue.put(("tail", filename))
+
+    def add_file(self, filename):
+        """
+        Read any remaining pulses from a closed file. Files must be added in recording order.
+        """
+        self.file_queue.put(("closed", filename))
+
+    def finish(self):
+        """
+        Process everything queued, render the final PNG, and stop the background thread
+        """
+        if self.worker_thread is None:
+            return
+        self.file_queue.put(None)
+        self.worker_thread.join()
+        self.worker_thread = None
+
+    def _process_from_queue(self):
+        while True:
+            try:
+                item = self.file_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                item = ("poll", None)
+
+            try:
+                if item is None:
+                    if self.open_file is not None:
+                        self._read_new_pulses(self.open_file)
+                    self.render()
+                    return
+
+                action, filename = item
+                if action == "tail":
+                    self.open_file = filename
+                elif action == "closed":
+                    self._read_new_pulses(filename)
+                    if self.open_file == filename:
+                        self.open_file = None
+                elif self.open_file is not None:
+                    self._read_new_pulses(self.open_file)
+
+                if self.needs_render and (time.time() - self.last_render > self.render_interval):
+                    self.render()
+            except Exception as e:
+                print(f"[QUICKLOOK] Failed to update quick-look radargram: {e}")
+
+    def _read_new_pulses(self, filename):
+        if not os.path.exists(filename):
+            return
+        first_pulse = self.pulses_read.get(filename, 0)
+        n_pulses = (os.path.getsize(filename) // self.bytes_per_pulse) - first_pulse
+        if n_pulses <= 0:
+            return
+
+        sig = processing.extractSig(filename, count=n_pulses*self.rx_len_samples*2, offset=first_pulse*self.bytes_per_pulse, cpu_format=self.cpu_format)
+        self.pulses_read[filename] = first_pulse + n_pulses
+        self.add_pulses(np.transpose(np.reshape(sig, (n_pulses, self.rx_len_samples))))
+
+    def add_pulses(self, pulses):
+        """
+        Add new raw pulses (sample_idx, pulse_idx) to the radargram
+        """
+        self.n_pulses += pulses.shape[1]
+        pulses = np.concatenate([self.leftover, pulses], axis=1)
+        n_full = (pulses.shape[1] // self.n_stack) * self.n_stack
+        self.leftover = np.array(pulses[:, n_full:])
+        if n_full == 0:
+            return
+
+        _, compressed = processing.pulse_compress(processing.stack(pulses[:, :n_full], self.n_stack), self.chirp, self.fs)
+        power = np.abs(compressed)**2
+
+        # Average down to at most max_samples samples in fast time
+        samples_per_row = int(np.ceil(power.shape[0] / self.max_samples))
+        n_rows = power.shape[0] // samples_per_row
+        power = np.mean(np.reshape(power[:(n_rows*samples_per_row), :], (n_rows, samples_per_row, power.shape[1])), axis=1)
+
+        self.pending.extend(power.T)
+        while len(self.pending) >= self.traces_per_column:
+            self.columns.append(10*np.log10(np.mean(self.pending[:self.traces_per_column], axis=0)))
+            del self.pending[:self.traces_per_column]
+            if len(self.columns) >= self.max_traces:
+                # Halve the slow time resolution of the buffer (averaging power, not dB)
+                linear = 10**(np.array(self.columns[:(len(self.columns)//2)*2]) / 10)
+                self.columns = list(10*np.log10((linear[0::2] + linear[1::2]) / 2))
+                self.traces_per_column *= 2
+        self.needs_render = True
+
+    def render(self):
+        """
+        Render the radargram buffer to the PNG file
+        """
+        if len(self.columns) == 0:
+            return
+        radargram = np.transpose(np.array(self.columns))
+        fast_time_us = (self.rx_len_samples - len(self.chirp) + 1) / self.fs * 1e6
+        slow_time_s = len(self.columns) * self.traces_per_column * self.n_stack * self.pulse_period
+
+        fig = Figure(figsize=(10, 5))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot()
+        im = ax.imshow(radargram, aspect='auto', cmap='inferno', interpolation='nearest',
+                       extent=[0, slow_time_s, fast_time_us, 0],
+                       vmin=np.percentile(radargram, 5), vmax=np.max(radargram))
+        fig.colorbar(im, ax=ax, label='Power [dB]')
+        ax.set_xlabel('Slow time [s]')
+        ax.set_ylabel('Fast time [us]')
+        ax.set_title(f"Quick look: {self.n_pulses} pulses ({self.n_stack * self.traces_per_column} per column), updated {time.strftime('%H:%M:%S')}")
+
+        # Write to a temporary file first so the PNG is never seen half-written
+        tmp_path = self.png_path + ".tmp.png"
+        fig.savefig(tmp_path, dpi=100)
+        os.replace(tmp_path, self.png_path)
+
+        self.last_render = time.time()
+        self.needs_render = False
@@ -0,0 +1,241 @@
+import os
+import re
+import sys
+import time
+import threading
+import collections
+
+import numpy as np
+
+# Types of events parsed from the radar program's stdout
+EVENT_START = 1        # [START] Beginning main loop
+EVENT_OPEN_FILE = 2    # [OPEN FILE] <filename>
+EVENT_CLOSE_FILE = 3   # [CLOSE FILE] <filename>
+EVENT_ERROR = 4        # [ERROR] (Chirp N) ...
+EVENT_TIME_OFFSET = 5  # [TX] (Chirp N) time_offset increased by X
+EVENT_TOTAL = 6        # [RX] Error count / Total pulses written / Total pulses attempted
+
+# One record per event. `chirp` is the chirp index (or -1), `value` is the time offset
+# increase or total, and `label` indexes into RadarOutputReader.labels (error codes,
+# filenames, and names of totals), or is -1.
+EVENT_DTYPE = np.dtype([('time', np.float64), ('type', np.uint8), ('chirp', np.int64), ('value', np.float64), ('label', np.int32)])
+
+_CHIRP_PATTERN = re.compile(r"\(Chirp (\d+)\)")
+_ERROR_CODE_PATTERN = re.compile(r"Receiver error: ([\w_]+)")
+_TIME_OFFSET_PATTERN = re.compile(r"time_offset increased by ([\d.eE+-]+)")
+_TOTAL_PATTERN = re.compile(r"\[RX\] (Error count|Total pulses written|Total pulses attempted): (\d+)")
+
+class RadarOutputReader():
+    """
+    Reads the stdout of the radar program in batches (everything available in the pipe at
+    once), so that bursts of thousands of [ERROR] lines per second don't back up the pipe.
+
+    For each batch, this:
+    - writes every line to `log_file` (with the same "[timestamp] \\t" prefix as before) in
+      a single buffered write
+    - parses the known line types into compact event records (see EVENT_DTYPE and `events()`)
+    - calls `line_callback(line)` for each line and `close_file_callback(filename)` for each
+      [CLOSE FILE] line, if provided
+    - prints the output, if `also_print` is True. [ERROR] and time_offset lines are printed
+      at most `max_errors_printed` times every `print_interval` seconds, with a summary of
+      how many were suppressed.
+
+    Live counters are available from `stats()` while the radar is running. Pulse counts are
+    estimated from the chirp indices in error messages and from the number of files closed
+    (if `pulses_per_file` is provided), since successful pulses aren't reported individually.
+
+    Typical use (in a thread, since `read` blocks until the pipe is closed):
+
+    reader = RadarOutputReader(open('uhd_stdout.log', 'w'))
+    reader.read(process.stdout)
+    """
+    def __init__(self, log_file, also_print=True, line_callback=None, close_file_callback=None,
+                 pulses_per_file=None, print_interval=1.0, max_errors_printed=10, rate_window=5.0):
+        self.log_file = log_file
+        self.also_print = also_print
+        self.line_callback = line_callback
+        self.close_file_callback = close_file_callback
+        self.pulses_per_file = pulses_per_file
+        self.print_interval = print_interval
+        self.max_errors_printed = max_errors_printed
+        self.rate_window = rate_window
+
+        self.lock = threading.Lock()
+        self.event_buffer = np.zeros(1024, dtype=EVENT_DTYPE)
+        self.n_events = 0
+        self.labels = [] # Strings referenced by the label field of event records
+        self.label_idxs = {}
+
+        self.start_time = None
+        self.n_lines = 0
+        self.n_errors = 0
+        self.n_files_closed = 0
+        self.last_chirp = -1 # Highest chirp index seen so far
+        self.totals = {}
+        self.history = collections.deque() # (time, pulses, errors) for rate calculations
+
+        self.print_window_start = 0
+        self.errors_printed = 0
+        self.errors_suppressed = 0
+
+    def read(self, out):
+        """
+        Read from `out` (the radar program's stdout pipe) until it's closed, then close
+        `out` and the log file.
+        """
+        fd = out.fileno()
+        partial_line = ""
+        while True:
+            data = os.read(fd, 2**16)
+            if not data:
+                break
+            lines = (partial_line + data.decode('utf-8', errors='replace')).split('\n')
+            partial_line = lines.pop()
+            if len(lines) > 0:
+                self.process_lines([line + '\n' for line in lines])
+        if partial_line:
+            self.process_lines([partial_line])
+        if self.also_print:
+            self._print_suppressed(time.time())
+
+        out.close()
+        self.log_file.close()
+
+    def process_lines(self, lines, t=None):
+        """
+        Process a batch of lines received at (approximately) the same time `t`
+        """
+        if t is None:
+            t = time.time()
+        prefix = f"[{t:0.3f}] \t"
+
+        self.log_file.write("".join([prefix + line for line in lines]))
+        self.log_file.flush()
+
+        new_events = []
+        for line in lines:
+            event = self._parse_line(line, t)
+            if event is not None:
+                new_events.append(event)
+
+            if self.line_callback is not None:
+                self.line_callback(line)
+            if (self.close_file_callback is not None) and (event is not None) and (event[1] == EVENT_CLOSE_FILE):
+                self.close_file_callback(line[13:].strip())
+
+            if self.also_print:
+                self._print_line(prefix + line, event, t)
+
+        with self.lock:
+            self.n_lines += len(lines)
+            self._append_events(new_events)
+            self.history.append((t, self._pulses_estimate(), self.n_errors))
+            while (len(self.history) > 2) and (t - self.history[1][0] > self.rate_window):
+                self.history.popleft()
+
+        if self.also_print:
+            self._print_suppressed(t, force=False)
+
+    def events(self):
+        """
+        Return a copy of all events parsed so far as a structured numpy array (see EVENT_DTYPE)
+        """
+        with self.lock:
+            return self.event_buffer[:self.n_events].copy()
+
+    def stats(self):
+        """
+        Return a dictionary of live counters: elapsed time since [START], estimated pulses
+        and pulses per second, errors and errors per second, files closed, and any totals
+        reported by the radar program when it finished.
+        """
+        with self.lock:
+            pulses = self._pulses_estimate()
+            if len(self.history) >= 2:
+                t0, pulses0, errors0 = self.history[0]
+                t1, pulses1, errors1 = self.history[-1]
+                dt = max(time.time(), t1) - t0
+            else:
+                dt = 0
+            return {
+                "elapsed_s": (time.time() - self.start_time) if self.start_time is not None else 0,
+                "lines": self.n_lines,
+                "pulses": pulses,
+                "pulses_per_second": ((pulses1 - pulses0) / dt) if dt > 0 else 0,
+                "errors": self.n_errors,
+                "errors_per_second": ((errors1 - errors0) / dt) if dt > 0 else 0,
+                "files_closed": self.n_files_closed,
+                "totals": dict(self.totals)
+            }
+
+    def _parse_line(self, line, t):
+        # Returns an event record tuple, or None for lines that aren't events
+        if line.startswith("[ERROR]"):
+            chirp = self._chirp(line)
+            error_code = _ERROR_CODE_PATTERN.search(line)
+            self.n_errors += 1
+            return (t, EVENT_ERROR, chirp, 0, self._label(error_code.group(1) if error_code else "OTHER"))
+        elif line.startswith("[TX]") and ("time_offset increased" in line):
+            value = _TIME_OFFSET_PATTERN.search(line)
+            return (t, EVENT_TIME_OFFSET, self._chirp(line), float(value.group(1)) if value else np.nan, -1)
+        elif line.startswith("[CLOSE FILE]"):
+            self.n_files_closed += 1
+            return (t, EVENT_CLOSE_FILE, -1, 0, self._label(line[13:].strip()))
+        elif line.startswith("[OPEN FILE]"):
+            return (t, EVENT_OPEN_FILE, -1, 0, self._label(line[12:].strip()))
+        elif line.startswith("[START]"):
+            self.start_time = t
+            return (t, EVENT_START, -1, 0, -1)
+        elif line.startswith("[RX]"):
+            total = _TOTAL_PATTERN.search(line)
+            if total:
+                self.totals[total.group(1)] = int(total.group(2))
+                return (t, EVENT_TOTAL, -1, int(total.group(2)), self._label(total.group(1)))
+        return None
+
+    def _chirp(self, line):
+        chirp = _CHIRP_PATTERN.search(line)
+        if chirp is None:
+            return -1
+        chirp = int(chirp.group(1))
+        self.last_chirp = max(self.last_chirp, chirp)
+        return chirp
+
+    def _label(self, label):
+        if label not in self.label_idxs:
+            self.label_idxs[label] = len(self.labels)
+            self.labels.append(label)
+        return self.label_idxs[label]
+
+    def _append_events(self, new_events):
+        if len(new_events) == 0:
+            return
+        if self.n_events + len(new_events) > len(self.event_buffer):
+            self.event_buffer = np.resize(self.event_buffer, max(2 * len(self.event_buffer), self.n_events + len(new_events)))
+        self.event_buffer[self.n_events:(self.n_events + len(new_events))] = new_events
+        self.n_events += len(new_events)
+
+    def _pulses_estimate(self):
+        pulses = self.last_chirp + 1
+        if self.pulses_per_file is not None:
+            pulses = max(pulses, self.n_files_closed * self.pulses_per_file + self.n_errors)
+        return pulses
+
+    def _print_line(self, line, event, t):
+        if (event is not None) and (event[1] in (EVENT_ERROR, EVENT_TIME_OFFSET)):
+            self._print_suppressed(t, force=False)
+            if self.errors_printed >= self.max_errors_printed:
+                self.errors_suppressed += 1
+                return
+            self.errors_printed += 1
+        print(line, end="")
+
+    def _print_suppressed(self, t, force=True):
+        if (t - self.print_window_start < self.print_interval) and (not force):
+            return
+        if self.errors_suppressed > 0:
+            print(f"[{t:0.3f}] \t... {self.errors_suppressed} error/time_offset lines not printed (see log file)")
+            sys.stdout.flush()
+        self.print_window_start = t
+        self.errors_printed = 0
+        self.errors_suppressed = 0
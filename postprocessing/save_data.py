@@ -1,4 +1,7 @@
+import os
 import sys
+import json
+import errno
 import shutil
 import argparse
 import numpy as np
@@ -8,6 +11,75 @@ import matplotlib.pyplot as plt
 from datetime import datetime
 from ruamel.yaml import YAML as ym
 
+# Errors from copy_file_range/sendfile that mean the kernel can't copy between
+# these two files, so a different method should be used
+_KERNEL_COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+# Copy the entire contents of the file at src_path to the open (binary, writable)
+# file dst_file, starting at its current position. The copy is done in the kernel
+# with copy_file_range (which can use reflinks or server-side copies) or sendfile
+# where possible, falling back to a regular buffered copy.
+def append_file(src_path, dst_file):
+    dst_file.flush()
+    with open(src_path, 'rb') as src_file:
+        remaining = os.fstat(src_file.fileno()).st_size
+        for copy_function in (getattr(os, "copy_file_range", None), os.sendfile):
+            if copy_function is None:
+                continue
+            try:
+                while remaining > 0:
+                    if copy_function is os.sendfile:
+                        n = os.sendfile(dst_file.fileno(), src_file.fileno(), None, min(remaining, 2**30))
+                    else:
+                        n = copy_function(src_file.fileno(), dst_file.fileno(), min(remaining, 2**30))
+                    if n == 0:
+                        break
+                    remaining -= n
+                if remaining == 0:
+                    return
+            except OSError as e:
+                if e.errno not in _KERNEL_COPY_UNSUPPORTED:
+                    raise
+        shutil.copyfileobj(src_file, dst_file)
+
+# Copy src to dst without copying any data if possible: a hard link is created if
+# both are on the same filesystem, otherwise the data is copied in the kernel.
+# Only use this for sources that are never modified in place afterwards (since a
+# hard link shares the data with the source).
+def link_or_copy(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    with open(dst, 'wb') as dst_file:
+        append_file(src, dst_file)
+    shutil.copymode(src, dst)
+
+# Move src to dst with a rename if both are on the same filesystem, otherwise by
+# copying the data in the kernel and removing src.
+def move_file(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        link_or_copy(src, dst)
+        os.remove(src)
+
+# Write a manifest listing the partial files that make up a recording, in order,
+# as an alternative to concatenating them into a single file.
+def write_manifest(manifest_filename, part_filenames):
+    manifest = {
+        "parts": [os.path.basename(f) for f in part_filenames],
+        "sizes": [os.path.getsize(f) for f in part_filenames],
+    }
+    manifest["total_size"] = sum(manifest["sizes"])
+    with open(manifest_filename, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
 def save_data(yaml_filename, extra_files={}, alternative_rx_samps_loc=None, num_files=1):
     # Initialize Constants
     yaml = ym()
@@ -16,19 +88,26 @@ def save_data(yaml_filename, extra_files={}, alternative_rx_samps_loc=None, num_
 
     file_prefix = datetime.now().strftime("data/%Y%m%d_%H%M%S")
 
-    print(f"Copying data to {file_prefix}...")
+    print(f"Saving data to {file_prefix}...")
 
+    # Data files are moved (or hard linked) into place rather than copied where possible.
+    # Partial files are temporary and are overwritten by the next run, so they're moved.
     shutil.copy(yaml_filename, file_prefix + "_config.yaml")
     if config['FILES']['max_chirps_per_file'] == -1:
-            shutil.move(config['FILES']['save_loc'], file_prefix + "_rx_samps.bin")
+            move_file(config['FILES']['save_loc'], file_prefix + "_rx_samps.bin")
     else:
-        if config['RUN_MANAGER']['save_partial_files']:
+        skip_merge = config['RUN_MANAGER'].get('skip_merge', False)
+        if config['RUN_MANAGER']['save_partial_files'] or skip_merge:
             base_filename = config['FILES']['save_loc']
+            part_filenames = []
             for i in range(num_files):
                 f = base_filename + "." + str(i)
-                shutil.copy(f, file_prefix + "_p" + str(i) + "_rx_samps.bin")
+                part_filenames.append(file_prefix + "_p" + str(i) + "_rx_samps.bin")
+                move_file(f, part_filenames[-1])
+            if skip_merge:
+                write_manifest(file_prefix + "_rx_samps.manifest.json", part_filenames)
         if alternative_rx_samps_loc is not None:
-            shutil.copy(alternative_rx_samps_loc, file_prefix + "_rx_samps.bin")
+            link_or_copy(alternative_rx_samps_loc, file_prefix + "_rx_samps.bin")
 
     for source_file, dest_tag in extra_files.items():
         shutil.copy(source_file, file_prefix + "_" + dest_tag)
@@ -36,7 +115,7 @@ def save_data(yaml_filename, extra_files={}, alternative_rx_samps_loc=None, num_
     if config['RUN_MANAGER']['save_gps']:
         shutil.copy(config['FILES']['gps_loc'], file_prefix + "_gps_log.txt")
 
-    print(f"File copying complete.")
+    print(f"Saving data complete.")
     
     return file_prefix
 
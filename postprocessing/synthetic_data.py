@@ -0,0 +1,158 @@
+import os
+import sys
+import copy
+
+import numpy as np
+from ruamel.yaml import YAML
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from generate_chirp import chirp_to_file_samples
+
+from chirp_cache import chirp_cache
+from phase_codes import sdr_phase_codes
+
+class SyntheticRadar():
+    """
+    Generates synthetic recordings that look like the output of the radar program, for
+    benchmarking and testing the processing code without any hardware.
+
+    The config (for example, loaded from config/synthetic_config.yaml with
+    `processing.load_config`) sets the sample rate, chirp, receive window, cpu_format, and
+    whether phase dithering is used. Each received pulse is the sum of the reference chirp
+    delayed and scaled by each (delay in seconds, amplitude) pair in `echoes`, plus complex
+    white noise with standard deviation `noise_std` (per I/Q component).
+
+    Each chirp has a receive error (ERROR_CODE_LATE_COMMAND) with probability `error_rate`.
+    If `error_data_included` is True, error pulses are written as zeros, like older versions of
+    the radar program. Otherwise nothing is written for them, like the current version.
+
+    If CHIRP:phase_dithering is set, each pulse is modulated by the same pseudorandom phase
+    as the radar program uses for that chirp (see phase_codes.py), without being inverted, so
+    the data can be processed with `processing_dask.invert_phase_dithering`.
+
+    Typical use:
+
+    radar = SyntheticRadar(processing.load_config("config/synthetic_config.yaml"), error_rate=1e-3)
+    radar.record("data/20240101_000000", num_pulses=10000)
+    """
+    def __init__(self, config, echoes=((2e-6, 0.5), (8e-6, 0.05)), noise_std=0.02, error_rate=0.0, error_data_included=True, seed=0):
+        self.config = config
+        self.echoes = echoes
+        self.noise_std = noise_std
+        self.error_rate = error_rate
+        self.error_data_included = error_data_included
+        self.rng = np.random.default_rng(seed)
+
+        self.fs = config['GENERATE']['sample_rate']
+        self.rx_len_samples = int(config['CHIRP']['rx_duration'] * self.fs)
+        self.cpu_format = config['DEVICE'].get('cpu_format', 'fc32')
+        self.phase_dithering = config['CHIRP'].get('phase_dithering', False)
+        self.pulse_rep_int = config['CHIRP']['pulse_rep_int']
+
+        # Noise-free received pulse (echoes past the end of the receive window are truncated)
+        _, chirp = chirp_cache.reference_chirp(config)
+        self.echo = np.zeros(self.rx_len_samples, dtype=np.complex64)
+        for delay_s, amplitude in echoes:
+            start = int(round(delay_s * self.fs))
+            n = min(len(chirp), self.rx_len_samples - start)
+            if n > 0:
+                self.echo[start:(start + n)] += amplitude * chirp[:n]
+
+    def error_chirps(self, num_pulses):
+        """
+        Choose which chirps have errors for a recording of `num_pulses` pulses. Returns the
+        sorted chirp indices with errors and the total number of chirps attempted.
+
+        As in the radar program, `num_pulses` error-free pulses are always collected, so the
+        number of chirps attempted is num_pulses plus the number of errors (unless
+        `error_data_included` is set, in which case num_pulses chirps are attempted in total).
+        """
+        if self.error_data_included:
+            num_attempted = num_pulses
+            error_chirps = np.flatnonzero(self.rng.random(num_attempted) < self.error_rate)
+        else:
+            num_attempted = num_pulses + self.rng.binomial(num_pulses, self.error_rate)
+            error_chirps = np.sort(self.rng.choice(num_attempted, size=num_attempted - num_pulses, replace=False))
+        return error_chirps, num_attempted
+
+    def pulses(self, chirp_idxs, error_mask=None):
+        """
+        Generate the received pulses for each chirp index in `chirp_idxs`, as a complex64
+        array of shape (rx_len_samples, len(chirp_idxs)). Pulses where `error_mask` is True
+        are zeros.
+        """
+        chirp_idxs = np.asarray(chirp_idxs)
+        noise = self.rng.standard_normal((self.rx_len_samples, 2 * len(chirp_idxs)), dtype=np.float32) * self.noise_std
+        pulses = noise.view(np.complex64)
+        if self.phase_dithering:
+            pulses += self.echo[:, np.newaxis] * np.exp(1j * sdr_phase_codes.phases(chirp_idxs)).astype(np.complex64)
+        else:
+            pulses += self.echo[:, np.newaxis]
+        if error_mask is not None:
+            pulses[:, error_mask] = 0
+        return pulses
+
+    def file_samples(self, pulses):
+        """
+        Convert pulses (rx_len_samples, n) to interleaved I/Q samples in the cpu_format of the
+        config, in the order they're written to rx_samps files
+        """
+        pulses = np.ravel(np.transpose(pulses))
+        if self.cpu_format != 'fc32':
+            pulses = np.clip(pulses.real, -1, 1) + 1j * np.clip(pulses.imag, -1, 1)
+        return chirp_to_file_samples(pulses, self.cpu_format)
+
+    def log_lines(self, error_chirps, num_pulses, num_attempted, filenames=(), start_timestamp=1.0):
+        """
+        Return the lines the radar program would have printed to stdout (with the timestamps
+        run.py adds) for a recording with errors on `error_chirps`.
+        """
+        t = lambda chirp: start_timestamp + chirp * self.pulse_rep_int
+        lines = [f"[{t(0):0.3f}] \t[START] Beginning main loop"]
+        lines += [f"[{t(0):0.3f}] \t[OPEN FILE] ../../{filenames[0]}"] if len(filenames) > 0 else []
+        for chirp in error_chirps:
+            lines.append(f"[{t(chirp):0.3f}] \t[ERROR] (Chirp {chirp}) Receiver error: ERROR_CODE_LATE_COMMAND")
+            lines.append(f"[{t(chirp):0.3f}] \t[TX] (Chirp {chirp + 1}) time_offset increased by {2 * self.pulse_rep_int}")
+        lines += [f"[{t(num_attempted):0.3f}] \t[CLOSE FILE] ../../{filename}" for filename in filenames]
+        lines += [
+            f"[{t(num_attempted):0.3f}] \t[RX] Error count: {len(error_chirps)}",
+            f"[{t(num_attempted):0.3f}] \t[RX] Total pulses written: {num_pulses}",
+            f"[{t(num_attempted):0.3f}] \t[RX] Total pulses attempted: {num_attempted}"
+        ]
+        return [line + "\n" for line in lines]
+
+    def record(self, prefix, num_pulses, block_pulses=4096):
+        """
+        Write a synthetic recording of `num_pulses` pulses to `prefix` (the _config.yaml,
+        _rx_samps.bin and _uhd_stdout.log files, as saved by save_data). Pulses are generated
+        and written `block_pulses` at a time, so recordings larger than memory can be made.
+
+        Returns a dictionary with the chirp indices with errors ("error_chirps"), and the number
+        of chirps attempted ("num_attempted") and pulses written ("num_written").
+        """
+        config = copy.deepcopy(self.config) # Don't modify the caller's config
+        config['CHIRP']['num_pulses'] = num_pulses
+        yaml = YAML()
+        with open(prefix + "_config.yaml", 'w') as f:
+            yaml.dump(config, f)
+
+        error_chirps, num_attempted = self.error_chirps(num_pulses)
+        is_error = np.zeros(num_attempted, dtype=bool)
+        is_error[error_chirps] = True
+
+        num_written = 0
+        with open(prefix + "_rx_samps.bin", 'wb') as f:
+            for start in range(0, num_attempted, block_pulses):
+                chirp_idxs = np.arange(start, min(start + block_pulses, num_attempted))
+                if self.error_data_included:
+                    pulses = self.pulses(chirp_idxs, error_mask=is_error[chirp_idxs])
+                else:
+                    pulses = self.pulses(chirp_idxs[~is_error[chirp_idxs]])
+                self.file_samples(pulses).tofile(f)
+                num_written += pulses.shape[1]
+
+        with open(prefix + "_uhd_stdout.log", 'w') as f:
+            f.writelines(self.log_lines(error_chirps, num_pulses, num_attempted,
+                                        filenames=[config['FILES']['save_loc']]))
+
+        return {"error_chirps": error_chirps, "num_attempted": num_attempted, "num_written": num_written}
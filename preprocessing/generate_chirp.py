@@ -1,4 +1,7 @@
+import os
 import sys
+import json
+import hashlib
 import argparse
 import numpy as np
 import scipy.signal
@@ -6,6 +9,9 @@ import scipy.fft
 import matplotlib.pyplot as plt
 from ruamel.yaml import YAML
 
+# Parameters from the GENERATE section of the config that affect the output of generate_chirp
+CHIRP_PARAMETERS = ["chirp_type", "sample_rate", "chirp_bandwidth", "lo_offset_sw", "window", "chirp_length", "pulse_length"]
+
 def generate_chirp(config):
     """
     Generate a chirp according to parameters in the config dictionary, typically
@@ -75,7 +81,58 @@ def generate_chirp(config):
     return ts_zp, chirp_complex
 
 
-def generate_from_yaml_filename(yaml_filename):
+def chirp_file_format(cpu_format):
+    """
+    Return a tuple (output_dtype, scale_factor) describing how chirp samples are
+    stored in a chirp file for the given cpu_format.
+    """
+    if cpu_format == 'fc32':
+        output_dtype = np.float32
+        scale_factor = 1.0
+    elif cpu_format == 'sc16':
+        output_dtype = np.int16
+        scale_factor = np.iinfo(output_dtype).max - 1
+    elif cpu_format == 'sc8':
+        output_dtype = np.int8
+        scale_factor = np.iinfo(output_dtype).max - 1
+    else:
+        raise Exception(f"Unrecognized cpu_format '{cpu_format}'. Must be one of 'fc32', 'sc16', or 'sc8'.")
+    return output_dtype, scale_factor
+
+def chirp_to_file_samples(chirp_complex, cpu_format):
+    """
+    Convert a complex chirp to interleaved I/Q samples in the format expected by
+    the radar code for the given cpu_format.
+    """
+    output_dtype, scale_factor = chirp_file_format(cpu_format)
+
+    # Conversion to integer formats truncates towards zero
+    chirp_floats = np.empty(shape=(2* np.shape(chirp_complex)[0],), dtype=output_dtype)
+    chirp_floats[0::2] = scale_factor * np.real(chirp_complex)
+    chirp_floats[1::2] = scale_factor * np.imag(chirp_complex)
+    return chirp_floats
+
+def _chirp_inputs_hash(config):
+    # Hash of everything that affects the contents of the chirp file
+    inputs = {key: config['GENERATE'].get(key) for key in CHIRP_PARAMETERS}
+    inputs['cpu_format'] = config['DEVICE'].get('cpu_format', 'fc32')
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+def _chirp_sidecar_filename(filename):
+    return filename + ".inputs.json"
+
+def _chirp_file_is_current(filename, inputs_hash):
+    # True if filename was written by generate_from_yaml_filename with the same
+    # inputs and hasn't been modified since
+    try:
+        with open(_chirp_sidecar_filename(filename)) as f:
+            sidecar = json.load(f)
+        stat = os.stat(filename)
+    except (OSError, ValueError):
+        return False
+    return (sidecar.get("inputs_hash") == inputs_hash) and (sidecar.get("size") == stat.st_size) and (sidecar.get("mtime_ns") == stat.st_mtime_ns)
+
+def generate_from_yaml_filename(yaml_filename, force=False):
     """
     Generate a chirp and save it to a binary file, according to parameters loaded
     from the supplied YAML filename.
@@ -83,6 +140,11 @@ def generate_from_yaml_filename(yaml_filename):
     Typically, this function is called to produce a chirp file. The save location
     of this file is specified in the YAML file, under the GENERATE section.
 
+    A sidecar file (out_file + ".inputs.json") records a hash of the parameters
+    the chirp file was generated from. If the parameters haven't changed and the
+    chirp file hasn't been modified since, generation is skipped (unless force
+    is True or show_plot is set).
+
     This function also returns the numpy array written to the file. Note that this
     is different from the chirp_complex array returned by generate_chirp(), as this
     array is in the format that is written to the file (interleaved I/Q samples
@@ -100,6 +162,13 @@ def generate_from_yaml_filename(yaml_filename):
     sample_rate = config['GENERATE']['sample_rate']
 
     cpu_format = config['DEVICE'].get('cpu_format', 'fc32')
+    output_dtype, _ = chirp_file_format(cpu_format)
+
+    inputs_hash = _chirp_inputs_hash(config)
+    if (not force) and (not show_plot) and _chirp_file_is_current(filename, inputs_hash):
+        print("--- Chirp parameters unchanged ---")
+        print("\tUsing existing chirp in %s" % filename)
+        return np.fromfile(filename, dtype=output_dtype)
 
     # Create the chirp
     ts, chirp_complex = generate_chirp(config)
@@ -137,22 +206,7 @@ def generate_from_yaml_filename(yaml_filename):
     # Convert to file 
     print("--- Converting Chirp to File ---")
 
-    if cpu_format == 'fc32':
-        output_dtype = np.float32
-        scale_factor = 1.0
-    elif cpu_format == 'sc16':
-        output_dtype = np.int16
-        scale_factor = np.iinfo(output_dtype).max - 1
-    elif cpu_format == 'sc8':
-        output_dtype = np.int8
-        scale_factor = np.iinfo(output_dtype).max - 1
-    else:
-        raise Exception(f"Unrecognized cpu_format '{cpu_format}'. Must be one of 'fc32', 'sc16', or 'sc8'.")
-
-    chirp_floats = np.empty(shape=(2* np.shape(chirp_complex)[0],), dtype=output_dtype)
-    for x in range(np.shape(chirp_complex)[0]):
-        chirp_floats[2*x] = scale_factor * chirp_complex[x].real
-        chirp_floats[2*x+1] = scale_factor * chirp_complex[x].imag
+    chirp_floats = chirp_to_file_samples(chirp_complex, cpu_format)
 
     chirp_floats.tofile(filename, sep='')
 
@@ -160,6 +214,9 @@ def generate_from_yaml_filename(yaml_filename):
     recov_floats = np.fromfile(filename, dtype=output_dtype, count=-1, sep='', offset=0)
     if np.array_equiv(recov_floats, chirp_floats):
         print("\tChirp successfully stored in %s" % filename)
+        stat = os.stat(filename)
+        with open(_chirp_sidecar_filename(filename), 'w') as f:
+            json.dump({"inputs_hash": inputs_hash, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}, f)
         return chirp_floats
     else:
         print("\t[ERROR] Chirp was not successfully stored in %s" % filename)
@@ -171,10 +228,12 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("yaml_file", nargs='?', default='config/default.yaml',
             help='Path to YAML configuration file')
+    parser.add_argument("--force", action='store_true',
+            help='Regenerate the chirp file even if its parameters are unchanged')
     args = parser.parse_args()
 
     try:
-        generate_from_yaml_filename(args.yaml_file)
+        generate_from_yaml_filename(args.yaml_file, force=args.force)
     except Exception as e:
         print(e)
         sys.exit(1)
@@ -2,7 +2,6 @@ import time
 import argparse
 import os
 import sys
-import shutil
 import subprocess
 import signal
 import threading
@@ -12,7 +11,10 @@ from ruamel.yaml import YAML
 sys.path.append("preprocessing")
 from generate_chirp import generate_from_yaml_filename
 sys.path.append("postprocessing")
-from save_data import save_data
+from save_data import save_data, append_file
+from live_zarr import LiveZarrConverter
+from quicklook import QuickLookRadargram
+from radar_output import RadarOutputReader
 
 """
 Provides a simple interface to build, run, and manage data outputs from the SDR code
@@ -46,34 +48,55 @@ class RadarProcessRunner():
         self.output_file = None
         self.output_file_path = None
 
+        self.live_converter = None
+        self.quicklook = None
+        self.output_reader = None
+
     """
     Manage the stdout of the radar program, including logging it to a file and optionally sending it for additional processing
+    (Output is read, logged, and printed in batches by RadarOutputReader so that bursts of errors can't back up the pipe)
     """
     def process_usrp_output(self, out, file_out, also_print=True):
-        for line in iter(out.readline, ''):
-            # Save output to specified file with timestamp
-            t = time.time()
-            file_out.write(f"[{t:0.3f}] \t{line}")
-
-            # If provided, pass output to external function for processing
-            if self.log_processing_function is not None:
-                self.log_processing_function(line)
-
-            # If specified, also print to stdout
-            if also_print:
-                print(f"[{t:0.3f}] \t{line}", end="")
-
-            # Enqueue for saving somewhere else
-            if line.startswith("[CLOSE FILE]"):
-                filename = (line[13:]).strip()
-                if filename.startswith("../../"): # Automatically added to escape cwd of binary
-                    filename = filename[6:] # Strip it out
-                self.file_queue.put(filename)
-
-        out.close()
-        file_out.close()
+        max_chirps_per_file = self.config['FILES']['max_chirps_per_file']
+        self.output_reader = RadarOutputReader(file_out, also_print=also_print,
+            line_callback=self.process_usrp_output_line, close_file_callback=self.enqueue_closed_file,
+            pulses_per_file=(max_chirps_per_file if max_chirps_per_file > 0 else None))
+        self.output_reader.read(out)
         self.file_queue_size = self.file_queue.qsize()
 
+    def process_usrp_output_line(self, line):
+        # If provided, pass output to external function for processing
+        if self.log_processing_function is not None:
+            self.log_processing_function(line)
+
+        if self.live_converter is not None:
+            self.live_converter.process_log_line(line)
+
+        if (self.quicklook is not None) and line.startswith("[OPEN FILE]"):
+            self.quicklook.tail_file(self.strip_binary_path(line[12:].strip()))
+
+    def strip_binary_path(self, filename):
+        if filename.startswith("../../"): # Automatically added to escape cwd of binary
+            filename = filename[6:] # Strip it out
+        return filename
+
+    def enqueue_closed_file(self, filename):
+        # Enqueue for saving somewhere else
+        filename = self.strip_binary_path(filename)
+        self.file_queue.put(filename)
+        if self.live_converter is not None:
+            self.live_converter.add_file(filename)
+        if self.quicklook is not None:
+            self.quicklook.add_file(filename)
+
+    """
+    Live counters from the radar program's output (see RadarOutputReader.stats), or None if it isn't running
+    """
+    def health(self):
+        if self.output_reader is None:
+            return None
+        return self.output_reader.stats()
+
     """
     Build the radar program, generate the chirp, and get ready to run
     """
@@ -111,13 +134,22 @@ class RadarProcessRunner():
                 print(f"Running '{cmd}' produced non-zero return value {retval}. Quitting...")
                 exit(1)
 
-        os.chdir("sdr/build")
-        run_and_fail_on_nonzero("cmake ..")
-        run_and_fail_on_nonzero("make")
-        os.chdir("../..")
+        # (Not needed if another program, like the simulator, is used instead)
+        if self.radar_binary() == "./radar":
+            os.chdir("sdr/build")
+            run_and_fail_on_nonzero("cmake ..")
+            run_and_fail_on_nonzero("make")
+            os.chdir("../..")
 
         self.setup_complete = True
 
+    """
+    Path (relative to sdr/build) of the radar program to run: ./radar, unless RUN_MANAGER:radar_binary
+    is set (for example, to ../simulated_radar.py to run without hardware)
+    """
+    def radar_binary(self):
+        return self.config['RUN_MANAGER'].get('radar_binary') or "./radar"
+
     """
     Start the radar program
     """
@@ -125,7 +157,18 @@ class RadarProcessRunner():
         if not self.setup_complete:
             raise Exception("Must call setup() before calling run(). If setup() does not complete successfully, you cannot call run().")
         
-        self.uhd_process = subprocess.Popen(["./radar", self.yaml_filename], stdout=subprocess.PIPE, bufsize=1, close_fds=True, text=True, cwd="sdr/build")
+        # Optionally convert each partial file to zarr as soon as it's closed
+        if self.config['RUN_MANAGER'].get('live_zarr_loc') is not None:
+            self.live_converter = LiveZarrConverter(self.config, self.config['RUN_MANAGER']['live_zarr_loc'])
+            self.live_converter.start()
+
+        # Optionally render a quick-look radargram while recording
+        if self.config['RUN_MANAGER'].get('quicklook_loc') is not None:
+            self.quicklook = QuickLookRadargram(self.config, self.config['RUN_MANAGER']['quicklook_loc'],
+                n_stack=self.config['RUN_MANAGER'].get('quicklook_n_stack', 100))
+            self.quicklook.start()
+
+        self.uhd_process = subprocess.Popen([self.radar_binary(), self.yaml_filename], stdout=subprocess.PIPE, bufsize=1, close_fds=True, text=True, cwd="sdr/build")
         self.uhd_output_reader_thread = threading.Thread(target=self.process_usrp_output, args=(self.uhd_process.stdout, open('uhd_stdout.log', 'w'), self.output_to_stdout))
         self.uhd_output_reader_thread.daemon = True # thread dies with the program
         self.uhd_output_reader_thread.start()
@@ -165,17 +208,38 @@ class RadarProcessRunner():
 
         self.uhd_output_reader_thread.join()
 
+        # Wait for any remaining files to be converted to zarr (before they are moved or merged)
+        if self.live_converter is not None:
+            print("Waiting for live zarr conversion to finish...")
+            self.live_converter.finish()
+
+        if self.quicklook is not None:
+            print("Rendering final quick-look radargram...")
+            self.quicklook.finish()
+            print(f"Quick-look radargram saved to {self.quicklook.png_path}")
+            self.quicklook = None
+
         # If necessary, concatenate data files into a single file
+        # (unless skip_merge is set, in which case save_data writes a manifest of the partial files instead)
         alternative_rx_samps_loc = None
-        if (self.config['RUN_MANAGER']['final_save_loc'] is not None) and (self.config['FILES']['max_chirps_per_file'] != -1):
+        if (self.config['RUN_MANAGER']['final_save_loc'] is not None) and (self.config['FILES']['max_chirps_per_file'] != -1) and (not self.config['RUN_MANAGER'].get('skip_merge', False)):
             print("Calling save_from_queue()")
             self.save_from_queue()
             alternative_rx_samps_loc = self.output_file_path
 
         # Save output
-        print("Copying data files...")
+        print("Saving data files...")
         file_prefix = save_data(self.yaml_filename, alternative_rx_samps_loc=alternative_rx_samps_loc, num_files=self.file_queue_size, extra_files={"uhd_stdout.log": "uhd_stdout.log"})
-        print("Finished copying data.")
+        print("Finished saving data.")
+
+        if self.live_converter is not None:
+            with open("uhd_stdout.log", "r") as f:
+                zarr_path = self.live_converter.save(file_prefix, stdout_log=f.read())
+            if zarr_path is not None:
+                print(f"Live zarr dataset saved to {zarr_path}")
+            elif self.live_converter.failed:
+                print("[WARNING] Live zarr conversion failed. Use processing_dask.save_radar_data_to_zarr on the saved data instead.")
+            self.live_converter = None
 
         self.output_file = None
 
@@ -187,11 +251,13 @@ class RadarProcessRunner():
     def save_from_queue(self):
         if self.output_file is None:
             self.output_file_path = self.config['RUN_MANAGER']['final_save_loc']
+            # Remove any old file first, rather than truncating it, in case it's hard linked to saved data
+            if os.path.exists(self.output_file_path):
+                os.remove(self.output_file_path)
             self.output_file = open(self.output_file_path, 'wb')
 
         while(not self.file_queue.empty()):
-            with open(self.file_queue.get(), 'rb') as f:
-                shutil.copyfileobj(f, self.output_file)
+            append_file(self.file_queue.get(), self.output_file)
 
         self.output_file.close()
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import signal
+import argparse
+import numpy as np
+from ruamel.yaml import YAML
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "postprocessing"))
+from synthetic_data import SyntheticRadar
+
+"""
+Hardware-free stand-in for the radar program (sdr/build/radar), for testing and load-testing
+run.py and the UAV payload manager without a USRP.
+
+It's run the same way as the real program -- from sdr/build, with the path to the YAML config
+relative to the root of the repository -- and behaves the same way as far as the Python side
+can tell:
+- received pulses are written to FILES:save_loc, or to the rotated save_loc.N files if
+  FILES:max_chirps_per_file is set, at the rate set by CHIRP:pulse_rep_int and num_presums
+  (after CHIRP:time_offset), in DEVICE:cpu_format
+- the same stdout lines are printed ([OPEN FILE], [START], [ERROR] (Chirp N) Receiver error: ...,
+  [TX] ... time_offset increased by ..., [CLOSE FILE], and the [RX] totals at the end)
+- nothing is written for error pulses, and num_pulses error-free pulses are collected
+- on SIGINT, it stops after the current pulses, closes the file, and prints the totals
+
+Errors (ERROR_CODE_LATE_COMMAND) are injected on each chirp with probability SIMULATOR:error_rate.
+If SIMULATOR:realtime is False, pulses are produced as fast as possible instead of being paced.
+Both can be overridden from the command line.
+
+To use it from run.py or uav_payload_manager.py, set RUN_MANAGER:radar_binary to
+"../simulated_radar.py".
+
+Unlike the real program, cpu_formats other than fc32 are accepted. Pulses are taken from a
+small pool of pre-generated synthetic pulses (see postprocessing/synthetic_data.py), so the
+cost of producing them is negligible next to writing them.
+"""
+
+stop_signal_called = False
+
+def sig_int_handler(signum, frame):
+    global stop_signal_called
+    stop_signal_called = True
+
+class SimulatedRadar():
+    def __init__(self, config, error_rate=0.0, realtime=True, seed=0, pool_size=256):
+        self.config = config
+        self.error_rate = error_rate
+        self.realtime = realtime
+        self.rng = np.random.default_rng(seed)
+
+        self.pulse_rep_int = config['CHIRP']['pulse_rep_int']
+        self.time_offset = config['CHIRP']['time_offset']
+        self.num_pulses = config['CHIRP']['num_pulses']
+        self.num_presums = config['CHIRP'].get('num_presums', 1)
+        self.max_chirps_per_file = config['FILES']['max_chirps_per_file']
+        self.save_loc = self.binary_path(config['FILES']['save_loc'])
+        self.gps_save_loc = self.binary_path(config['FILES']['gps_loc'])
+
+        # The radar program inverts phase dithering before writing, so the pulses written aren't dithered
+        synthetic_radar = SyntheticRadar(config, seed=seed)
+        synthetic_radar.phase_dithering = False
+        self.pool = synthetic_radar.file_samples(synthetic_radar.pulses(np.arange(pool_size))).tobytes()
+        self.pool_size = pool_size
+        self.bytes_per_pulse = len(self.pool) // pool_size
+
+        self.pulses_received = 0 # Chirps attempted so far
+        self.error_count = 0
+        self.successes = 0 # Error-free chirps so far
+        self.last_pulse_num_written = 0
+        self.error_delay = 0 # Total increase in time_offset after errors
+        self.save_file_index = 0
+        self.outfile = None
+        self.current_filename = None
+
+    def binary_path(self, filename):
+        # Relative paths are relative to the root of the repo, like in the radar program
+        if filename[0] != '/':
+            filename = "../../" + filename
+        return filename
+
+    def emit(self, lines):
+        sys.stdout.write("".join([line + "\n" for line in lines]))
+        sys.stdout.flush()
+
+    def open_file(self):
+        self.current_filename = self.save_loc
+        if self.max_chirps_per_file > 0:
+            self.current_filename = self.current_filename + "." + str(self.save_file_index)
+        self.emit([f"[OPEN FILE] {self.current_filename}"])
+        self.outfile = open(self.current_filename, 'wb')
+
+    def write_pulses(self, n):
+        for i in range(self.last_pulse_num_written, self.last_pulse_num_written + n):
+            offset = (i % self.pool_size) * self.bytes_per_pulse
+            self.outfile.write(self.pool[offset:(offset + self.bytes_per_pulse)])
+        self.last_pulse_num_written += n
+
+    def chirp_time(self, chirp):
+        # Time (relative to the start) at which a chirp's receive window ends
+        return self.time_offset + self.error_delay + (chirp + 1) * self.pulse_rep_int
+
+    def run(self):
+        open(self.gps_save_loc, 'wb').close()
+        self.open_file()
+        if self.num_pulses < 0:
+            self.emit(["num_pulses is < 0. Will continue to send chirps until stopped with Ctrl-C."])
+        self.emit(["[START] Beginning main loop"])
+
+        t0 = time.time()
+        max_block = max(1, int(0.05 / self.pulse_rep_int)) # At most 50 ms of chirps at a time
+        while (self.num_pulses < 0) or (self.last_pulse_num_written < self.num_pulses):
+            # Chirps that have finished by now
+            if self.realtime:
+                due = int((time.time() - t0 - self.time_offset - self.error_delay) / self.pulse_rep_int) - self.pulses_received
+                if due < 1:
+                    time.sleep(min(max(self.chirp_time(self.pulses_received) - (time.time() - t0), 0), 0.05))
+                    if stop_signal_called:
+                        self.emit(["[RX] Reached stop signal handling for outer RX loop -> break"])
+                        break
+                    continue
+                n = min(due, max_block)
+            else:
+                n = max_block
+
+            self.process_chirps(n)
+
+            if stop_signal_called:
+                self.emit(["[RX] Reached stop signal handling for outer RX loop -> break"])
+                break
+
+        self.emit(["[RX] Closing output file."])
+        self.outfile.close()
+        self.emit([
+            f"[CLOSE FILE] {self.current_filename}",
+            f"[RX] Error count: {self.error_count}",
+            f"[RX] Total pulses written: {self.last_pulse_num_written}",
+            f"[RX] Total pulses attempted: {self.pulses_received}",
+            "[RX] Done. Calling join_all() on transmit thread group.",
+            "[TX] Done.",
+            "[RX] transmit_thread.join_all() complete.",
+            ""
+        ])
+
+    def process_chirps(self, n):
+        # Receive up to n chirps, stopping early after the pulse that fills a file or completes the recording
+        is_error = self.rng.random(n) < self.error_rate
+        written = (self.successes + np.cumsum(~is_error)) // self.num_presums # last_pulse_num_written after each chirp
+        stop_after = np.zeros(n, dtype=bool)
+        if self.max_chirps_per_file > 0:
+            stop_after |= (written // self.max_chirps_per_file) > self.save_file_index
+        if self.num_pulses >= 0:
+            stop_after |= written >= self.num_pulses
+        if np.any(stop_after):
+            n = np.argmax(stop_after) + 1
+            is_error = is_error[:n]
+            written = written[:n]
+
+        lines = []
+        for i in np.flatnonzero(is_error):
+            chirp = self.pulses_received + i
+            lines.append(f"[ERROR] (Chirp {chirp}) Receiver error: ERROR_CODE_LATE_COMMAND")
+            lines.append(f"[TX] (Chirp {chirp + 7}) time_offset increased by {2 * self.pulse_rep_int}")
+        self.emit(lines)
+
+        self.write_pulses(written[-1] - self.last_pulse_num_written)
+        self.pulses_received += n
+        self.error_count += np.sum(is_error)
+        self.successes += n - np.sum(is_error)
+        self.error_delay += 2 * self.pulse_rep_int * np.sum(is_error)
+
+        if (self.max_chirps_per_file > 0) and (self.last_pulse_num_written // self.max_chirps_per_file > self.save_file_index):
+            self.outfile.close()
+            self.emit([f"[CLOSE FILE] {self.current_filename}"])
+            self.save_file_index += 1
+            self.open_file()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("yaml_file", nargs='?', default='config/default.yaml',
+            help='Path to YAML configuration file (relative to the root of the repository)')
+    parser.add_argument("--error_rate", type=float, default=None,
+            help='Probability of an error on each chirp (overrides SIMULATOR:error_rate)')
+    parser.add_argument("--fast", action='store_true',
+            help='Produce pulses as fast as possible instead of at pulse_rep_int (overrides SIMULATOR:realtime)')
+    args = parser.parse_args()
+
+    yaml_filename = "../../" + args.yaml_file
+    print(f"Reading from config file: {yaml_filename}")
+    with open(yaml_filename) as stream:
+        config = YAML().load(stream)
+
+    simulator_config = config.get('SIMULATOR') or {}
+    error_rate = args.error_rate if args.error_rate is not None else simulator_config.get('error_rate', 0.0)
+    realtime = (not args.fast) and simulator_config.get('realtime', True)
+
+    print("[VERSION] 0.0.1")
+    print("Note: This is a simulation. No hardware is used.")
+    print("Note: Nothing is written to the file for error pulses.")
+
+    signal.signal(signal.SIGINT, sig_int_handler)
+    SimulatedRadar(config, error_rate=error_rate, realtime=realtime, seed=simulator_config.get('seed', 0)).run()
+
+    # Exit right away, like the real program, rather than spending a noticeable fraction of a
+    # second tearing down the interpreter (which would be counted as stop latency)
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,186 @@
+import time
+import argparse
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import xarray as xr
+import dask
+
+sys.path.append("preprocessing")
+sys.path.append("postprocessing")
+import processing
+import processing_dask
+from chirp_cache import chirp_cache
+from synthetic_data import SyntheticRadar
+
+# Benchmarks for the processing code, run on synthetic recordings (see postprocessing/synthetic_data.py)
+#
+# Each benchmark is timed `repeats` times, then run once more with tracemalloc to find the
+# peak memory allocated while it runs (memory mapped files aren't counted). Results are saved
+# as JSON in tests/data/benchmarks/ along with the git commit, so they can be compared between
+# commits with --compare.
+#
+# Usage (from the root of the repository):
+#   python tests/benchmark_processing.py --sizes small medium --formats fc32 sc16 sc8
+#   python tests/benchmark_processing.py --compare tests/data/benchmarks/<earlier results>.json
+
+SIZES = {"small": 2000, "medium": 20000, "large": 100000} # Number of pulses
+
+def measure(fn, repeats=3):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"times_s": times, "min_s": min(times), "median_s": float(np.median(times)), "peak_mb": peak / 2**20}
+
+def benchmark_cases(prefix, config, output_dir, n_stack):
+    # Returns a list of (name, function) pairs to benchmark for the recording at prefix
+    zarr_path = processing_dask.save_radar_data_to_zarr(prefix, skip_if_cached=False)
+    data = xr.open_zarr(zarr_path)
+    _, chirp = chirp_cache.reference_chirp(config)
+    fs = config['GENERATE']['sample_rate']
+    duration_s = len(data["pulse_idx"]) * config['CHIRP']['pulse_rep_int']
+
+    cases = [
+        ("load_radar_window", lambda: processing.load_radar_window(prefix, start_s=duration_s/4, end_s=3*duration_s/4)),
+        ("stack_from_file", lambda: sum(1 for _ in processing.stack_from_file(prefix + "_rx_samps.bin", len(data["sample_idx"]), n_stack, config['DEVICE']['cpu_format']))),
+        ("save_radar_data_to_zarr", lambda: processing_dask.save_radar_data_to_zarr(prefix, skip_if_cached=False, zarr_base_location=output_dir)),
+        ("fill_errors", lambda: processing_dask.fill_errors(data)["radar_data"].compute()),
+        ("remove_errors", lambda: processing_dask.remove_errors(data)["radar_data"].compute()),
+        ("stack", lambda: processing_dask.stack(data, n_stack)["radar_data"].compute()),
+        ("stack_statistics", lambda: processing_dask.stack_statistics(data, [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000])),
+        ("pulse_compress", lambda: processing_dask.pulse_compress(data, chirp, fs)["radar_data"].compute()),
+        ("slow_time_welch", lambda: processing_dask.slow_time_welch(data, nperseg=256)["psd"].compute()),
+    ]
+    if config['DEVICE']['cpu_format'] == 'fc32':
+        # load_radar_data always reads the recording as fc32
+        cases.insert(0, ("load_radar_data", lambda: processing.load_radar_data(prefix)))
+    if config['CHIRP'].get('phase_dithering', False):
+        cases.append(("invert_phase_dithering", lambda: processing_dask.invert_phase_dithering(data)["radar_data"].compute()))
+    return cases
+
+def git_commit():
+    commit = os.popen('git rev-parse HEAD').read().strip()
+    dirty = os.popen('git status --porcelain --untracked-files=no').read().strip() != ""
+    return commit + ("-dirty" if dirty else "")
+
+def compare(results, baseline_filename, threshold):
+    # Print the change in time and memory for every benchmark also in the baseline.
+    # Returns the number of regressions (more than `threshold` slower or larger).
+    with open(baseline_filename) as f:
+        baseline = json.load(f)
+    key = lambda r: (r["case"], r["cpu_format"], r["num_pulses"])
+    baseline_results = {key(r): r for r in baseline["results"]}
+
+    print(f"Comparing to {baseline_filename} (commit {baseline['commit']})")
+    n_regressions = 0
+    for r in results:
+        if key(r) not in baseline_results:
+            continue
+        b = baseline_results[key(r)]
+        time_ratio = r["median_s"] / b["median_s"]
+        memory_ratio = r["peak_mb"] / max(b["peak_mb"], 1e-3)
+        regression = (time_ratio > 1 + threshold) or (memory_ratio > 1 + threshold)
+        n_regressions += regression
+        print(f"{r['case']:<25} {r['cpu_format']:<5} {r['num_pulses']:>8} \t" +
+              f"time: {b['median_s']:8.3f} s -> {r['median_s']:8.3f} s ({time_ratio:5.2f}x) \t" +
+              f"peak memory: {b['peak_mb']:8.1f} MB -> {r['peak_mb']:8.1f} MB ({memory_ratio:5.2f}x)" +
+              ("\t[REGRESSION]" if regression else ""))
+    return n_regressions
+
+if __name__ == "__main__":
+
+    # Check for correct working directory
+    expected_cwd = os.popen('git rev-parse --show-toplevel').read().strip() # Root of git repo
+    if os.getcwd() != expected_cwd:
+        raise Exception(f"This script should ONLY be run from {expected_cwd}. Detected CWD {os.getcwd()}")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("yaml_file", nargs='?', default='config/synthetic_config.yaml',
+            help='Path to YAML configuration file used to synthesize recordings')
+    parser.add_argument("--sizes", nargs='+', default=["small"], choices=list(SIZES.keys()),
+            help='Recording sizes to benchmark')
+    parser.add_argument("--formats", nargs='+', default=["fc32", "sc16", "sc8"], choices=["fc32", "sc16", "sc8"],
+            help='cpu_format of the synthetic recordings')
+    parser.add_argument("--cases", nargs='+', default=None,
+            help='Only run these benchmarks (by name). By default, all are run.')
+    parser.add_argument("--repeats", type=int, default=3, help='Number of timed runs of each benchmark')
+    parser.add_argument("--error_rate", type=float, default=1e-3, help='Probability of a late command error on each chirp')
+    parser.add_argument("--no_phase_dithering", action='store_true', help='Synthesize recordings without phase dithering')
+    parser.add_argument("--n_stack", type=int, default=10, help='Number of pulses to stack')
+    parser.add_argument("--scheduler", default="threads", choices=["threads", "processes", "single-threaded"],
+            help='dask scheduler used for the processing_dask benchmarks')
+    parser.add_argument("--tmp_dir", default=None, help='Where to write the synthetic recordings (default: a new temporary directory)')
+    parser.add_argument("--output_dir", default="tests/data/benchmarks", help='Where to save the results')
+    parser.add_argument("--compare", default=None, help='Results file from an earlier run to compare against')
+    parser.add_argument("--threshold", type=float, default=0.2,
+            help='Relative increase in time or peak memory reported as a regression by --compare')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    results = []
+    try:
+        for size in args.sizes:
+            for cpu_format in args.formats:
+                num_pulses = SIZES[size]
+                config = processing.load_config(args.yaml_file, {
+                    "DEVICE": {"cpu_format": cpu_format},
+                    "CHIRP": {"phase_dithering": not args.no_phase_dithering}
+                })
+
+                prefix = os.path.join(tmp_dir, "20000101_000000")
+                print(f"Synthesizing {num_pulses} {cpu_format} pulses...")
+                SyntheticRadar(config, error_rate=args.error_rate).record(prefix, num_pulses)
+                data_mb = os.path.getsize(prefix + "_rx_samps.bin") / 2**20
+
+                with dask.config.set(scheduler=args.scheduler):
+                    for case, fn in benchmark_cases(prefix, config, os.path.join(tmp_dir, "output"), args.n_stack):
+                        if (args.cases is not None) and (case not in args.cases):
+                            continue
+                        result = measure(fn, args.repeats)
+                        result.update({"case": case, "cpu_format": cpu_format, "num_pulses": num_pulses, "data_mb": data_mb})
+                        results.append(result)
+                        print(f"{case:<25} {cpu_format:<5} {num_pulses:>8} \t{result['median_s']:8.3f} s " +
+                              f"({data_mb / result['median_s']:8.1f} MB/s) \tpeak memory: {result['peak_mb']:8.1f} MB")
+
+                for filename in os.listdir(tmp_dir):
+                    path = os.path.join(tmp_dir, filename)
+                    shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    # Save results
+    commit = git_commit()
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_path = os.path.join(args.output_dir, f"{time.strftime('%Y%m%d_%H%M%S')}_{commit[:8]}_benchmark.json")
+    with open(results_path, 'w') as f:
+        json.dump({
+            "commit": commit,
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "dask": dask.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+            "results": results
+        }, f, indent=2)
+    print(f"Results saved to: {results_path}")
+
+    if args.compare is not None:
+        n_regressions = compare(results, args.compare, args.threshold)
+        if n_regressions > 0:
+            print(f"{n_regressions} regression(s) found")
+            exit(1)
@@ -0,0 +1,112 @@
+import time
+import argparse
+import glob
+import os
+import sys
+import json
+import threading
+from ruamel.yaml import YAML
+
+sys.path.append(".")
+from run import RadarProcessRunner
+from benchmark_processing import git_commit
+
+# Load test for run.py, using the simulated radar program (sdr/simulated_radar.py) instead of
+# a USRP. Runs a recording for `duration` seconds and measures:
+# - throughput: pulses and stdout lines per second handled by the runner while recording
+# - stop latency: time from calling RadarProcessRunner.stop() to the radar program exiting
+# - finalization time: the rest of stop() (merging files, saving data, and so on)
+#
+# The recording is saved to data/ like any other run, and deleted afterwards unless --keep
+# is set. Results are saved as JSON in tests/data/benchmarks/.
+#
+# Usage (from the root of the repository):
+#   python tests/benchmark_run_manager.py --duration 30 --pulse_rep_int 100e-6 --error_rate 1e-3
+
+if __name__ == "__main__":
+
+    # Check for correct working directory
+    expected_cwd = os.popen('git rev-parse --show-toplevel').read().strip() # Root of git repo
+    if os.getcwd() != expected_cwd:
+        raise Exception(f"This script should ONLY be run from {expected_cwd}. Detected CWD {os.getcwd()}")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("yaml_file", nargs='?', default='config/default.yaml',
+            help='Path to YAML configuration file to start from')
+    parser.add_argument("--duration", type=float, default=10, help='How long to record for [s]')
+    parser.add_argument("--pulse_rep_int", type=float, default=None, help='Override CHIRP:pulse_rep_int [s]')
+    parser.add_argument("--error_rate", type=float, default=0.0, help='Probability of an error on each chirp')
+    parser.add_argument("--max_chirps_per_file", type=int, default=None, help='Override FILES:max_chirps_per_file')
+    parser.add_argument("--keep", action='store_true', help='Keep the saved recording')
+    parser.add_argument("--output_dir", default="tests/data/benchmarks", help='Where to save the results')
+    args = parser.parse_args()
+
+    # Config for the simulated radar (the path must be relative to the root of the repo)
+    yaml = YAML()
+    with open(args.yaml_file) as stream:
+        config = yaml.load(stream)
+    config['CHIRP']['num_pulses'] = -1 # Record until stopped
+    if args.pulse_rep_int is not None:
+        config['CHIRP']['pulse_rep_int'] = args.pulse_rep_int
+    if args.max_chirps_per_file is not None:
+        config['FILES']['max_chirps_per_file'] = args.max_chirps_per_file
+    config['RUN_MANAGER']['radar_binary'] = "../simulated_radar.py"
+    config['SIMULATOR'] = {"error_rate": args.error_rate, "realtime": True}
+    yaml_filename = "tests/data/benchmark_run_manager.yaml.tmp"
+    with open(yaml_filename, 'w') as f:
+        yaml.dump(config, f)
+
+    runner = RadarProcessRunner(yaml_filename, output_to_stdout=False)
+    runner.setup()
+    runner.run()
+
+    # Wait until the simulated radar starts receiving, then record for the requested duration
+    while (runner.health() is None) or (runner.health()["elapsed_s"] == 0):
+        time.sleep(0.1)
+    time.sleep(args.duration)
+    stats = runner.health()
+
+    # Watch for the process exiting while stop() runs
+    exit_time = []
+    def watch_process():
+        while runner.uhd_process.poll() is None:
+            time.sleep(0.001)
+        exit_time.append(time.time())
+    watcher = threading.Thread(target=watch_process)
+    watcher.daemon = True
+    watcher.start()
+
+    t_stop = time.time()
+    file_prefix = runner.stop()
+    t_done = time.time()
+    watcher.join()
+
+    totals = runner.output_reader.stats()["totals"]
+    saved_files = glob.glob(file_prefix + "_*")
+    saved_mb = sum(os.path.getsize(f) for f in saved_files if os.path.isfile(f)) / 2**20
+
+    result = {
+        "duration_s": stats["elapsed_s"],
+        "pulses_per_second": stats["pulses_per_second"],
+        "lines_per_second": stats["lines"] / stats["elapsed_s"],
+        "errors": totals.get("Error count"),
+        "pulses_written": totals.get("Total pulses written"),
+        "pulses_attempted": totals.get("Total pulses attempted"),
+        "stop_latency_s": exit_time[0] - t_stop,
+        "finalization_s": t_done - exit_time[0],
+        "saved_mb": saved_mb
+    }
+    for key, value in result.items():
+        print(f"{key:<20} {value}")
+
+    if not args.keep:
+        for f in saved_files:
+            os.remove(f)
+    os.remove(yaml_filename)
+
+    commit = git_commit()
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_path = os.path.join(args.output_dir, f"{time.strftime('%Y%m%d_%H%M%S')}_{commit[:8]}_run_manager.json")
+    with open(results_path, 'w') as f:
+        json.dump({"commit": commit, "timestamp": time.time(), "args": vars(args), "result": result}, f, indent=2)
+    print(f"Results saved to: {results_path}")
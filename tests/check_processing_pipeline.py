@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import xarray as xr
+
+sys.path.append("preprocessing")
+sys.path.append("postprocessing")
+import processing
+import processing_dask
+from chirp_cache import chirp_cache
+from synthetic_data import SyntheticRadar
+
+# Checks that ProcessingPipeline gives the same result as calling the individual
+# processing_dask functions one after another, on a synthetic recording with errors
+# (see postprocessing/synthetic_data.py). This includes data that already contains NaNs,
+# like a dataset saved after fill_errors.
+#
+# Usage (from the root of the repository):
+#   python tests/check_processing_pipeline.py
+
+def chained(data, stages):
+    # Apply each stage with the function of the same name
+    for name, kwargs in stages:
+        data = getattr(processing_dask, name)(data, **kwargs)
+    return data
+
+def check(name, data, stages):
+    expected = chained(data, stages)["radar_data"].values
+    result = processing_dask.ProcessingPipeline(stages).apply(data)["radar_data"].values
+    matches = (expected.shape == result.shape) and np.allclose(result, expected, rtol=1e-4, atol=1e-6, equal_nan=True)
+    print(f"{name:<45} {'OK' if matches else 'MISMATCH'}")
+    return matches
+
+if __name__ == "__main__":
+
+    # Check for correct working directory
+    expected_cwd = os.popen('git rev-parse --show-toplevel').read().strip() # Root of git repo
+    if os.getcwd() != expected_cwd:
+        raise Exception(f"This script should ONLY be run from {expected_cwd}. Detected CWD {os.getcwd()}")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("yaml_file", nargs='?', default='config/synthetic_config.yaml',
+            help='Path to YAML configuration file used to synthesize the recording')
+    parser.add_argument("--num_pulses", type=int, default=2000, help='Number of pulses in the recording')
+    parser.add_argument("--error_rate", type=float, default=0.02, help='Probability of a late command error on each chirp')
+    parser.add_argument("--n_stack", type=int, default=10, help='Number of pulses to stack')
+    args = parser.parse_args()
+
+    config = processing.load_config(args.yaml_file, {"CHIRP": {"phase_dithering": True}})
+    _, chirp = chirp_cache.reference_chirp(config)
+    fs = config['GENERATE']['sample_rate']
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(tmp_dir, "20000101_000000")
+        SyntheticRadar(config, error_rate=args.error_rate).record(prefix, args.num_pulses)
+        raw = xr.open_zarr(processing_dask.save_radar_data_to_zarr(prefix, zarr_base_location=tmp_dir))
+
+        stack = ("stack", {"n_stack": args.n_stack})
+        compress = ("pulse_compress", {"chirp": chirp, "fs": fs})
+        dither = ("invert_phase_dithering", {})
+
+        # The same data with NaNs already filled in, like a dataset saved after fill_errors
+        filled = processing_dask.fill_errors(raw)
+        filled_path = os.path.join(tmp_dir, "filled.zarr")
+        filled.to_zarr(filled_path)
+        filled = xr.open_zarr(filled_path)
+
+        results = [
+            check("fill_errors, stack, pulse_compress", raw, [("fill_errors", {}), stack, compress]),
+            check("remove_errors, invert, stack, pulse_compress", raw, [("remove_errors", {}), dither, stack, compress]),
+            check("fill_errors, invert, stack", raw, [("fill_errors", {}), dither, stack]),
+            check("(NaN-filled data) stack, pulse_compress", filled, [stack, compress]),
+            check("(NaN-filled data) invert, stack", filled, [dither, stack]),
+        ]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if not all(results):
+        print(f"{len(results) - sum(results)} check(s) failed")
+        exit(1)
@@ -0,0 +1,120 @@
+import argparse
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+import xarray as xr
+
+sys.path.append("preprocessing")
+sys.path.append("postprocessing")
+import processing
+import processing_dask
+from live_zarr import LiveZarrConverter
+from synthetic_data import SyntheticRadar
+
+# Checks that zarr stores built in pieces end up the same as ones built by
+# save_radar_data_to_zarr, on a synthetic recording with errors (see
+# postprocessing/synthetic_data.py).
+#
+# Usage (from the root of the repository):
+#   python tests/check_zarr_stores.py
+
+def check(name, passed):
+    print(f"{name:<55} {'OK' if passed else 'FAILED'}")
+    return passed
+
+def check_add_stdout_log(tmp_dir, prefix):
+    # add_stdout_log_to_zarr must keep the existing attributes (i.e. config)
+    zarr_path = processing_dask.save_radar_data_to_zarr(prefix, zarr_base_location=os.path.join(tmp_dir, "add_log"))
+    with open(prefix + "_uhd_stdout.log") as f:
+        log = f.read()
+    expected = xr.open_zarr(zarr_path)
+    processing_dask.add_stdout_log_to_zarr(zarr_path, log)
+    data = xr.open_zarr(zarr_path)
+
+    return [
+        check("add_stdout_log_to_zarr keeps config", data.attrs.get("config") == expected.attrs["config"]),
+        check("add_stdout_log_to_zarr keeps other attributes", all(data.attrs.get(key) == value for key, value in expected.attrs.items())),
+        check("add_stdout_log_to_zarr keeps the error coordinates", "error_chirp_idx" in data.coords),
+    ]
+
+def check_live_zarr(tmp_dir, prefix, config, max_chirps_per_file):
+    # A store built by LiveZarrConverter from the partial files must work with the error
+    # handling functions (which need config and the log index) like one from save_radar_data_to_zarr
+    expected_path = processing_dask.save_radar_data_to_zarr(prefix, zarr_base_location=os.path.join(tmp_dir, "expected"))
+    with open(prefix + "_uhd_stdout.log") as f:
+        log = f.read()
+
+    # Split the recording into partial files, like the radar program does
+    rx_len_samples = int(config['CHIRP']['rx_duration'] * config['GENERATE']['sample_rate'])
+    bytes_per_pulse = rx_len_samples * 8 # fc32
+    with open(prefix + "_rx_samps.bin", "rb") as f:
+        samples = f.read()
+    live_dir = os.path.join(tmp_dir, "live")
+    os.makedirs(live_dir)
+    converter = LiveZarrConverter(config, os.path.join(live_dir, "rx_samps.zarr"))
+    converter.start()
+    for line in log.splitlines():
+        converter.process_log_line(line)
+    for i, start in enumerate(range(0, len(samples), max_chirps_per_file * bytes_per_pulse)):
+        filename = os.path.join(live_dir, f"rx_samps.bin.{i}")
+        with open(filename, "wb") as f:
+            f.write(samples[start:(start + max_chirps_per_file * bytes_per_pulse)])
+        converter.add_file(filename)
+    converter.finish()
+    live_path = converter.save(os.path.join(live_dir, os.path.basename(prefix)), stdout_log=log)
+
+    # Each function is run on a freshly opened store, since fill_errors modifies the data it's given
+    fs = config['GENERATE']['sample_rate']
+    cases = [
+        ("check_if_error_data_exists", lambda data: processing_dask.check_if_error_data_exists(data)),
+        ("fill_errors", lambda data: processing_dask.fill_errors(data)["radar_data"].values),
+        ("remove_errors", lambda data: processing_dask.remove_errors(data)["radar_data"].values),
+        ("pulse_compress (reference chirp from config)", lambda data: processing_dask.pulse_compress(data, None, fs)["radar_data"].values),
+    ]
+
+    results = [check("live zarr store has config", "config" in xr.open_zarr(live_path).attrs)]
+    for name, fn in cases:
+        try:
+            result = fn(xr.open_zarr(live_path))
+        except Exception as e:
+            print(f"{name} failed on the live zarr store: {e!r}")
+            results.append(check(f"live zarr {name}", False))
+            continue
+        expected = fn(xr.open_zarr(expected_path))
+        if isinstance(expected, str):
+            results.append(check(f"live zarr {name}", result == expected))
+        else:
+            results.append(check(f"live zarr {name}", np.allclose(result, expected, equal_nan=True)))
+    return results
+
+if __name__ == "__main__":
+
+    # Check for correct working directory
+    expected_cwd = os.popen('git rev-parse --show-toplevel').read().strip() # Root of git repo
+    if os.getcwd() != expected_cwd:
+        raise Exception(f"This script should ONLY be run from {expected_cwd}. Detected CWD {os.getcwd()}")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("yaml_file", nargs='?', default='config/synthetic_config.yaml',
+            help='Path to YAML configuration file used to synthesize the recording')
+    parser.add_argument("--num_pulses", type=int, default=1000, help='Number of pulses in the recording')
+    parser.add_argument("--error_rate", type=float, default=0.02, help='Probability of a late command error on each chirp')
+    args = parser.parse_args()
+
+    config = processing.load_config(args.yaml_file)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(tmp_dir, "20000101_000000")
+        SyntheticRadar(config, error_rate=args.error_rate).record(prefix, args.num_pulses)
+
+        results = check_add_stdout_log(tmp_dir, prefix)
+        results += check_live_zarr(tmp_dir, prefix, config, max_chirps_per_file=300)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if not all(results):
+        print(f"{len(results) - sum(results)} check(s) failed")
+        exit(1)
@@ -10,11 +10,13 @@ import matplotlib.pyplot as plt
 import numpy as np
 import re
 import pickle
+import scipy.stats
 
 sys.path.append("preprocessing")
 from generate_chirp import generate_from_yaml_filename
 sys.path.append("postprocessing")
 from save_data import save_data
+from radar_output import RadarOutputReader
 
 def run_and_fail_on_nonzero(cmd):
     retval = os.system(cmd)
@@ -22,16 +24,35 @@ def run_and_fail_on_nonzero(cmd):
         print(f"Running '{cmd}' produced non-zero return value {retval}. Quitting...")
         exit(retval)
 
-# Output logging
-def log_output_from_usrp(out, file_out):
-    global current_state
-    for line in iter(out.readline, ''):
-        file_out.write(f"[{time.time():0.3f}] \t{line}")
-        print(f"UHD output: \t{line}", end="")
-    out.close()
-    file_out.close()
-
-def test_with_pulse_rep_int(yaml_filename, pulse_rep_int, timeout_s=60*2, tmp_yaml_filename='tmp_config.yaml.tmp'):
+# Radar program to run from sdr/build (RUN_MANAGER:radar_binary can be set to ../simulated_radar.py to test without hardware)
+def radar_binary(config):
+    return config['RUN_MANAGER'].get('radar_binary') or "./radar"
+
+# Two-sided Clopper-Pearson confidence interval for an error rate of n_errors in n_attempts
+def error_rate_interval(n_errors, n_attempts, confidence=0.95):
+    alpha = 1 - confidence
+    lower = scipy.stats.beta.ppf(alpha/2, n_errors, n_attempts - n_errors + 1) if n_errors > 0 else 0.0
+    upper = scipy.stats.beta.ppf(1 - alpha/2, n_errors + 1, n_attempts - n_errors) if n_errors < n_attempts else 1.0
+    return lower, upper
+
+# Decide from live counters (see RadarOutputReader.stats) whether the error rate is clearly
+# below or above target_error_rate. Returns "below", "above", or None (not clear yet).
+#
+# Successful chirps aren't reported individually, so the number attempted so far is bounded
+# from the elapsed time: at most elapsed_s / pulse_rep_int, and at least that minus the
+# time_offset before the first chirp and the 2 * pulse_rep_int delay added after each error.
+# Each decision uses whichever bound makes it harder to reach.
+def live_decision(stats, pulse_rep_int, time_offset, target_error_rate, confidence=0.95, min_attempts=100):
+    n_errors = stats['errors']
+    n_upper = max(stats['pulses'], int(stats['elapsed_s'] / pulse_rep_int))
+    n_lower = max(stats['pulses'], int((stats['elapsed_s'] - time_offset) / pulse_rep_int) - 2 * n_errors)
+    if n_lower >= min_attempts and error_rate_interval(n_errors, n_lower, confidence)[1] < target_error_rate:
+        return "below"
+    if n_upper >= min_attempts and error_rate_interval(n_errors, n_upper, confidence)[0] > target_error_rate:
+        return "above"
+    return None
+
+def test_with_pulse_rep_int(yaml_filename, pulse_rep_int, timeout_s=60*2, tmp_yaml_filename='tmp_config.yaml.tmp', target_error_rate=None, confidence=0.95):
     # Load YAML file
     yaml = YAML(typ='safe')
     stream = open(yaml_filename)
@@ -44,39 +65,79 @@ def test_with_pulse_rep_int(yaml_filename, pulse_rep_int, timeout_s=60*2, tmp_ya
     with open(tmp_yaml_filename, 'w') as f:
         yaml.dump(config, f)
 
-    uhd_process = subprocess.Popen(["./radar", tmp_yaml_filename], stdout=subprocess.PIPE, bufsize=1, close_fds=True, text=True, cwd="sdr/build")
-    uhd_output_reader_thread = threading.Thread(target=log_output_from_usrp, args=(uhd_process.stdout, open('uhd_stdout.log', 'w')))
+    uhd_process = subprocess.Popen([radar_binary(config), tmp_yaml_filename], stdout=subprocess.PIPE, bufsize=1, close_fds=True, text=True, cwd="sdr/build")
+    output_reader = RadarOutputReader(open('uhd_stdout.log', 'w'))
+    uhd_output_reader_thread = threading.Thread(target=output_reader.read, args=(uhd_process.stdout,))
     uhd_output_reader_thread.daemon = True # thread dies with the program
     uhd_output_reader_thread.start()
 
+    # If a target error rate is provided, errors are counted live and the run is stopped as
+    # soon as the error rate is clearly above or below the target
     print(f"Waiting up to {timeout_s} seconds for the process to quit")
     killed = False
+    decision = None
+    t = time.time()
+    while uhd_process.poll() is None:
+        time.sleep(0.5)
+        if (target_error_rate is not None) and (output_reader.start_time is not None):
+            decision = live_decision(output_reader.stats(), pulse_rep_int, config['CHIRP']['time_offset'], target_error_rate, confidence)
+            if decision is not None:
+                print(f"Error rate is clearly {decision} the target of {target_error_rate}. Stopping early...")
+                uhd_process.send_signal(signal.SIGINT)
+                break
+        if time.time() - t > timeout_s:
+            break
     try:
-        uhd_process.wait(timeout=timeout_s)
+        uhd_process.wait(timeout=(10 if decision is not None else max(timeout_s - (time.time() - t), 0)))
     except subprocess.TimeoutExpired as e:
         print(f"UHD process did not terminate within time limit. Killing...")
         uhd_process.kill()
         killed = True
+    uhd_output_reader_thread.join()
 
     # Save output
     print("Copying data files...")
     file_prefix = save_data(yaml_filename, extra_files={"uhd_stdout.log": "uhd_stdout.log"})
     print("Finished copying data.")
 
-    with open("uhd_stdout.log", "r") as f:
-        n_errors = sum(line.count("ERROR_CODE_LATE_COMMAND") for line in f)
-
+    stats = output_reader.stats()
+    n_errors = stats['errors']
     if killed:
         n_pulses_received = np.nan #max(config['CHIRP']['num_pulses'], n_errors)
     else:
-        with open("uhd_stdout.log", "r") as f:
-            rex = '.Total pulses attempted: (\d+)'
-            n_pulses_received = re.findall(rex, f.read(), re.DOTALL)
-            n_pulses_received = int(n_pulses_received[0])
+        n_pulses_received = stats['totals'].get('Total pulses attempted', np.nan)
 
     print(f"{n_errors}/{n_pulses_received} ERROR_CODE_LATE_COMMAND errors detected / pulses attempted")
 
-    return {'file_prefix': file_prefix, 'pulse_rep_int': pulse_rep_int, 'n_errors': n_errors, 'n_attempts': n_pulses_received, 'process_killed': killed}
+    return {'file_prefix': file_prefix, 'pulse_rep_int': pulse_rep_int, 'n_errors': n_errors, 'n_attempts': n_pulses_received, 'process_killed': killed, 'decision': decision}
+
+# Save results after each run (to preserve them in case of a crash)
+def save_results(results, config, target_error_rate=None):
+    first_pri = list(results.keys())[0]
+    pickle_path = f"./tests/{results[first_pri]['file_prefix']}_error_code_late_command.pickle"
+
+    pris_so_far = list(results.keys())
+    n_error_list = np.array([results[val]['n_errors'] for val in pris_so_far])
+    n_pulse_attempts = np.array([results[val]['n_attempts'] for val in pris_so_far])
+    was_killed = np.array([results[val]['process_killed'] for val in pris_so_far])
+    with open(pickle_path, 'wb') as f:
+        pickle.dump({
+            'n_error_list': n_error_list,
+            'n_pulse_attempts': n_pulse_attempts,
+            'was_killed': was_killed,
+            'pri': pris_so_far,
+            'decision': [results[val]['decision'] for val in pris_so_far],
+            'target_error_rate': target_error_rate,
+            'config': config
+        }, f)
+    print(f"Pickle file saved to: {pickle_path}")
+
+# Was the error rate of this run below the target? Uses the live decision if the run was
+# stopped early, and the final counts otherwise.
+def is_below_target(result, target_error_rate):
+    if result['decision'] is not None:
+        return result['decision'] == "below"
+    return (not result['process_killed']) and (result['n_errors'] / result['n_attempts'] <= target_error_rate)
 
 if __name__ == "__main__":
 
@@ -91,6 +152,16 @@ if __name__ == "__main__":
             help='Path to YAML configuration file')
     parser.add_argument("--half_duplex", action='store_true',
                         help='Calculate duty cycle for a half duplex transport layer. By default, assumes full duplex.')
+    parser.add_argument("--adaptive", action='store_true',
+                        help='Bisect on duty cycle to find the maximum duty cycle with an error rate below --target_error_rate, ' +
+                             'stopping each run as soon as its error rate is clearly above or below the target. ' +
+                             'By default, duty cycles are swept in fixed 5%% steps.')
+    parser.add_argument("--target_error_rate", type=float, default=0.01,
+                        help='Highest acceptable fraction of chirps with ERROR_CODE_LATE_COMMAND (adaptive mode only)')
+    parser.add_argument("--confidence", type=float, default=0.95,
+                        help='Confidence level used to stop runs early and for the reported error rate interval (adaptive mode only)')
+    parser.add_argument("--resolution", type=float, default=1.0,
+                        help='Stop bisecting once the maximum duty cycle is known to within this many percent (adaptive mode only)')
     args = parser.parse_args()
     yaml_filename = args.yaml_file
 
@@ -103,10 +174,11 @@ if __name__ == "__main__":
 
     # Compile UHD program
 
-    os.chdir("sdr/build")
-    run_and_fail_on_nonzero("cmake ..")
-    run_and_fail_on_nonzero("make")
-    os.chdir("../..")
+    if radar_binary(config) == "./radar":
+        os.chdir("sdr/build")
+        run_and_fail_on_nonzero("cmake ..")
+        run_and_fail_on_nonzero("make")
+        os.chdir("../..")
 
     # Figure out a reasonable sweep range
     if args.half_duplex:
@@ -125,45 +197,64 @@ if __name__ == "__main__":
     def duty_to_pri(duty):
         return 100 * active_time / (duty)
 
-    duty_cycles = np.arange(pri_to_duty(max(config['CHIRP']['tx_duration'], config['CHIRP']['rx_duration'])), 1.0, -5) # in percent
-    duty_cycles = np.flip(duty_cycles)
-    pris = duty_to_pri(duty_cycles)
-    
-    print(f"pri values: {pris}")
-    print(f"duty cycles: {duty_cycles}")
     results = {}
-
-    # Run sweep
-    for pri in pris:
+    def run_pri(pri):
         expected_time = 120 + ((pri * config['CHIRP']['num_pulses']) * 2) # Time to allow process to run -- two minutes (for setup) + 2x the expected error-free time
-        results[pri] = test_with_pulse_rep_int(yaml_filename, pulse_rep_int = float(pri), timeout_s=expected_time)
+        results[pri] = test_with_pulse_rep_int(yaml_filename, pulse_rep_int = float(pri), timeout_s=expected_time,
+                                               target_error_rate=(args.target_error_rate if args.adaptive else None), confidence=args.confidence)
 
         for i, j in results.items():
             print(f"pulse_rep_int: {i} \tn_errors: {j['n_errors']}\tn_pulses_attempted: {j['n_attempts']}\tprefix: {j['file_prefix']}")
 
-        # Save results
-        # Save after each run to preserve in case of a crash
-        pickle_path = f"./tests/{results[pris[0]]['file_prefix']}_error_code_late_command.pickle"
-
-        pris_so_far = list(results.keys())
-        n_error_list = np.array([results[val]['n_errors'] for val in pris_so_far])
-        n_pulse_attempts = np.array([results[val]['n_attempts'] for val in pris_so_far])
-        was_killed = np.array([results[val]['process_killed'] for val in pris_so_far])
-        with open(pickle_path, 'wb') as f:
-            pickle.dump({
-                'n_error_list': n_error_list,
-                'n_pulse_attempts': n_pulse_attempts,
-                'was_killed': was_killed,
-                'pri': pris_so_far,
-                'config': config
-            }, f)
-        print(f"Pickle file saved to: {pickle_path}")
+        save_results(results, config, target_error_rate=(args.target_error_rate if args.adaptive else None))
+        return results[pri]
+
+    max_duty_cycle = pri_to_duty(max(config['CHIRP']['tx_duration'], config['CHIRP']['rx_duration']))
+    if args.adaptive:
+        # Bisection on duty cycle, assuming the error rate increases with duty cycle.
+        # low is the highest duty cycle known to be below the target error rate, high is the
+        # lowest duty cycle known to be above it.
+        low, high = None, max_duty_cycle
+        if is_below_target(run_pri(duty_to_pri(high)), args.target_error_rate):
+            low = high
+        else:
+            low = 1.0
+            if not is_below_target(run_pri(duty_to_pri(low)), args.target_error_rate):
+                print(f"Error rate is above the target even at a duty cycle of {low}%")
+                low = None
+        while (low is not None) and (high - low > args.resolution):
+            duty = (low + high) / 2
+            if is_below_target(run_pri(duty_to_pri(duty)), args.target_error_rate):
+                low = duty
+            else:
+                high = duty
+
+        if low is not None:
+            result = results[duty_to_pri(low)]
+            if result['process_killed']:
+                print(f"Maximum sustainable duty cycle: {low:.2f}% (process was killed, so no error rate is available)")
+            else:
+                lower, upper = error_rate_interval(result['n_errors'], result['n_attempts'], args.confidence)
+                print(f"Maximum sustainable duty cycle: {low:.2f}% (between {low:.2f}% and {high:.2f}%) " +
+                      f"with error rate {result['n_errors']}/{result['n_attempts']} " +
+                      f"({args.confidence*100:.0f}% confidence interval: {lower*100:.3f}% to {upper*100:.3f}%)")
+    else:
+        duty_cycles = np.arange(max_duty_cycle, 1.0, -5) # in percent
+        duty_cycles = np.flip(duty_cycles)
+        pris = duty_to_pri(duty_cycles)
+
+        print(f"pri values: {pris}")
+        print(f"duty cycles: {duty_cycles}")
+
+        # Run sweep
+        for pri in pris:
+            run_pri(pri)
 
     duty_cycles = []
     n_errors = []
     n_attempted = []
 
-    for pri, result in results.items():
+    for pri, result in sorted(results.items(), reverse=True):
         duty_cycles.append(pri_to_duty(pri))
         n_errors.append(result['n_errors'])
         n_attempted.append(result['n_attempts'])
@@ -188,6 +279,6 @@ if __name__ == "__main__":
     ax.grid()
     fig.tight_layout()
 
-    fig_path = f"./tests/{results[pris[0]]['file_prefix']}_error_code_late_command.png"
+    fig_path = f"./tests/{results[list(results.keys())[0]]['file_prefix']}_error_code_late_command.png"
     fig.savefig(fig_path)
     print(f"Figure saved to: {fig_path}")
\ No newline at end of file